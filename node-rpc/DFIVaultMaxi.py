@@ -1,14 +1,22 @@
 import json
 import logging
+import math
 
-import requests
 import sys
 import os
 from time import sleep
 
 import traceback
+import journal
+import recorder
+import risk
+import rpc_metrics
+import strategy
+import tokenamount
 import utils
 from utils import rpc, waitForTx
+from router import Router
+from tokenamount import Amount, to_sats
 
 '''
 Script to keep a Defichain vault within a collateral range and therefore use the LM rewards optimally
@@ -17,442 +25,827 @@ DFI donations welcome: dLBqjysPVXYQX4dFSp5hMWdVfbdeY4aHVS
 '''
 
 errortimeout = 5  # blocks
-
-vaultId = "vault"
-address = "myAdress"
-
-mainCollateralAsset = "DFI"
-minCollateralRatio = 160
-maxCollateralRatio = -1
-targetCollateral = 1.6
-lmPair = "notInSettings"
-assetA = "GME"
-assetB = "noSettingsFound"
-minReinvest = None
-logToConsole = True
-logToFile = False
-logId = ""
-heartBeatUrl= None
-
-settingsLastModified = 0
-logger = None
-
-
-def readSettings(settingsPath):
-    global logger, shouldExecute, settingsLastModified, lastBlockSettingsLogged, \
-        vaultId, address, minCollateralRatio, maxCollateralRatio, lmPair, minReinvest, mainCollateralAsset, \
-        logToFile, logToConsole, logId, assetA, assetB, targetCollateral, heartBeatUrl
-
-    lastmodified = os.stat(settingsPath).st_mtime
-    if settingsLastModified == lastmodified:
-        return
-    if logger is not None:
-        logger.info(
-            f"found changed settings file. last changed: {int(lastmodified)} previous settings from {int(settingsLastModified)}")
-    settingsLastModified = lastmodified
-    lastBlockSettingsLogged = 0  # report on next block cause they changed
-    with open(settingsPath) as f:
-        settings = json.load(f)
-        if "NODE_URL" in settings:
-            utils.NODE_URL = settings["NODE_URL"]
-        utils.NODE_USER = settings['NODE_USER']
-        utils.NODE_PASSWORD = settings['NODE_PASSWORD']
-        vaultId = settings['vaultId']
-        address = settings['address']
-        if "minCollateralRatio" in settings and "maxCollateralRatio" in settings:
-            minCollateralRatio = settings['minCollateralRatio']
-            maxCollateralRatio = settings['maxCollateralRatio']
-        lmPair = settings['lmPair']
-        if "mainCollateralAsset" in settings:
-            mainCollateralAsset = settings['mainCollateralAsset']
-        if "minReinvest" in settings:
-            minReinvest = settings['minReinvest']
-        # TODO: add keepWalletClean feature
-        if "logToFile" in settings:
-            logToFile = settings['logToFile']
-        if "logToConsole" in settings:
-            logToConsole = settings['logToConsole']
-        if "logId" in settings:
-            logId = settings['logId']
-            utils.logId = logId
-        if "heartbeaturl" in settings:
-            heartBeatUrl = settings['heartbeaturl']
-        if "telegram" in settings:
-            utils.TELEGRAM_TOKEN = settings['telegram']['token']
-            utils.TELEGRAM_CHANNEL = settings['telegram']['channel']
-            if "logs" in settings['telegram']:
-                utils.TELEGRAM_LOG_CHANNEL = settings['telegram']['logs']
-
-
-    assets = lmPair.split("-")
-    assetA = assets[0]
-    assetB = assets[1]
-    targetCollateral = (minCollateralRatio + maxCollateralRatio) / 200
-
-
-settingsPath = sys.argv[1] if len(sys.argv) > 1 else None
-# read settings
-if settingsPath is not None:
-    print("Importing settings from %s" % settingsPath)
-    readSettings(settingsPath)
-else:
-    print("You need to provide a settings path!")
-
-
-logger = utils.setup_logger("SafeVault_" + logId, logging.INFO, logToConsole, logToFile)
-utils.LOGGER = logger
-
-
-lastheight = rpc('getblockcount')
-vault = rpc("getvault", [vaultId, True])
-nextPriceBlock = 0
-
-lastBlockSettingsLogged = 0
-
-
-def logSettings(scheduledLog=False):
-    global shouldExecute, lastBlockSettingsLogged, \
-        vaultId, address, minCollateralRatio, maxCollateralRatio, lmPair, minReinvest, mainCollateralAsset, \
-        logToFile, logToConsole, logId, assetA, assetB, targetCollateral, heartBeatUrl
-
-    vault = rpc("getvault", [vaultId, True])
-    lastBlockSettingsLogged = rpc('getblockcount')
-
-    isSingleMint = mainCollateralAsset == "DUSD" or lmPair == "DUSD-DFI"
-    singleMintMsg = f" minting only {assetA}" if isSingleMint else "minting both"
-    reinvestMsg = " will not reinvest"
-    if minReinvest is not None:
-        reinvestMsg = f" will reinvest when balance goes above {minReinvest} DFI"
-    heartbeatMsg = ""
-    if heartBeatUrl is not None and len(heartBeatUrl) > 0:
-        heartbeatMsg= " sending heartbeat to "+ heartBeatUrl+ "every 120 blocks"
-
-    if scheduledLog:
-        msg = "still monitoring "
-    else:
-        msg = "starting to monitor"
-    msg = f"{msg} {vaultId}. with pair {assetA}-{assetB}." \
-          f" Vault currently at {vault['collateralRatio']} next {vault['nextCollateralRatio']}, " \
-          f"will increase LM above {maxCollateralRatio} and decrease below {minCollateralRatio}," \
-          + singleMintMsg + "," + reinvestMsg \
-          + heartbeatMsg
-    logger.info(msg)
-
-    if not logToConsole and not scheduledLog:
-        utils.send_telegram(msg)
-
-
-def reduceExposureDoubleMint(neededrepay, pool, account):
-    oracle = rpc("getfixedintervalprice", [assetA + "/USD"])
-
-    neededStock = neededrepay / (oracle['activePrice'] + pool['reserveB/reserveA'])
-    stock_per_token = pool["reserveA"] / pool['totalLiquidity']
-    removeTokens = min(neededStock / stock_per_token, account[lmPair])
-    wanteddusd = pool['reserveB/reserveA'] * neededStock
-    logger.info(f"{rpc('getblockcount')} removing liquidity {round(removeTokens, 4)} tokens for "
-                f"{round(neededStock, 3)}@{assetA} , "
-                f"{round(wanteddusd, 3)}@{assetB}")
-    txId = rpc("removepoolliquidity",
-               [address, "%.8f@%s" % (removeTokens, lmPair), utils.get_tx_input(address)])
-    waitForTx(txId)
-    account = utils.get_account(address)
-    neededStock = min(neededStock, account[assetA])
-    wanteddusd = min(wanteddusd, account[assetB])
-    logger.info(
-        f"{rpc('getblockcount')} done, paying back "
-        f"{round(neededStock, 3)}@{assetA} , {round(wanteddusd, 3)}@{assetB}")
-    data = {"vaultId": vaultId,
-            "from": address,
-            "amounts": ["%.8f@%s" % (neededStock, assetA),
-                        "%.8f@%s" % (wanteddusd, assetB)]
-            }
-    txId = rpc("paybackloan", [data, utils.get_tx_input(address)])
-    waitForTx(txId)
-    logger.info(f"{rpc('getblockcount')} done payback")
-    utils.send_telegram("done reducing exposure")
-
-
-def reduceExposureSingleMint(neededrepay, wantedRatio, pool, account):
-    if assetA != "DUSD":
-        oracleA = rpc("getfixedintervalprice", [assetA + "/USD"])
-    else:
-        oracleA = {"activePrice": 1}
-
-    if assetB != "DUSD":
-        oracleB = rpc("getfixedintervalprice", [assetB + "/USD"])
-    else:
-        oracleB = {"activePrice": 0.99}  # DUSD only counts 0.99 as collateral
-
-    # read wanted values from dictionary
-    oracleA = oracleA["activePrice"]
-    oracleB = oracleB["activePrice"]
-
-    neededcollateral = neededrepay * wantedRatio  # I did the calc this way around, so convert it
-    reserveA = pool['reserveA']
-    reserveB = pool['reserveB']
-    totalLiq = pool['totalLiquidity']
-    ratioPart = (reserveA * oracleA * wantedRatio + reserveB * oracleB) / totalLiq
-    wantedLPTokens = (neededcollateral) / (ratioPart)
-    removeTokens = min(wantedLPTokens, account[lmPair])
-
-    expectedA = removeTokens * reserveA / totalLiq
-    expectedB = removeTokens * reserveB / totalLiq
-    logger.info(f"{rpc('getblockcount')} removing liquidity {round(removeTokens, 4)} tokens for "
-                f"{round(expectedA, 3)}@{assetA} , "
-                f"{round(expectedB, 3)}@{assetB}")
-    txId = rpc("removepoolliquidity",
-               [address, "%.8f@%s" % (removeTokens, lmPair), utils.get_tx_input(address)])
-    waitForTx(txId)
-
-    account = utils.get_account(address)
-    receivedA = min(expectedA, account[assetA])
-    receivedB = min(expectedB, account[assetB])
-    logger.info(
-        f"{rpc('getblockcount')} done, paying back "
-        f"{round(receivedA, 3)}@{assetA}")
-    data = {"vaultId": vaultId,
-            "from": address,
-            "amounts": ["%.8f@%s" % (receivedA, assetA)]
-            }
-    txId = rpc("paybackloan", [data, utils.get_tx_input(address)])
-    waitForTx(txId)
-
-    logger.info(
-        f"{rpc('getblockcount')} done payback, depositing "
-        f"{round(receivedB, 3)}@{assetB}")
-    txId = rpc("deposittovault",
-               [vaultId, address, "%.8f@%s" % (receivedB, assetB), utils.get_tx_input(address)])
-    waitForTx(txId)
-
-    logger.info(f"{rpc('getblockcount')} done deposit and payback")
-    utils.send_telegram("done reducing exposure")
-
-
-def increaseExposureDoubleMint(additionalLoan, pool):
-    oracle = rpc("getfixedintervalprice", [assetA + "/USD"])
-
-    neededStock = additionalLoan / (oracle['activePrice'] + pool['reserveB/reserveA'])
-    neededDUSD = pool['reserveB/reserveA'] * neededStock
-    logger.info(
-        f"{rpc('getblockcount')} taking loan {round(neededStock, 3)}@{assetA}, {round(neededDUSD, 3)}@{assetB}")
-    data = {"vaultId": vaultId,
-            "to": address,
-            "amounts": ["%.8f@%s" % (neededDUSD, assetB),
-                        "%.8f@%s" % (neededStock, assetA)]
-            }
-    txId = rpc("takeloan", [data, utils.get_tx_input(address)])
-    waitForTx(txId)
-
-    pool = utils.get_pool(lmPair)
-    neededStock = pool['reserveA/reserveB'] * neededDUSD
-
-    account = utils.get_account(address)
-    if neededStock > account[assetA]:
-        neededStock = account[assetA]
-        neededDUSD = pool['reserveB/reserveA'] * neededStock
-    logger.info(
-        f"{rpc('getblockcount')} done, adding liquidity "
-        f"{round(neededStock, 3)}@{assetA}, {round(neededDUSD, 3)}@{assetB}")
-    data = {address: ["%.8f@%s" % (neededStock, assetA),
-                      "%.8f@%s" % (neededDUSD, assetB)]
-            }
-    txId = rpc("addpoolliquidity", [data, address, utils.get_tx_input(address)])
-    waitForTx(txId)
-    logger.info(f"{rpc('getblockcount')} done ")
-    utils.send_telegram("done increasing exposure")
-
-
-def increaseExposureSingleMint(additionalLoan, wantedRatio, pool):
-    if assetA != "DUSD":
-        oracleA = rpc("getfixedintervalprice", [assetA + "/USD"])
-    else:
-        oracleA = {"activePrice": 1}
-
-    if assetB != "DUSD":
-        oracleB = rpc("getfixedintervalprice", [assetB + "/USD"])
-    else:
-        oracleB = {"activePrice": 0.99}  # DUSD only counts 0.99 as collateral
-
-    # read wanted values from dictionary
-    oracleA = oracleA["activePrice"]
-    oracleB = oracleB["activePrice"]
-
-    freeCollateral = additionalLoan * wantedRatio  # I did the calc this way around, so convert it
-
-    ratioBA = pool['reserveB/reserveA']
-    usedAssetA = freeCollateral / (wantedRatio * oracleA + ratioBA * oracleB)
-    usedAssetB = (pool['reserveB/reserveA'] * usedAssetA)
-
-    ####
-
-    logger.info(f"{rpc('getblockcount')} taking loan {round(usedAssetA, 3)}@{assetA}")
-    data = {"vaultId": vaultId,
-            "to": address,
-            "amounts": ["%.8f@%s" % (usedAssetA, assetA)]
-            }
-    txId = rpc("takeloan", [data, utils.get_tx_input(address)])
-    waitForTx(txId)
-
-    logger.info(f"{rpc('getblockcount')} withdrawing {round(usedAssetB, 3)}@{assetB}")
-    txId = rpc("withdrawfromvault", [vaultId, address, "%.8f@%s" % (usedAssetB, assetB), utils.get_tx_input(address)])
-    waitForTx(txId)
-
-    pool = utils.get_pool(lmPair)
-    usedAssetA = pool['reserveA/reserveB'] * usedAssetB
-
-    account = utils.get_account(address)
-    if usedAssetA > account[assetA]:
-        usedAssetA = account[assetA]
-        usedAssetB = pool['reserveB/reserveA'] * usedAssetA
-    logger.info(
-        f"{rpc('getblockcount')} done, adding liquidity "
-        f"{round(usedAssetA, 3)}@{assetA}, {round(usedAssetB, 3)}@{assetB}")
-    data = {address: ["%.8f@%s" % (usedAssetA, assetA),
-                      "%.8f@%s" % (usedAssetB, assetB)]
-            }
-    txId = rpc("addpoolliquidity", [data, address, utils.get_tx_input(address)])
-    waitForTx(txId)
-    logger.info(f"{rpc('getblockcount')} done ")
-    utils.send_telegram("done increasing exposure")
-
-
-try:
-    frozen = False
-    lastErrorOnBlock = 0
-
-    # initial log of settings
-    logSettings()
-    while assetB == "DUSD" or lmPair == "DUSD-DFI":
-        lastheight = rpc('getblockcount')
-        if settingsPath is not None:
-            readSettings(settingsPath)
-        if lastheight > lastBlockSettingsLogged + 720:
-            logSettings(True)  # log periodically to know whats going on
-
-        if mainCollateralAsset != "DFI" and assetB != mainCollateralAsset:
-            logger.warning(
-                f"can't work with this combination of mainCollateralAsset {mainCollateralAsset} and lmPair {lmPair}")
-            mainCollateralAsset = "DFI"
-        vault = rpc("getvault", [vaultId, True])
-        isSingleMint = mainCollateralAsset == "DUSD" or lmPair == "DUSD-DFI"
-
-        # TODO: only run loop if new block
+planTimeout = 30  # blocks after its start a plan with unconfirmed txs is given up, same as waitForTx
+reinvestSlippage = 0.005  # the reward swap may execute that much worse than the route the node quoted for it
+
+
+def plan_result(kind, confirmedSteps):
+    """
+    result of a plan that has no loose tokens left
+    :param confirmedSteps: names of the confirmed steps, in the order they were sent
+    """
+    if len(confirmedSteps) == 0:
+        return "aborted"
+    if kind.startswith("increase") and "paybackloan" in confirmedSteps:
+        return "rolledBack"
+    return "done"
+
+
+class VaultMaxi:
+    def __init__(self, settingsPath):
+        self.settingsPath = settingsPath
+
+        self.vaultId = "vault"
+        self.address = "myAdress"
+
+        self.mainCollateralAsset = "DFI"
+        self.minCollateralRatio = 160
+        self.maxCollateralRatio = -1
+        self.targetCollateral = 1.6
+        self.lmPair = "notInSettings"
+        self.assetA = "GME"
+        self.assetB = "noSettingsFound"
+        self.minReinvest = None
+        self.logToConsole = True
+        self.logToFile = False
+        self.logId = ""
+        self.heartBeatUrl = None
+        self.chainTransactions = False
+        self.chainSafety = 0.995  # buffer on pre-computed amounts of chained txs, pool might move within the block
+        self.prepareEmergencyBlocks = 0  # blocks before nextPriceBlock to watch the live prices, 0 = off
+        self.emergencyPlan = None
+        self.journalPath = os.path.splitext(settingsPath)[0] + ".journal"
+        self.journal = None
+        self.metricsSettings = None
+        self.riskSettings = None
+        self.riskEngine = None
+        self.riskCalibrated = False
+        self.liquidationRatio = None
+        self.telegramToken = None
+        self.telegramChannel = None
+        self.telegramLogChannel = None
+
+        self.settingsLastModified = 0
+        self.lastBlockSettingsLogged = 0
+        self.logger = None
+        self.snapshot = None
+        self.nextPriceBlock = 0
+        self.frozen = False
+        self.lastErrorOnBlock = 0
+
+        print("Importing settings from %s" % settingsPath)
+        self.readSettings()
+        self.logger = utils.setup_logger("SafeVault_" + self.logId, logging.INFO, self.logToConsole, self.logToFile)
+        if self.journalPath:
+            self.journal = journal.Journal(self.journalPath)
+
+    def isSupported(self):
+        return self.assetB == "DUSD" or self.lmPair == "DUSD-DFI"
+
+    def send_telegram(self, message):
+        utils.send_telegram(message, self.telegramToken, self.telegramChannel, self.logId)
+
+    def send_telegram_log(self, message):
+        utils.send_telegram_log(message, self.telegramToken, self.telegramLogChannel, self.logId)
+
+    def readSettings(self):
+        lastmodified = os.stat(self.settingsPath).st_mtime
+        if self.settingsLastModified == lastmodified:
+            return
+        if self.logger is not None:
+            self.logger.info(
+                f"found changed settings file. last changed: {int(lastmodified)} previous settings from {int(self.settingsLastModified)}")
+        self.settingsLastModified = lastmodified
+        self.lastBlockSettingsLogged = 0  # report on next block cause they changed
+        with open(self.settingsPath) as f:
+            settings = json.load(f)
+            if "NODE_URL" in settings:
+                utils.NODE_URL = settings["NODE_URL"]
+            if "BACKUP_NODES" in settings:
+                utils.BACKUP_NODES = settings["BACKUP_NODES"]
+            utils.NODE_USER = settings['NODE_USER']
+            utils.NODE_PASSWORD = settings['NODE_PASSWORD']
+            self.vaultId = settings['vaultId']
+            self.address = settings['address']
+            if "minCollateralRatio" in settings and "maxCollateralRatio" in settings:
+                self.minCollateralRatio = settings['minCollateralRatio']
+                self.maxCollateralRatio = settings['maxCollateralRatio']
+            self.lmPair = settings['lmPair']
+            if "mainCollateralAsset" in settings:
+                self.mainCollateralAsset = settings['mainCollateralAsset']
+            if "minReinvest" in settings:
+                self.minReinvest = settings['minReinvest']
+            # TODO: add keepWalletClean feature
+            if "logToFile" in settings:
+                self.logToFile = settings['logToFile']
+            if "logToConsole" in settings:
+                self.logToConsole = settings['logToConsole']
+            if "logId" in settings:
+                self.logId = settings['logId']
+            if "heartbeaturl" in settings:
+                self.heartBeatUrl = settings['heartbeaturl']
+            if "chainTransactions" in settings:
+                self.chainTransactions = settings['chainTransactions']
+            if "journal" in settings:
+                self.journalPath = settings['journal']  # false to disable
+            if "prepareEmergency" in settings:
+                self.prepareEmergencyBlocks = settings['prepareEmergency']
+            if "recordTo" in settings:
+                recorder.attach(settings['recordTo'])
+            if "compactRecords" in settings:
+                utils.COMPACT_POOLS = settings['compactRecords']
+            if "metrics" in settings:
+                self.metricsSettings = settings['metrics']
+            if "riskEngine" in settings:
+                self.riskSettings = settings['riskEngine']
+                self.riskEngine = risk.RiskEngine(self.riskSettings.get('paths', 10000),
+                                                  self.riskSettings.get('intervals', 1))
+                self.riskCalibrated = False
+            if "utxoSplit" in settings:
+                # f.e. {"count": 10, "amount": 0.1}: keep 10 utxos of 0.1 DFI for the txs of this address
+                utils.utxo_manager(self.address).configure(settings['utxoSplit']['count'],
+                                                           settings['utxoSplit']['amount'])
+            if "telegram" in settings:
+                self.telegramToken = settings['telegram']['token']
+                self.telegramChannel = settings['telegram']['channel']
+                if "logs" in settings['telegram']:
+                    self.telegramLogChannel = settings['telegram']['logs']
+
+        assets = self.lmPair.split("-")
+        self.assetA = assets[0]
+        self.assetB = assets[1]
+        self.targetCollateral = strategy.target_collateral(self.minCollateralRatio, self.maxCollateralRatio)
+
+    def logSettings(self, scheduledLog=False):
+        snapshot = utils.chain_snapshot(self.vaultId, self.address)
+        if not scheduledLog and self.journal is not None:
+            logged = self.journal.state.get("lastBlockSettingsLogged", 0)
+            if self.journal.state.get("settingsModified") == self.settingsLastModified \
+                    and snapshot.height < logged + 720:
+                # restart with the same settings, they were announced recently
+                self.lastBlockSettingsLogged = logged
+                return
+        self.lastBlockSettingsLogged = snapshot.height
+        if self.journal is not None:
+            self.journal.set_state(lastBlockSettingsLogged=snapshot.height, settingsModified=self.settingsLastModified)
+        vault = snapshot.vault(self.vaultId)
+
+        isSingleMint = strategy.is_single_mint(self.mainCollateralAsset, self.lmPair)
+        singleMintMsg = f" minting only {self.assetA}" if isSingleMint else "minting both"
+        reinvestMsg = " will not reinvest"
+        if self.minReinvest is not None:
+            reinvestMsg = f" will reinvest when balance goes above {self.minReinvest} DFI"
+        heartbeatMsg = ""
+        if self.heartBeatUrl is not None and len(self.heartBeatUrl) > 0:
+            heartbeatMsg= " sending heartbeat to "+ self.heartBeatUrl+ "every 120 blocks"
+        chainMsg = " chaining exposure txs in one block," if self.chainTransactions else ""
+        if self.prepareEmergencyBlocks > 0:
+            chainMsg += f" chaining a reduce at the price block if the live prices of the last " \
+                        f"{self.prepareEmergencyBlocks} blocks call for it,"
+
+        if scheduledLog:
+            msg = "still monitoring "
+        else:
+            msg = "starting to monitor"
+        msg = f"{msg} {self.vaultId}. with pair {self.assetA}-{self.assetB}." \
+              f" Vault currently at {vault['collateralRatio']} next {vault['nextCollateralRatio']}, " \
+              f"will increase LM above {self.maxCollateralRatio} and decrease below {self.minCollateralRatio}," \
+              + singleMintMsg + "," + chainMsg + reinvestMsg \
+              + heartbeatMsg
+        self.logger.info(msg)
+
+        if not self.logToConsole and not scheduledLog:
+            self.send_telegram(msg)
+
+    def beginPlan(self, kind, params):
+        # the steps of a plan are journaled, so a restart can finish what a crash interrupted (resumePlans).
+        # the balances before the plan tell which tokens of the wallet belong to it
+        if self.journal is None:
+            return None
+        account = self.snapshot.account(self.address)
+        params["balances"] = {self.assetA: account.get(self.assetA, 0), self.assetB: account.get(self.assetB, 0)}
+        return self.journal.begin(kind, params, utils.chainHeight)
+
+    def planSent(self, planId, step, txId):
+        if planId is not None:
+            self.journal.sent(planId, step, txId)
+
+    def endPlan(self, planId, result="done"):
+        if planId is not None:
+            self.journal.end(planId, result)
+
+    def planIncomplete(self, planId, step):
+        # a step was rejected or not mined: the plan stays open and resumePlans finishes it from the next block on
+        later = "finishing it from the next block" if planId is not None else "check the wallet for loose tokens"
+        self.logger.warning(f"{utils.chainHeight} {step} did not go through, {later}")
+        self.send_telegram(f"{step} did not go through, {later}")
+
+    def sendTx(self, method, params, txInput=None):
+        """
+        sends a tx of the address with txInput (a fresh input if None) as last param and updates the utxo cache
+        :return: txId, None if the node rejected it
+        """
+        if txInput is None:
+            txInput = utils.get_tx_input(self.address)
+        return utils.tx_sent(self.address, txInput, rpc(method, params + [txInput]))
+
+    def nextTxInput(self, prevTxId, chained=False):
+        # with chainTransactions the follow-up tx spends the change of the previous one, so both land in the same block.
+        # otherwise wait for the previous tx to be mined first. None if it wasn't
+        if self.chainTransactions or chained:
+            return utils.get_chained_tx_input(prevTxId, self.address)
+        if not waitForTx(prevTxId):
+            return None
+        return utils.get_tx_input(self.address)
+
+    def reduceExposureDoubleMint(self, neededrepay, pool, account, txInput=None):
+        oracle = self.snapshot.fixed_price(self.assetA)
+
+        [removeTokens, neededStock, wanteddusd] = strategy.reduce_double_mint(
+            neededrepay, oracle['activePrice'], pool['reserveA'], pool['reserveB'], pool['totalLiquidity'],
+            account[self.lmPair])
+        self.logger.info(f"{utils.chainHeight} removing liquidity {round(removeTokens, 4)} tokens for "
+                         f"{round(neededStock, 3)}@{self.assetA} , "
+                         f"{round(wanteddusd, 3)}@{self.assetB}")
+        planId = self.beginPlan("reduceDoubleMint",
+                                {"removeTokens": removeTokens, "assetA": neededStock, "assetB": wanteddusd})
+        removeTokens = Amount.of(removeTokens, self.lmPair)
+        neededStock = Amount.of(neededStock, self.assetA)
+        wanteddusd = Amount.of(wanteddusd, self.assetB)
+        # a prepared input (emergency plan) means chaining everything, no time to wait for blocks
+        chained = self.chainTransactions or txInput is not None
+        txId = self.sendTx("removepoolliquidity", [self.address, str(removeTokens)], txInput)
+        self.planSent(planId, "removepoolliquidity", txId)
+        if txId is None:
+            return self.planIncomplete(planId, "removepoolliquidity")
+        if chained:
+            # can't read the account before the removal is mined, so use the amounts from the pool snapshot
+            neededStock = min(neededStock, self.removedAmount(removeTokens, pool, 'reserveA') * self.chainSafety)
+            wanteddusd = min(wanteddusd, self.removedAmount(removeTokens, pool, 'reserveB') * self.chainSafety)
+            txInput = utils.get_chained_tx_input(txId, self.address)
+        else:
+            if not waitForTx(txId):
+                return self.planIncomplete(planId, "removepoolliquidity")
+            account = utils.get_account_amounts(self.address)
+            neededStock = min(neededStock, account.get(self.assetA, Amount(0, self.assetA)))
+            wanteddusd = min(wanteddusd, account.get(self.assetB, Amount(0, self.assetB)))
+            txInput = utils.get_tx_input(self.address)
+        self.logger.info(f"{utils.chainHeight} done, paying back {neededStock} , {wanteddusd}")
+        data = {"vaultId": self.vaultId,
+                "from": self.address,
+                "amounts": [str(neededStock), str(wanteddusd)]
+                }
+        txId = self.sendTx("paybackloan", [data], txInput)
+        self.planSent(planId, "paybackloan", txId)
+        if not waitForTx(txId):
+            return self.planIncomplete(planId, "paybackloan")
+        self.endPlan(planId)
+        self.logger.info(f"{utils.chainHeight} done payback")
+        self.send_telegram("done reducing exposure")
+
+    def removedAmount(self, removeTokens, pool, reserve):
+        token = self.assetA if reserve == 'reserveA' else self.assetB
+        return Amount(tokenamount.removed_amount(removeTokens.sats, to_sats(pool[reserve]),
+                                                 to_sats(pool['totalLiquidity'])), token)
+
+    def poolRatioAmount(self, amount, pool):
+        """
+        :return: the other token of the pair in the ratio of the pool, rounded down
+        """
+        if amount.token == self.assetA:
+            return Amount(tokenamount.at_pool_ratio(amount.sats, to_sats(pool['reserveA']),
+                                                    to_sats(pool['reserveB'])), self.assetB)
+        return Amount(tokenamount.at_pool_ratio(amount.sats, to_sats(pool['reserveB']), to_sats(pool['reserveA'])),
+                      self.assetA)
+
+    def singleMintOracles(self):
+        oracleA = self.snapshot.fixed_price(self.assetA)['activePrice'] if self.assetA != "DUSD" else 1
+        if self.assetB != "DUSD":
+            oracleB = self.snapshot.fixed_price(self.assetB)['activePrice']
+        else:
+            oracleB = strategy.DUSD_COLLATERAL_FACTOR
+        return [oracleA, oracleB]
+
+    def reduceExposureSingleMint(self, neededrepay, wantedRatio, pool, account, txInput=None):
+        [oracleA, oracleB] = self.singleMintOracles()
+
+        [removeTokens, expectedA, expectedB] = strategy.reduce_single_mint(
+            neededrepay, wantedRatio, oracleA, oracleB, pool['reserveA'], pool['reserveB'], pool['totalLiquidity'],
+            account[self.lmPair])
+        self.logger.info(f"{utils.chainHeight} removing liquidity {round(removeTokens, 4)} tokens for "
+                         f"{round(expectedA, 3)}@{self.assetA} , "
+                         f"{round(expectedB, 3)}@{self.assetB}")
+        planId = self.beginPlan("reduceSingleMint",
+                                {"removeTokens": removeTokens, "assetA": expectedA, "assetB": expectedB})
+        removeTokens = Amount.of(removeTokens, self.lmPair)
+        chained = self.chainTransactions or txInput is not None
+        txId = self.sendTx("removepoolliquidity", [self.address, str(removeTokens)], txInput)
+        self.planSent(planId, "removepoolliquidity", txId)
+        if txId is None:
+            return self.planIncomplete(planId, "removepoolliquidity")
+        if chained:
+            # can't read the account before the removal is mined, so use the amounts from the pool snapshot
+            receivedA = min(Amount.of(expectedA, self.assetA),
+                            self.removedAmount(removeTokens, pool, 'reserveA')) * self.chainSafety
+            receivedB = min(Amount.of(expectedB, self.assetB),
+                            self.removedAmount(removeTokens, pool, 'reserveB')) * self.chainSafety
+            txInput = utils.get_chained_tx_input(txId, self.address)
+        else:
+            if not waitForTx(txId):
+                return self.planIncomplete(planId, "removepoolliquidity")
+            account = utils.get_account_amounts(self.address)
+            receivedA = min(Amount.of(expectedA, self.assetA), account.get(self.assetA, Amount(0, self.assetA)))
+            receivedB = min(Amount.of(expectedB, self.assetB), account.get(self.assetB, Amount(0, self.assetB)))
+            txInput = utils.get_tx_input(self.address)
+        self.logger.info(f"{utils.chainHeight} done, paying back {receivedA}")
+        data = {"vaultId": self.vaultId,
+                "from": self.address,
+                "amounts": [str(receivedA)]
+                }
+        txId = self.sendTx("paybackloan", [data], txInput)
+        self.planSent(planId, "paybackloan", txId)
+        txInput = self.nextTxInput(txId, chained) if txId is not None else None
+        if txInput is None:
+            return self.planIncomplete(planId, "paybackloan")
+
+        self.logger.info(f"{utils.chainHeight} done payback, depositing {receivedB}")
+        txId = self.sendTx("deposittovault", [self.vaultId, self.address, str(receivedB)], txInput)
+        self.planSent(planId, "deposittovault", txId)
+        if not waitForTx(txId):
+            return self.planIncomplete(planId, "deposittovault")
+        self.endPlan(planId)
+
+        self.logger.info(f"{utils.chainHeight} done deposit and payback")
+        self.send_telegram("done reducing exposure")
+
+    def increaseExposureDoubleMint(self, additionalLoan, pool):
+        oracle = self.snapshot.fixed_price(self.assetA)
+
+        [neededStock, neededDUSD] = strategy.increase_double_mint(additionalLoan, oracle['activePrice'],
+                                                                  pool['reserveA'], pool['reserveB'])
+        planId = self.beginPlan("increaseDoubleMint", {"assetA": neededStock, "assetB": neededDUSD})
+        neededStock = Amount.of(neededStock, self.assetA)
+        neededDUSD = Amount.of(neededDUSD, self.assetB)
+        self.logger.info(f"{utils.chainHeight} taking loan {neededStock}, {neededDUSD}")
+        data = {"vaultId": self.vaultId,
+                "to": self.address,
+                "amounts": [str(neededDUSD), str(neededStock)]
+                }
+        txId = self.sendTx("takeloan", [data])
+        self.planSent(planId, "takeloan", txId)
+        if txId is None:
+            return self.planIncomplete(planId, "takeloan")
+        if self.chainTransactions:
+            # loan amounts are known exactly, add them with the ratio of the pool snapshot
+            txInput = utils.get_chained_tx_input(txId, self.address)
+        else:
+            if not waitForTx(txId):
+                return self.planIncomplete(planId, "takeloan")
+            txInput = utils.get_tx_input(self.address)
+
+            pool = utils.get_pool(self.lmPair)
+            neededStock = self.poolRatioAmount(neededDUSD, pool)
+
+            account = utils.get_account_amounts(self.address)
+            if neededStock > account.get(self.assetA, Amount(0, self.assetA)):
+                neededStock = account[self.assetA]
+                neededDUSD = self.poolRatioAmount(neededStock, pool)
+        self.logger.info(f"{utils.chainHeight} done, adding liquidity {neededStock}, {neededDUSD}")
+        data = {self.address: [str(neededStock), str(neededDUSD)]}
+        txId = self.sendTx("addpoolliquidity", [data, self.address], txInput)
+        self.planSent(planId, "addpoolliquidity", txId)
+        if not waitForTx(txId):
+            return self.planIncomplete(planId, "addpoolliquidity")
+        self.endPlan(planId)
+        self.logger.info(f"{utils.chainHeight} done ")
+        self.send_telegram("done increasing exposure")
+
+    def increaseExposureSingleMint(self, additionalLoan, wantedRatio, pool):
+        [oracleA, oracleB] = self.singleMintOracles()
+
+        [usedAssetA, usedAssetB] = strategy.increase_single_mint(additionalLoan, wantedRatio, oracleA, oracleB,
+                                                                 pool['reserveA'], pool['reserveB'])
+
+        planId = self.beginPlan("increaseSingleMint", {"assetA": usedAssetA, "assetB": usedAssetB})
+        usedAssetA = Amount.of(usedAssetA, self.assetA)
+        usedAssetB = Amount.of(usedAssetB, self.assetB)
+        self.logger.info(f"{utils.chainHeight} taking loan {usedAssetA}")
+        data = {"vaultId": self.vaultId,
+                "to": self.address,
+                "amounts": [str(usedAssetA)]
+                }
+        txId = self.sendTx("takeloan", [data])
+        self.planSent(planId, "takeloan", txId)
+        txInput = self.nextTxInput(txId) if txId is not None else None
+        if txInput is None:
+            return self.planIncomplete(planId, "takeloan")
+
+        self.logger.info(f"{utils.chainHeight} withdrawing {usedAssetB}")
+        txId = self.sendTx("withdrawfromvault", [self.vaultId, self.address, str(usedAssetB)], txInput)
+        self.planSent(planId, "withdrawfromvault", txId)
+        if txId is None:
+            return self.planIncomplete(planId, "withdrawfromvault")
+        if self.chainTransactions:
+            # loan and withdrawal amounts are known exactly, add them with the ratio of the pool snapshot
+            txInput = utils.get_chained_tx_input(txId, self.address)
+        else:
+            if not waitForTx(txId):
+                return self.planIncomplete(planId, "withdrawfromvault")
+            txInput = utils.get_tx_input(self.address)
+
+            pool = utils.get_pool(self.lmPair)
+            usedAssetA = self.poolRatioAmount(usedAssetB, pool)
+
+            account = utils.get_account_amounts(self.address)
+            if usedAssetA > account.get(self.assetA, Amount(0, self.assetA)):
+                usedAssetA = account[self.assetA]
+                usedAssetB = self.poolRatioAmount(usedAssetA, pool)
+        self.logger.info(f"{utils.chainHeight} done, adding liquidity {usedAssetA}, {usedAssetB}")
+        data = {self.address: [str(usedAssetA), str(usedAssetB)]}
+        txId = self.sendTx("addpoolliquidity", [data, self.address], txInput)
+        self.planSent(planId, "addpoolliquidity", txId)
+        if not waitForTx(txId):
+            return self.planIncomplete(planId, "addpoolliquidity")
+        self.endPlan(planId)
+        self.logger.info(f"{utils.chainHeight} done ")
+        self.send_telegram("done increasing exposure")
+
+    def prepareEmergency(self, snapshot, vault):
+        """
+        in the blocks before nextPriceBlock: if the live prices (that become the next oracle price there) would bring
+        the vault below minCollateralRatio, keep an input reserved for the price block. if a reduce is needed there,
+        its txs are chained with that input, without waiting for confirmations in between.
+        the amounts are computed at the price block from its snapshot as usual, and defid signs and sends custom txs
+        in the same call, so nothing else can be prepared in advance.
+        """
+        nextPriceBlock = snapshot.loanInfo["nextPriceBlock"]
+        if not nextPriceBlock - self.prepareEmergencyBlocks <= snapshot.height < nextPriceBlock:
+            return
+        prices = {"DUSD": 1}
+        for price in snapshot.livePrices:
+            if price['currency'] == 'USD' and price['ok'] and "price" in price:
+                prices[price['token']] = price['price']
+        ratio = strategy.projected_ratio(vault.collaterals(), vault.loans(), prices)
+        if ratio is None or not 0 < ratio < self.minCollateralRatio:
+            self.dropEmergencyPlan()
+            return
+        [action, usdAmount] = strategy.decide(vault['collateralRatio'], ratio,
+                                              vault['collateralValue'], vault['loanValue'],
+                                              self.minCollateralRatio, self.maxCollateralRatio, self.targetCollateral)
+        if self.emergencyPlan is None:
+            self.logger.info(f"{snapshot.height} live prices would bring the ratio to {round(ratio, 2)} at "
+                             f"{nextPriceBlock} (repay about {round(usdAmount, 2)} USD), a reduce there will be chained")
+            self.send_telegram(f"emergency reduce ready, ratio would go to {round(ratio, 2)} at {nextPriceBlock}")
+        else:
+            utils.utxo_manager(self.address).release(self.emergencyPlan['txInput'])
+        # fresh input every block, so it is sure to be unspent when the plan is used
+        self.emergencyPlan = {"triggerHeight": nextPriceBlock, "txInput": utils.get_tx_input(self.address)}
+
+    def dropEmergencyPlan(self):
+        if self.emergencyPlan is not None:
+            utils.utxo_manager(self.address).release(self.emergencyPlan['txInput'])
+            self.logger.info(f"{utils.chainHeight} dropped emergency plan")
+            self.emergencyPlan = None
+
+    def calibrateRisk(self, height):
+        path = self.riskSettings.get('history')
+        if path is None:
+            return
+        # opened fresh and read-only, the store might be written by another process right now
+        store = recorder.Recorder(path, readOnly=True)
+        try:
+            self.riskEngine.calibrate_from(store, height)
+        finally:
+            store.close()
+        self.logger.info(f"{height} calibrated risk engine from {path}: volatility per price interval "
+                         + ", ".join(f"{token} {round(100 * math.sqrt(variance), 2)}%" for token, variance
+                                     in zip(self.riskEngine.tokens, self.riskEngine.covariance.diagonal())))
+
+    def updateRisk(self, snapshot, vault, newPriceBlock):
+        """
+        liquidation risk of the current composition. with "apply" the collateral range follows the safe ratio
+        """
+        if self.liquidationRatio is None:
+            scheme = rpc("getloanscheme", [vault['loanSchemeId']], silentErrors=True)
+            self.liquidationRatio = scheme['mincolratio'] if scheme is not None else 150
+        if not self.riskCalibrated or newPriceBlock:
+            # recorded volatility only changes with new prices
+            self.calibrateRisk(snapshot.height)
+            self.riskCalibrated = True
+        collaterals = vault.collaterals()
+        loans = vault.loans()
+        prices = {}
+        nextPrices = {}
+        for token in set(collaterals.keys()) | set(loans.keys()):
+            if token in risk.FIXED_TOKENS:
+                continue
+            price = snapshot.fixed_price(token)
+            if price is None:
+                return
+            prices[token] = price['activePrice']
+            nextPrices[token] = price['nextPrice']
+        maxProbability = self.riskSettings.get('maxProbability', 0.001)
+        result = self.riskEngine.evaluate(collaterals, loans, prices, nextPrices, vault['collateralRatio'],
+                                          self.liquidationRatio, maxProbability)
+        [newMin, newMax] = risk.suggested_range(result['safeRatio'], self.minCollateralRatio,
+                                                self.maxCollateralRatio, self.liquidationRatio)
+        if newPriceBlock:
+            self.logger.info(f"{snapshot.height} liquidation risk at ratio {vault['collateralRatio']}: "
+                             f"{round(100 * result['probability'], 3)}%, safe min ratio {round(result['safeRatio'], 1)} "
+                             f"for {100 * maxProbability}% ({round(1000 * result['seconds'], 1)} ms)")
+        # the quantile moves a bit with every run of paths, don't follow every wiggle
+        if self.riskSettings.get('apply', False) and abs(newMin - self.minCollateralRatio) >= 2:
+            msg = (f"risk engine moves the range from {self.minCollateralRatio}-{self.maxCollateralRatio} "
+                   f"to {newMin}-{newMax}")
+            self.logger.info(f"{snapshot.height} {msg}")
+            self.send_telegram_log(msg)
+            self.minCollateralRatio = newMin
+            self.maxCollateralRatio = newMax
+            self.targetCollateral = strategy.target_collateral(newMin, newMax)
+
+    def resumePlans(self, snapshot):
+        """
+        finishes (or rolls back) the operations that a crash, a rejected or an unconfirmed tx interrupted
+        (see journal.py).
+        the journaled txs are checked with one batch call and the missing steps are sent on the snapshot of this block.
+        a plan with txs in the mempool waits for the next block (up to planTimeout blocks after its start, then it is
+        ended as "failed"), one with sent follow-up txs stays open until they are confirmed and no loose tokens are
+        left.
+        :return: True if plans are still in progress (the vault should not be touched in this block)
+        """
+        plans = self.journal.open_plans()
+        if len(plans) == 0:
+            return False
+        # a tx sent right before a crash but not journaled yet is still in the mempool,
+        # the chain rejects spending the same tokens twice
+        txIds = [txId for plan in plans for step, txId in plan['steps'] if txId is not None]
+        try:
+            states = utils.tx_states(txIds) if len(txIds) > 0 else {}
+        except Exception as e:
+            self.logger.warning(f"{snapshot.height} checking the txs of {len(plans)} open plans failed: {str(e)}")
+            return True
+        busy = False
+        ended = False
+        for plan in plans:
+            steps = [(step, states[txId]) for step, txId in plan['steps'] if txId is not None]
+            if any(state != utils.TX_CONFIRMED and state != utils.TX_FAILED for step, state in steps):
+                if plan['height'] is not None and snapshot.height - plan['height'] > planTimeout:
+                    # stuck in the mempool, don't block the vault forever
+                    self.journal.end(plan['id'], "failed")
+                    ended = True
+                    msg = (f"gave up on {plan['kind']} from block {plan['height']}, its txs are still unconfirmed. "
+                           f"check the wallet for loose tokens")
+                    self.logger.warning(f"{snapshot.height} {msg}")
+                    self.send_telegram(msg)
+                else:
+                    busy = True  # not final yet
+                continue
+            result = self.finishPlan(plan, snapshot)
+            if result == "nothing":
+                result = plan_result(plan['kind'], [step for step, state in steps if state == utils.TX_CONFIRMED])
+                self.journal.end(plan['id'], result)
+                ended = True
+                self.logger.info(f"{snapshot.height} interrupted {plan['kind']} from block {plan['height']}: {result}")
+                self.send_telegram(f"resumed interrupted {plan['kind']}: {result}")
+            else:
+                busy = busy or result != "failed"
+                self.logger.info(f"{snapshot.height} finishing interrupted {plan['kind']} from block "
+                                 f"{plan['height']}: {result}")
+        if ended:
+            self.journal.compact()
+        return busy
+
+    def finishPlan(self, plan, snapshot):
+        """
+        sends the missing steps of an interrupted plan. what is missing follows from the tokens that are in the wallet
+        on top of the balances at the start of the plan (capped at the planned amounts): they are still to be paid back,
+        deposited or added to the pool. the sent txs are journaled as steps of the plan
+        :return: "nothing" (no loose tokens), "done" or "rolledBack" if txs were sent,
+                 "failed" if the node rejected them
+        """
+        kind = plan['kind']
+        params = plan['params']
+        account = snapshot.account_amounts(self.address)
+        looseA = min(Amount.of(params['assetA'], self.assetA),
+                     account.get(self.assetA, Amount(0, self.assetA)) - Amount.of(params['balances'][self.assetA],
+                                                                                  self.assetA))
+        looseB = min(Amount.of(params['assetB'], self.assetB),
+                     account.get(self.assetB, Amount(0, self.assetB)) - Amount.of(params['balances'][self.assetB],
+                                                                                  self.assetB))
+        planId = plan['id']
+        txIds = []
+
+        def send(method, params):
+            txInput = utils.get_tx_input(self.address) if len(txIds) == 0 or txIds[-1] is None else \
+                utils.get_chained_tx_input(txIds[-1], self.address)
+            txId = self.sendTx(method, params, txInput)
+            self.journal.sent(planId, method, txId)
+            txIds.append(txId)
+
+        result = "nothing"
+        if kind == "increaseSingleMint" and looseA > 0 and looseB <= 0:
+            # loan taken, collateral not withdrawn yet. the vault moved since, withdrawing blind could be dangerous:
+            # give the loan back instead
+            send("paybackloan", [{"vaultId": self.vaultId, "from": self.address, "amounts": [str(looseA)]}])
+            result = "rolledBack"
+        elif kind.startswith("increase") and looseA > 0 and looseB > 0:
+            # add in the current pool ratio
+            pool = snapshot.pool(self.lmPair)
+            looseB = min(looseB, self.poolRatioAmount(looseA, pool))
+            looseA = self.poolRatioAmount(looseB, pool)
+            send("addpoolliquidity", [{self.address: [str(looseA), str(looseB)]}, self.address])
+            result = "done"
+        elif kind == "reduceDoubleMint" and (looseA > 0 or looseB > 0):
+            amounts = [str(amount) for amount in [looseA, looseB] if amount > 0]
+            send("paybackloan", [{"vaultId": self.vaultId, "from": self.address, "amounts": amounts}])
+            result = "done"
+        elif kind == "reduceSingleMint":
+            if looseA > 0:
+                send("paybackloan", [{"vaultId": self.vaultId, "from": self.address, "amounts": [str(looseA)]}])
+                result = "done"
+            if looseB > 0:
+                send("deposittovault", [self.vaultId, self.address, str(looseB)])
+                result = "done"
+        if any(txId is None for txId in txIds):
+            return "failed"
+        return result
+
+    def processBlock(self, snapshot):
+        """
+        runs the checks and actions for one block
+        :param snapshot: ChainSnapshot of the block, containing this vault and address
+        :return: False if the vault can't be handled anymore
+        """
+        self.readSettings()
+        if not self.isSupported():
+            return False
+        self.snapshot = snapshot
+        lastheight = snapshot.height
+        vault = snapshot.vault(self.vaultId)
+        if self.journal is not None and self.resumePlans(snapshot):
+            if not 0 < min(vault['collateralRatio'], vault['nextCollateralRatio']) < self.minCollateralRatio:
+                return True  # plans in progress, decide once they are through
+            # below the range: reducing can't wait for them
+            self.logger.warning(f"{lastheight} open plans, but the ratio is below {self.minCollateralRatio}")
+        if lastheight > self.lastBlockSettingsLogged + 720:
+            self.logSettings(True)  # log periodically to know whats going on
+
+        if self.mainCollateralAsset != "DFI" and self.assetB != self.mainCollateralAsset:
+            self.logger.warning(
+                f"can't work with this combination of mainCollateralAsset {self.mainCollateralAsset} and lmPair {self.lmPair}")
+            self.mainCollateralAsset = "DFI"
+        isSingleMint = strategy.is_single_mint(self.mainCollateralAsset, self.lmPair)
 
         collateralRatio = min(vault['collateralRatio'], vault['nextCollateralRatio'])
-        if nextPriceBlock <= lastheight:
-            nextPriceBlock = rpc("getloaninfo")["nextPriceBlock"]
-            if heartBeatUrl is not None and len(heartBeatUrl) > 0:
-                requests.get(heartBeatUrl)
-            utils.send_telegram_log(
-                f"current ratio {collateralRatio} ( {vault['collateralRatio']}/{vault['nextCollateralRatio']} ), target range: {minCollateralRatio} - {maxCollateralRatio} running on {lmPair} {('singlemint' if isSingleMint else 'minting both')}")
-            logger.info(
+        newPriceBlock = self.nextPriceBlock <= lastheight
+        if newPriceBlock:
+            self.nextPriceBlock = snapshot.loanInfo["nextPriceBlock"]
+            utils.send_heartbeat(self.heartBeatUrl)
+            self.send_telegram_log(
+                f"current ratio {collateralRatio} ( {vault['collateralRatio']}/{vault['nextCollateralRatio']} ), target range: {self.minCollateralRatio} - {self.maxCollateralRatio} running on {self.lmPair} {('singlemint' if isSingleMint else 'minting both')}")
+            self.logger.info(
                 f"--next price block: %d currentRatio %d "
-                % (nextPriceBlock, collateralRatio))
-
+                % (self.nextPriceBlock, collateralRatio))
 
         if vault['state'] == 'frozen':
-            if not frozen:
-                logger.warning(f"{lastheight} vault halted, waiting for resume")
-                utils.send_telegram(f"vault halted")
+            if not self.frozen:
+                self.logger.warning(f"{lastheight} vault halted, waiting for resume")
+                self.send_telegram(f"vault halted")
                 # TODO: remove exposure for safety
-            frozen = True
-            sleep(60)
-            continue
-        if frozen:
-            utils.send_telegram(f"vault active again")
-            logger.info(f"{lastheight} vault active again")
-
-        frozen = False
+            self.frozen = True
+            return True
+        if self.frozen:
+            self.send_telegram(f"vault active again")
+            self.logger.info(f"{lastheight} vault active again")
+
+        self.frozen = False
         if vault['state'] != "active":
-            if lastheight > lastErrorOnBlock:
-                utils.send_telegram(f"something is wrong with the vault {vaultId}: {str(vault)}")
-            lastErrorOnBlock = lastheight
+            if lastheight > self.lastErrorOnBlock:
+                self.send_telegram(f"something is wrong with the vault {self.vaultId}: {str(vault)}")
+            self.lastErrorOnBlock = lastheight
 
         if vault['state'] == 'inLiquidation':
-            logger.warn(f"got liquidated. quitting")
-            break
+            self.logger.warn(f"got liquidated. quitting")
+            return False
+
+        if self.riskEngine is not None:
+            self.updateRisk(snapshot, vault, newPriceBlock)
 
+        emergencyInput = None
+        if self.emergencyPlan is not None and lastheight >= self.emergencyPlan['triggerHeight']:
+            # the price block is here: reduce first, reinvest can wait
+            emergencyInput = self.emergencyPlan['txInput']
+            self.emergencyPlan = None
 
-        if minReinvest is not None:
-            dfiBalance = utils.get_balance(address, "DFI")
-            if dfiBalance > minReinvest:
+        if self.minReinvest is not None and emergencyInput is None:
+            dfiBalance = snapshot.account(self.address).get("DFI", 0)
+            if strategy.should_reinvest(dfiBalance, self.minReinvest):
                 tokensToReinvest = dfiBalance
-                if mainCollateralAsset != "DFI":
+                if self.mainCollateralAsset != "DFI":
                     data = {
-                        "from": address,
+                        "from": self.address,
                         "tokenFrom": "DFI",
-                        "amountFrom": "%.8f" % dfiBalance,
-                        "to": address,
-                        "tokenTo": mainCollateralAsset
+                        "amountFrom": Amount.of(dfiBalance, "DFI").number(),
+                        "to": self.address,
+                        "tokenTo": self.mainCollateralAsset
                     }
-                    txId = rpc("compositeswap", [data, utils.get_tx_input(address)])
-                    logger.info(
-                        f"{lastheight} - swaping rewards {dfiBalance}@DFI to {mainCollateralAsset} in {txId}")
+                    [expectedOut, path] = Router(snapshot).quote("DFI", self.mainCollateralAsset, dfiBalance)
+                    # compositeswap takes no path, defid picks the route. the local path is only an estimate,
+                    # the price of the node's own route is the maxPrice of the swap
+                    nodeOut, nodeRoute = utils.test_compositeswap(data)
+                    if nodeOut is not None and nodeOut.sats > 0:
+                        maxPrice = float(data["amountFrom"]) / float(nodeOut) * (1 + reinvestSlippage)
+                        data["maxPrice"] = Amount.of(maxPrice, "DFI").number()  # at most 8 decimals
+                        if float(nodeOut) < expectedOut * (1 - reinvestSlippage):
+                            self.logger.warning(
+                                f"{lastheight} - node routes the rewards via {' > '.join(nodeRoute)} to {nodeOut}, "
+                                f"local route via {' > '.join(symbol for symbol, tokenIn in path)} would get "
+                                f"{round(expectedOut, 4)}@{self.mainCollateralAsset}")
+                    txId = self.sendTx("compositeswap", [data])
+                    self.logger.info(
+                        f"{lastheight} - swaping rewards {dfiBalance}@DFI to {self.mainCollateralAsset} in {txId}, "
+                        f"expecting {round(expectedOut, 4)}@{self.mainCollateralAsset}"
+                        + (f" (node: {nodeOut})" if nodeOut is not None else ""))
                     waitForTx(txId)
-                    tokensToReinvest = utils.get_balance(address, mainCollateralAsset)
+                    tokensToReinvest = utils.get_balance(self.address, self.mainCollateralAsset)
 
-                txId = rpc("deposittovault", [vaultId, address, "%.8f@%s" % (tokensToReinvest, mainCollateralAsset),
-                                              utils.get_tx_input(address)])
-                logger.info(f"{lastheight} - reinvesting rewards {tokensToReinvest}@{mainCollateralAsset} in {txId}")
+                txId = self.sendTx("deposittovault", [self.vaultId, self.address,
+                                                      str(Amount.of(tokensToReinvest, self.mainCollateralAsset))])
+                self.logger.info(
+                    f"{lastheight} - reinvesting rewards {tokensToReinvest}@{self.mainCollateralAsset} in {txId}")
                 waitForTx(txId)
-                logger.info("done")
-                utils.send_telegram(f"reinvested {tokensToReinvest} {mainCollateralAsset}")
-                vault = rpc("getvault", [vaultId, True])
-                collateralRatio = min(vault['collateralRatio'], vault['nextCollateralRatio'])
-
-        if 0 < collateralRatio < minCollateralRatio:
+                self.logger.info("done")
+                self.send_telegram(f"reinvested {tokensToReinvest} {self.mainCollateralAsset}")
+                self.snapshot = utils.chain_snapshot(self.vaultId, self.address)
+                vault = self.snapshot.vault(self.vaultId)
+
+        [action, usdAmount] = strategy.decide(vault['collateralRatio'], vault['nextCollateralRatio'],
+                                              vault['collateralValue'], vault['loanValue'],
+                                              self.minCollateralRatio, self.maxCollateralRatio, self.targetCollateral)
+        if action == strategy.REDUCE:
             # reduce exposure
 
-            account = utils.get_account(address)
+            account = self.snapshot.account(self.address)
 
             openLoans = []
             for loan in vault["loanAmounts"]:
-                t = loan.split("@")
-                openLoans.append(t[1])
-
-            if lmPair not in account or assetA not in openLoans or (not isSingleMint and assetB not in openLoans):
-                    msg = "ERROR: can't withdraw from pool, no tokens left or no loans left"
-                    logger.error(msg)
-                    utils.send_telegram(msg)
-                    sleep(10)  # to not flood
+                openLoans.append(Amount.parse(loan).token)
+
+            if self.lmPair not in account or self.assetA not in openLoans or (
+                    not isSingleMint and self.assetB not in openLoans):
+                msg = "ERROR: can't withdraw from pool, no tokens left or no loans left"
+                self.logger.error(msg)
+                self.send_telegram(msg)
+                sleep(10)  # to not flood
             else:
-                # not calculating nextLoanValue and nextCollateralValue here, assuming that coll will move more -> approx nextColl via nextRatio and current loan
-
-                neededrepay = max(vault['loanValue'] - (vault['collateralValue'] / targetCollateral),
-                                  vault['loanValue'] - (vault['loanValue'] * vault['nextCollateralRatio'] / (
-                                              100 * targetCollateral)))
-                actualRepay = max(neededrepay, vault['loanValue'] * 0.01)
-                logger.info(
+                self.logger.info(
                     f"need to reduce exposure. "
                     f"ratios: {vault['collateralRatio']} ({vault['nextCollateralRatio']}) "
-                    f"need to repay {neededrepay} will do {actualRepay} USD. current values: {vault['loanValue']} vs {vault['collateralValue']} ")
+                    f"will repay {usdAmount} USD. current values: {vault['loanValue']} vs {vault['collateralValue']} ")
 
-                pool = utils.get_pool(lmPair)
+                pool = self.snapshot.pool(self.lmPair)
                 if isSingleMint:
-                    reduceExposureSingleMint(actualRepay, targetCollateral, pool, account)
+                    self.reduceExposureSingleMint(usdAmount, self.targetCollateral, pool, account, emergencyInput)
                 else:
-                    reduceExposureDoubleMint(actualRepay, pool, account)
+                    self.reduceExposureDoubleMint(usdAmount, pool, account, emergencyInput)
+                emergencyInput = None
 
-        elif maxCollateralRatio > 0 and (collateralRatio < 0 or collateralRatio > maxCollateralRatio) and vault[
-            'collateralValue'] > 10:
+        elif action == strategy.INCREASE:
             # increase exposure
-            pool = utils.get_pool(lmPair)
-            # not calculating nextLoanValue and nextCollateralValue here, assuming that coll will move more -> approx nextColl via nextRatio and current loan
-
-            additionalLoan = (vault['collateralValue'] / targetCollateral) - vault['loanValue']
-            if vault['nextCollateralRatio'] > 0:
-                additionalLoan = min(additionalLoan,
-                                     (vault['loanValue'] * vault['nextCollateralRatio'] / (100 * targetCollateral)) -
-                                     vault['loanValue'])
+            pool = self.snapshot.pool(self.lmPair)
             if isSingleMint:
-                increaseExposureSingleMint(additionalLoan, targetCollateral, pool)
+                self.increaseExposureSingleMint(usdAmount, self.targetCollateral, pool)
             else:
-                increaseExposureDoubleMint(additionalLoan, pool)
-
-
-        sleep(1)
-
-except Exception as e:
-    logger.error("uncaught exception: " + str(e) + "\n" + traceback.format_exc())
-    utils.send_telegram("LMVault: Exception in script!")
-    raise e
+                self.increaseExposureDoubleMint(usdAmount, pool)
+        if emergencyInput is not None:
+            utils.utxo_manager(self.address).release(emergencyInput)
+            if action != strategy.REDUCE:
+                self.logger.info(f"{lastheight} price block passed without the need to reduce")
+        if action == strategy.NOTHING and self.prepareEmergencyBlocks > 0:
+            self.prepareEmergency(self.snapshot, vault)
+        else:
+            self.dropEmergencyPlan()
+        return True
+
+    def run(self):
+        try:
+            # initial log of settings
+            self.logSettings()
+            while True:
+                # all reads of the iteration come from the snapshot of this block
+                snapshot = utils.chain_snapshot(self.vaultId, self.address)
+                if not self.processBlock(snapshot):
+                    break
+                # decisions only change with a new block, so sleep until it arrives
+                utils.waitForNewBlock(snapshot.height)
+
+        except Exception as e:
+            self.logger.error("uncaught exception: " + str(e) + "\n" + traceback.format_exc())
+            self.send_telegram("LMVault: Exception in script!")
+            raise e
+
+
+if __name__ == "__main__":
+    settingsPath = sys.argv[1] if len(sys.argv) > 1 else None
+    if settingsPath is None:
+        print("You need to provide a settings path!")
+        sys.exit(1)
+    vaultMaxi = VaultMaxi(settingsPath)
+    # single vault: errors of rpc calls go to the telegram of this vault
+    utils.LOGGER = vaultMaxi.logger
+    utils.logId = vaultMaxi.logId
+    utils.TELEGRAM_TOKEN = vaultMaxi.telegramToken
+    utils.TELEGRAM_CHANNEL = vaultMaxi.telegramChannel
+    utils.TELEGRAM_LOG_CHANNEL = vaultMaxi.telegramLogChannel
+    rpc_metrics.start(vaultMaxi.metricsSettings, vaultMaxi.logger)
+    vaultMaxi.run()
@@ -0,0 +1,201 @@
+import asyncio
+import json
+import time
+
+import aiohttp
+
+import rpc_metrics
+import utils
+
+'''
+asyncio versions of the rpc helpers in utils. uses the same node settings (utils.NODE_URL etc.)
+and one pooled aiohttp session, so independent reads can run in parallel:
+
+    vault, account, pools = await gather_reads(vaultId, address, ["TSLA-DUSD"])
+    tx, block = await asyncio.gather(rpc("gettransaction", [txId]), rpc("getblock", [blockHash]))
+
+every call has a timeout and can be cancelled like any other asyncio task.
+state is shared with the sync code of utils, so both can run in one process: utxos come from the same
+UtxoManager (same reservations), vault/account/pool reads from the same per-block ChainSnapshot, confirmations
+from the same TxTracker and waitForNewBlock uses the same long-poll fallback. those helpers run in a worker thread.
+'''
+
+MAX_CONNECTIONS = 10
+
+_session = None
+
+
+def rpc_session():
+    global _session
+    if _session is None or _session.closed:
+        _session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=MAX_CONNECTIONS),
+                                         auth=aiohttp.BasicAuth(utils.NODE_USER, utils.NODE_PASSWORD))
+    return _session
+
+
+async def close():
+    global _session
+    if _session is not None:
+        await _session.close()
+        _session = None
+
+
+async def _post(method, data, timeout):
+    if timeout is None:
+        timeout = utils.RPC_TIMEOUT
+    caller = rpc_metrics.caller()
+    start = time.perf_counter()
+    try:
+        async with rpc_session().post(utils.NODE_URL, data=data,
+                                      timeout=aiohttp.ClientTimeout(total=timeout)) as response:
+            text = await response.text()
+    except Exception:
+        rpc_metrics.metrics.record(method, caller, time.perf_counter() - start, len(data), 0, True)
+        raise
+    rpc_metrics.metrics.record(method, caller, time.perf_counter() - start, len(data), len(text),
+                               response.status >= 300)
+    return response.status, json.loads(text)
+
+
+async def rpc(method, params=None, silentErrors=False, timeout=None):
+    if params is None:
+        params = []
+    response = await rpc_response(method, params, timeout)
+    if response.get('error') is not None and not silentErrors:
+        await _log_rpc_error(method, params, response['error'])
+    return response['result']
+
+
+async def rpc_response(method, params=None, timeout=None):
+    """
+    same as utils.rpc_response
+    """
+    data = json.dumps({
+        "jsonrpc": "2.0",
+        "id": "meBe",
+        "method": method,
+        "params": params if params is not None else []
+    })
+    status, response = await _post(method, data, timeout)
+    return response
+
+
+async def rpc_batch(calls, silentErrors=False, timeout=None):
+    """
+    same as utils.rpc_batch
+    """
+    if len(calls) == 0:
+        return []
+    requestData = []
+    for idx, call in enumerate(calls):
+        requestData.append({
+            "jsonrpc": "2.0",
+            "id": idx,
+            "method": call[0],
+            "params": call[1] if len(call) > 1 and call[1] is not None else []
+        })
+    rpc_metrics.metrics.record_batched([call[0] for call in calls], rpc_metrics.caller())
+    status, responses = await _post("batch", json.dumps(requestData), timeout)
+    if not isinstance(responses, list):
+        if not silentErrors:
+            await _log_rpc_error("batch", [call[0] for call in calls], responses['error'])
+        return [None] * len(calls)
+    results = [None] * len(calls)
+    for response in responses:
+        idx = response['id']
+        if response.get('error') is not None:
+            if not silentErrors:
+                await _log_rpc_error(requestData[idx]['method'], requestData[idx]['params'], response['error'])
+        else:
+            results[idx] = response['result']
+    return results
+
+
+async def _log_rpc_error(method, params, error):
+    message = f"--Error in RPC Call {method} with {str(params)}:\n{error['message']}"
+    if utils.LOGGER:
+        utils.LOGGER.error(message)
+    else:
+        print("\r" + message)
+    await send_telegram(f"Error in RPC Call {method}: {error['message']}")
+
+
+async def send_telegram(message, token=None, channel=None, messageId=None):
+    # enqueues in the outbox of utils, returns right away
+    utils.send_telegram(message, token, channel, messageId)
+
+
+def _in_thread(function, *args):
+    # the shared helpers of utils block on rpc, run them next to the event loop
+    return asyncio.get_running_loop().run_in_executor(None, function, *args)
+
+
+async def get_account(address):
+    return await _in_thread(utils.get_account, address)
+
+
+async def get_balance(address, token):
+    balances = await get_account(address)
+    if token in balances:
+        return balances[token]
+    return 0
+
+
+async def get_pool(pool):
+    return await _in_thread(utils.get_pool, pool)
+
+
+async def get_tx_input(address, minamount=0.001, count=1, minconf=1):
+    # reserved in the UtxoManager of the address, like the inputs of the sync code
+    return await _in_thread(utils.get_tx_input, address, minamount, count, minconf)
+
+
+async def waitForNewBlock(lastHeight, longPollSeconds=20, maxPollSleep=5.0):
+    """
+    same as utils.waitForNewBlock: long-poll, polling getblockcount if the node doesn't support it or the call failed
+    """
+    pollSleep = 0.5
+    while True:
+        height = None
+        if utils._longPollSupported:
+            response = await rpc_response("waitforblockheight", [lastHeight + 1, longPollSeconds * 1000],
+                                          timeout=longPollSeconds + utils.RPC_TIMEOUT)
+            if response.get('result') is not None:
+                height = response['result']['height']
+            else:
+                utils.long_poll_failed(response.get('error'))
+        if height is None:
+            await asyncio.sleep(pollSleep)
+            pollSleep = min(pollSleep * 2, maxPollSleep)
+            height = await rpc("getblockcount", silentErrors=True)
+        if height is not None and height > lastHeight:
+            utils.chainHeight = max(utils.chainHeight, height)
+            return height
+
+
+async def waitForTx(txId, timeoutBlocks=30):
+    """
+    waits block by block until the tx is mined (utils.txTracker decides). cancel the task to stop waiting
+    """
+    if txId is None:
+        return False
+    tracker = utils.txTracker
+    await _in_thread(tracker.watch, txId, None, timeoutBlocks)
+    try:
+        while txId in tracker.pending:
+            height = await waitForNewBlock(max(utils.chainHeight, tracker.checkedHeight))
+            await _in_thread(tracker.onNewBlock, height)
+        with tracker.lock:
+            return tracker.results.pop(txId, False)
+    finally:
+        with tracker.lock:
+            tracker.pending.pop(txId, None)  # cancelled: stop tracking it
+
+
+async def gather_reads(vaultId, address, pairs=()):
+    """
+    vault, account and pools of the current block, from the shared snapshot (one batch for all of them)
+    :return: [vault, account, list of pools]
+    """
+    snapshot = await _in_thread(utils.chain_snapshot, vaultId, address)
+    return [snapshot.vault(vaultId), dict(snapshot.account(address)), [snapshot.pool(pair) for pair in pairs]]
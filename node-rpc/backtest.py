@@ -0,0 +1,264 @@
+import json
+import math
+import sys
+import time
+
+import numpy as np
+
+import strategy
+
+'''
+replays per-block pool reserves and oracle prices through the decision core (strategy.py) to evaluate settings offline.
+
+the history has one row per block with the columns in COLUMNS:
+  reserveA, reserveB, totalLiquidity: the lmPair pool
+  priceA, nextPriceA: active and next oracle price of assetA (1 for DUSD)
+  (assetB is DUSD, or DFI for DUSD-DFI)
+  priceDFI, nextPriceDFI: active and next oracle price of DFI (collateral and rewards)
+  rewardPerBlock: DFI rewards of the whole pool per block
+load it from a .npz or .csv file with History.load or generate one with synthetic_history.
+
+between two actions the vault does not change (besides rewards and interest), so the ratios of a whole window of blocks
+are calculated at once with numpy and only the blocks where the strategy acts are processed one by one.
+this is what makes it fast, a year of blocks takes well below a second.
+
+simplifications: the own trades don't move the pool (history is the pool without us),
+all txs of an action land in the block of the decision, collateral is only the mainCollateralAsset
+and the loan interest is added linearly between actions.
+
+usage: python backtest.py settings.json [history.npz|history.csv]  (synthetic history of 1 year if no file given)
+'''
+
+COLUMNS = ["height", "reserveA", "reserveB", "totalLiquidity", "priceA", "nextPriceA", "priceDFI", "nextPriceDFI",
+           "rewardPerBlock"]
+
+BLOCKS_PER_YEAR = 365 * 24 * 3600 // 30
+PRICE_INTERVAL = 120  # blocks between oracle price updates
+
+
+class History:
+    def __init__(self, **columns):
+        for name in COLUMNS:
+            setattr(self, name, np.asarray(columns[name], dtype=np.float64))
+        self.height = self.height.astype(np.int64)
+
+    def __len__(self):
+        return len(self.height)
+
+    @staticmethod
+    def load(path):
+        if path.endswith(".npz"):
+            data = np.load(path)
+            return History(**{name: data[name] for name in COLUMNS})
+        data = np.genfromtxt(path, delimiter=",", names=True)
+        return History(**{name: data[name] for name in COLUMNS})
+
+    def save(self, path):
+        np.savez(path, **{name: getattr(self, name) for name in COLUMNS})
+
+
+def synthetic_history(blocks=BLOCKS_PER_YEAR, seed=42, priceA=1000.0, priceDFI=2.5, volatility=0.0015,
+                      premium=0.2, poolLiquidity=5e6, rewardPerBlock=1.5, lmPair="TSLA-DUSD"):
+    """
+    random walk of assetA and DFI (per block volatility), oracle updates every PRICE_INTERVAL blocks,
+    the dex price of assetA in assetB with a premium that wanders around `premium` (0.2 = 20%)
+    """
+    rnd = np.random.default_rng(seed)
+    livePriceA = priceA * np.exp(np.cumsum(rnd.normal(0, volatility, blocks)))
+    livePriceDFI = priceDFI * np.exp(np.cumsum(rnd.normal(0, volatility, blocks)))
+    dexFactor = 1
+    if lmPair == "DUSD-DFI":
+        # DUSD has no oracle (always 1), the pool price is in DFI
+        livePriceA = np.ones(blocks)
+        dexFactor = 1 / livePriceDFI
+    # oracle takes the live price at the start of each interval, next price is the one of the next interval
+    intervalStart = (np.arange(blocks) // PRICE_INTERVAL) * PRICE_INTERVAL
+    nextStart = np.minimum(intervalStart + PRICE_INTERVAL, blocks - 1)
+    dexPrice = livePriceA * dexFactor * (1 + premium + np.cumsum(rnd.normal(0, volatility / 10, blocks)))
+    dexPrice = np.maximum(dexPrice, livePriceA * dexFactor * 0.5)
+    k = poolLiquidity * poolLiquidity
+    return History(height=np.arange(blocks), reserveA=np.sqrt(k / dexPrice), reserveB=np.sqrt(k * dexPrice),
+                   totalLiquidity=np.full(blocks, poolLiquidity),
+                   priceA=livePriceA[intervalStart], nextPriceA=livePriceA[nextStart],
+                   priceDFI=livePriceDFI[intervalStart], nextPriceDFI=livePriceDFI[nextStart],
+                   rewardPerBlock=np.full(blocks, rewardPerBlock))
+
+
+def run(history, settings, initialCollateral=1000.0, txFee=0.0002, swapFee=0.002, interestRate=0.0,
+        liquidationRatio=150, window=256):
+    """
+    :param settings: dict like settings.json (lmPair, minCollateralRatio, maxCollateralRatio, mainCollateralAsset, minReinvest)
+    :param initialCollateral: amount of mainCollateralAsset in the vault, no loans at start
+    :param txFee: DFI per transaction
+    :param swapFee: fee when swapping rewards into a mainCollateralAsset other than DFI
+    :param interestRate: yearly loan interest (0.05 for 5%)
+    :return: dict with the results
+    """
+    lmPair = settings['lmPair']
+    assetB = lmPair.split("-")[1]
+    minRatio = settings['minCollateralRatio']
+    maxRatio = settings['maxCollateralRatio']
+    mainCollateralAsset = settings.get('mainCollateralAsset', "DFI")
+    if mainCollateralAsset != "DFI" and assetB != mainCollateralAsset:
+        mainCollateralAsset = "DFI"
+    minReinvest = settings.get('minReinvest')
+    targetCollateral = strategy.target_collateral(minRatio, maxRatio)
+    singleMint = strategy.is_single_mint(mainCollateralAsset, lmPair)
+
+    n = len(history)
+    reserveA, reserveB, totalLiquidity = history.reserveA, history.reserveB, history.totalLiquidity
+    priceA, nextPriceA = history.priceA, history.nextPriceA
+    if mainCollateralAsset == "DFI":
+        collPrice, nextCollPrice = history.priceDFI, history.nextPriceDFI
+    else:
+        collPrice = nextCollPrice = np.full(n, strategy.DUSD_COLLATERAL_FACTOR)
+    # in single mint assetB goes into the vault as collateral, in double mint it is a DUSD loan
+    priceB = history.priceDFI if assetB == "DFI" else np.ones(n)
+    rewardShare = history.rewardPerBlock / totalLiquidity
+
+    collateral = initialCollateral
+    loanA = loanB = lp = 0.0
+    wallet = 0.0  # unclaimed rewards in DFI
+    rewards = rewardsUSD = interest = feesUSD = 0.0
+    reduces = increases = reinvests = txs = 0
+    minSeen = math.inf
+    minSeenHeight = None
+    liquidated = None
+    lastInterest = 0
+    size = window
+
+    start = time.perf_counter()
+    i = 0
+    while i < n:
+        end = min(n, i + size)
+        s = slice(i, end)
+        interestFactor = 1 + interestRate * (np.arange(i, end) - lastInterest) / BLOCKS_PER_YEAR
+        loanValue = (loanA * priceA[s] + loanB) * interestFactor
+        nextLoanValue = (loanA * nextPriceA[s] + loanB) * interestFactor
+        collValue = collateral * collPrice[s]
+        hasLoan = loanValue > 0
+        safeLoan = np.where(hasLoan, loanValue, 1)
+        ratio = np.where(hasLoan, collValue / safeLoan * 100, -1)
+        nextRatio = np.where(hasLoan, collateral * nextCollPrice[s] / np.where(hasLoan, nextLoanValue, 1) * 100, -1)
+        checked = np.minimum(ratio, nextRatio)
+        event = (checked > 0) & (checked < minRatio)
+        if maxRatio > 0:
+            event |= ((checked < 0) | (checked > maxRatio)) & (collValue > 10)
+        event |= hasLoan & (ratio < liquidationRatio)
+        walletAt = wallet + np.cumsum(rewardShare[s] * lp)
+        if minReinvest is not None:
+            event |= walletAt > minReinvest
+        hits = np.flatnonzero(event)
+        last = end - i if len(hits) == 0 else hits[0] + 1  # blocks of the window that are processed now
+        if hasLoan[0]:
+            lowest = int(np.argmin(ratio[:last]))
+            if ratio[lowest] < minSeen:
+                minSeen = ratio[lowest]
+                minSeenHeight = int(history.height[i + lowest])
+        rewards += walletAt[last - 1] - wallet
+        rewardsUSD += lp * np.dot(rewardShare[i:i + last], history.priceDFI[i:i + last])
+        wallet = walletAt[last - 1]
+        if len(hits) == 0:
+            i = end
+            size = min(size * 2, 65536)
+            continue
+
+        # process the block of the event like the bot would
+        j = i + hits[0]
+        k = hits[0]
+        size = window
+        txsBefore = txs
+        factor = interestFactor[k]
+        interest += (loanA * priceA[j] + loanB) * (factor - 1)
+        loanA *= factor
+        loanB *= factor
+        lastInterest = j
+        if hasLoan[k] and ratio[k] < liquidationRatio:
+            liquidated = int(history.height[j])
+            break
+        if strategy.should_reinvest(wallet, minReinvest):
+            if mainCollateralAsset == "DFI":
+                collateral += wallet
+            else:
+                collateral += wallet * history.priceDFI[j] * (1 - swapFee)
+                txs += 1
+            wallet = 0
+            reinvests += 1
+            txs += 1
+        collValue = collateral * collPrice[j]
+        loanValue = loanA * priceA[j] + loanB
+        if loanValue > 0:
+            currentRatio = collValue / loanValue * 100
+            currentNext = collateral * nextCollPrice[j] / (loanA * nextPriceA[j] + loanB) * 100
+        else:
+            currentRatio = currentNext = -1
+        [action, usdAmount] = strategy.decide(currentRatio, currentNext, collValue, loanValue,
+                                              minRatio, maxRatio, targetCollateral)
+        rA, rB, total = reserveA[j], reserveB[j], totalLiquidity[j]
+        if action == strategy.REDUCE and lp > 0:
+            if singleMint:
+                [removeTokens, gotA, gotB] = strategy.reduce_single_mint(usdAmount, targetCollateral, priceA[j],
+                                                                         collPrice[j], rA, rB, total, lp)
+                loanA -= min(gotA, loanA)
+                collateral += gotB
+                txs += 3
+            else:
+                [removeTokens, neededA, neededB] = strategy.reduce_double_mint(usdAmount, priceA[j], rA, rB, total, lp)
+                loanA -= min(neededA, removeTokens * rA / total, loanA)
+                loanB -= min(neededB, removeTokens * rB / total, loanB)
+                txs += 2
+            lp -= removeTokens
+            reduces += 1
+        elif action == strategy.INCREASE and usdAmount > 0:
+            if singleMint:
+                [amountA, amountB] = strategy.increase_single_mint(usdAmount, targetCollateral, priceA[j],
+                                                                   collPrice[j], rA, rB)
+                amountB = min(amountB, collateral)
+                collateral -= amountB
+                txs += 3
+            else:
+                [amountA, amountB] = strategy.increase_double_mint(usdAmount, priceA[j], rA, rB)
+                loanB += amountB
+                txs += 2
+            loanA += amountA
+            lp += min(amountA * total / rA, amountB * total / rB)
+            increases += 1
+        feesUSD += (txs - txsBefore) * txFee * history.priceDFI[j]
+        i = j + 1
+    duration = time.perf_counter() - start
+
+    processed = n if liquidated is None else int(liquidated - history.height[0]) + 1
+    endIdx = processed - 1
+    lpValue = lp / totalLiquidity[endIdx] * (reserveA[endIdx] * priceA[endIdx] + reserveB[endIdx] * priceB[endIdx])
+    netValue = (collateral * collPrice[endIdx] + lpValue + wallet * history.priceDFI[endIdx]
+                - loanA * priceA[endIdx] - loanB) if liquidated is None else 0
+    return {
+        "blocks": processed,
+        "blocksPerSecond": processed / duration if duration > 0 else math.inf,
+        "rewardsDFI": rewards,
+        "rewardsUSD": rewardsUSD,
+        "reduces": reduces,
+        "increases": increases,
+        "reinvests": reinvests,
+        "txs": txs,
+        "feesDFI": txs * txFee,
+        "feesUSD": feesUSD,
+        "interestUSD": interest,
+        "minCollateralRatio": minSeen if minSeenHeight is not None else None,
+        "minCollateralRatioHeight": minSeenHeight,
+        "liquidatedAt": liquidated,
+        "startValueUSD": initialCollateral * collPrice[0],
+        "endValueUSD": netValue - feesUSD,
+    }
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print("You need to provide a settings path!")
+        sys.exit(1)
+    with open(sys.argv[1]) as f:
+        settings = json.load(f)
+    history = History.load(sys.argv[2]) if len(sys.argv) > 2 else synthetic_history()
+    result = run(history, settings)
+    for key, value in result.items():
+        print(f"{key}: {value}")
@@ -0,0 +1,196 @@
+import utils
+from tokenamount import Amount, COIN, to_sats
+
+'''
+orders and execution schedules for trade_bot. all orders of the bot are stepped once per block on the same
+snapshot and router, swaps of one order move the virtual reserves the next order sees.
+
+schedules (the "schedule" entry of an order, default "asap"):
+  asap:          as much as stays below maxPrice every block
+  twap:          spreads the order evenly over "blocks" blocks, catches up if it fell behind
+  participation: every block "rate" (0.1 = 10%) of the volume that went through the first pool of the route
+                 the order trades through in the last block (reserve change of the source token without our own swaps)
+  opportunistic: only trades while the premium of "premiumPair" (ChainData.premium_for_pair) is below
+                 "premiumBelow" or above "premiumAbove"
+maxPrice always applies on top of the schedule.
+'''
+
+# (poolSymbol, tokenIn) -> amount our own confirmed swaps put into the pool in the last block (first hop only).
+# filled by the tx tracker callbacks, cleared by end_block after all orders did their step
+ownFlow = {}
+
+
+def end_block():
+    ownFlow.clear()
+
+
+class Schedule:
+    def budget(self, order, snapshot, chainData, reserves):
+        """
+        :param reserves: virtual reserves of the block (see Order.step)
+        :return: max amount the order may send in this block (without the amount that is already pending)
+        """
+        return order.openAmount
+
+
+class TwapSchedule(Schedule):
+    def __init__(self, blocks):
+        self.blocks = max(1, blocks)
+        self.startHeight = None
+
+    def budget(self, order, snapshot, chainData, reserves):
+        if self.startHeight is None:
+            self.startHeight = snapshot.height
+        elapsed = snapshot.height - self.startHeight + 1
+        target = order.totalAmount * min(1, elapsed / self.blocks)
+        return max(0, target - order.sentAmount())
+
+
+class ParticipationSchedule(Schedule):
+    def __init__(self, rate):
+        self.rate = rate
+        self.lastReserves = {}  # (poolSymbol, tokenIn) -> reserve of tokenIn in the last block
+
+    def budget(self, order, snapshot, chainData, reserves):
+        # reserves of every first hop, the route max_amount picks can change from block to block
+        current = {}
+        for symbol, tokenIn in {path[0] for path in order.router.paths(order.sourceToken, order.targetToken)}:
+            pool = snapshot.pool(symbol)
+            current[(symbol, tokenIn)] = pool['reserveA'] if symbol.split("-")[0] == tokenIn else pool['reserveB']
+        path = order.router.max_amount(order.sourceToken, order.targetToken, order.maxPrice, reserves)[1]
+        budget = 0
+        if path is not None and path[0] in self.lastReserves:
+            # own swaps of the last block are part of the change, only count the others
+            flow = abs((current[path[0]] - self.lastReserves[path[0]]) - ownFlow.get(path[0], 0))
+            budget = self.rate * flow
+        self.lastReserves = current
+        return budget
+
+
+class OpportunisticSchedule(Schedule):
+    def __init__(self, premiumPair, premiumBelow=None, premiumAbove=None):
+        self.premiumPair = premiumPair
+        self.premiumBelow = premiumBelow
+        self.premiumAbove = premiumAbove
+
+    def budget(self, order, snapshot, chainData, reserves):
+        premium = chainData.premium_for_pair(self.premiumPair)
+        if (self.premiumBelow is not None and premium < self.premiumBelow) or \
+                (self.premiumAbove is not None and premium > self.premiumAbove):
+            return order.openAmount
+        return 0
+
+
+def schedule_from_settings(settings):
+    kind = settings.get("schedule", "asap")
+    if kind == "twap":
+        return TwapSchedule(settings["blocks"])
+    if kind == "participation":
+        return ParticipationSchedule(settings["rate"])
+    if kind == "opportunistic":
+        return OpportunisticSchedule(settings["premiumPair"], settings.get("premiumBelow"),
+                                     settings.get("premiumAbove"))
+    if kind == "asap":
+        return Schedule()
+    raise ValueError(f"unknown schedule {kind}")
+
+
+class Order:
+    def __init__(self, settings, address, router, logger, minSwap=0.001):
+        self.name = settings.get("name", settings["sourceToken"] + ">" + settings["targetToken"])
+        self.address = settings.get("address", address)
+        self.sourceToken = settings["sourceToken"]
+        self.targetToken = settings["targetToken"]
+        self.totalAmount = settings["totalAmount"]
+        self.maxPrice = settings["maxPrice"]
+        self.batchSize = settings.get("batchSize")  # max amount per swap
+        self.minSwap = settings.get("minSwap", minSwap)
+        self.schedule = schedule_from_settings(settings)
+        self.router = router
+        self.logger = logger
+        self.openSats = to_sats(self.totalAmount)  # not sent yet (or failed), in satoshis so nothing drifts
+        self.pending = {}  # txId -> amount in satoshis
+        self.firstHop = {}  # txId -> (poolSymbol, tokenIn)
+
+    @property
+    def openAmount(self):
+        return self.openSats / COIN
+
+    @openAmount.setter
+    def openAmount(self, value):
+        self.openSats = to_sats(value)
+
+    def sentAmount(self):
+        return self.totalAmount - self.openAmount
+
+    def pendingAmount(self):
+        return sum(self.pending.values()) / COIN
+
+    def done(self):
+        return self.openAmount < self.minSwap and len(self.pending) == 0
+
+    def onSwapResult(self, txId, confirmed):
+        amount = Amount(self.pending.pop(txId), self.sourceToken)
+        firstHop = self.firstHop.pop(txId)
+        if confirmed:
+            ownFlow[firstHop] = ownFlow.get(firstHop, 0) + float(amount)
+            self.logger.info(f"{utils.chainHeight} {self.name}: swap of {amount} done in {txId}, "
+                             f"{Amount(self.openSats + sum(self.pending.values()), self.sourceToken)} to do")
+            utils.send_telegram(f"tradebot {self.name} successfully swapped {amount.number()} {self.sourceToken}")
+        else:
+            utils.rpc("removeprunedfunds", [txId], silentErrors=True)
+            self.openSats += amount.sats
+            self.logger.info(f"{utils.chainHeight} {self.name}: swap of {amount} failed")
+
+    def step(self, snapshot, chainData, reserves, balances):
+        """
+        sends the swaps of this block
+        :param reserves: virtual reserves of the block, shared by all orders
+        :param balances: free balance per (address, token) in this block, shared by all orders
+        """
+        budget = min(self.openAmount, self.schedule.budget(self, snapshot, chainData, reserves))
+        lastTx = None
+        while budget >= self.minSwap:
+            [maxAmount, path] = self.router.max_amount(self.sourceToken, self.targetToken, self.maxPrice, reserves)
+            if path is None:
+                break
+            balance = balances.get((self.address, self.sourceToken), 0)
+            amount = Amount.of(min(maxAmount, budget, balance, self.batchSize or maxAmount), self.sourceToken)
+            # no more than the chain accepts for maxPrice after its integer rounding
+            amount.sats = self.router.fit_max_price(path, amount.sats, self.maxPrice, reserves)
+            if float(amount) < self.minSwap:
+                break
+            expectedOut = Amount(self.router.quote_path_sats(path, amount.sats, reserves), self.targetToken)
+            data = {
+                "from": self.address,
+                "tokenFrom": self.sourceToken,
+                "amountFrom": amount.number(),
+                "to": self.address,
+                "tokenTo": self.targetToken
+            }
+            # compositeswap takes no path, defid routes it itself. path is only our estimate: check the route of
+            # the node against maxPrice too (it doesn't see our swaps of this block that are still pending)
+            nodeOut, nodeRoute = utils.test_compositeswap(data)
+            if nodeOut is not None and (nodeOut.sats <= 0
+                                        or amount.sats * COIN // nodeOut.sats > to_sats(self.maxPrice)):
+                self.logger.warning(f"{snapshot.height} {self.name}: the node routes {amount} via "
+                                    f"{' > '.join(nodeRoute)} to {nodeOut}, above maxPrice. not sending")
+                break
+            data["maxPrice"] = self.maxPrice
+            txInput = utils.get_tx_input(self.address)
+            if len(txInput) == 0 and lastTx is not None:
+                txInput = utils.get_chained_tx_input(lastTx, self.address)
+            tx = utils.tx_sent(self.address, txInput, utils.rpc("compositeswap", [data, txInput], silentErrors=True))
+            if tx is None:
+                break
+            self.router.quote_path(path, float(amount), reserves, apply=True)
+            self.logger.info(f"{snapshot.height} {self.name}: sent swap of {amount}, expecting {expectedOut} via "
+                             f"{' > '.join(symbol for symbol, tokenIn in path)}"
+                             + (f" (node: {nodeOut} via {' > '.join(nodeRoute)})" if nodeOut is not None else ""))
+            self.pending[tx] = amount.sats
+            self.firstHop[tx] = path[0]
+            self.openSats -= amount.sats
+            budget -= float(amount)
+            balances[(self.address, self.sourceToken)] = balance - float(amount)
+            lastTx = tx
+            utils.txTracker.watch(tx, self.onSwapResult)
@@ -0,0 +1,133 @@
+import json
+import os
+import threading
+
+'''
+append-only journal of the multi-tx operations of the vault maxi (remove liquidity -> payback, loan -> add liquidity),
+so a restart knows where it stopped. one json object per line, every record is fsync'd before the next rpc is sent:
+
+  {"type": "begin", "plan": 3, "kind": "reduceDoubleMint", "params": {...}, "height": 1234}
+  {"type": "sent", "plan": 3, "step": "removepoolliquidity", "txId": "..."}
+  {"type": "end", "plan": 3, "result": "done"}                  (or "aborted", "rolledBack")
+  {"type": "state", "values": {"lastBlockSettingsLogged": 1200}} (merged, last value wins)
+
+a torn last line from a crash is cut off on open. when the file gets long it is rewritten with only the
+open plans and the state (written to a temp file, fsync'd and renamed over the journal).
+'''
+
+COMPACT_RECORDS = 1000
+
+
+class Journal:
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.plans = {}  # open plans: id -> {"id", "kind", "params", "height", "steps": [[step, txId], ...]}
+        self.state = {}
+        self.nextId = 1
+        self.records = 0
+        self._load()
+        self.file = open(self.path, "a")
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            return
+        good = 0
+        with open(self.path, "rb") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    break  # torn write, everything after it is lost anyway
+                if not line.endswith(b"\n"):
+                    break
+                self._apply(record)
+                good += len(line)
+                self.records += 1
+        if good < os.path.getsize(self.path):
+            with open(self.path, "r+b") as f:
+                f.truncate(good)
+                os.fsync(f.fileno())
+
+    def _apply(self, record):
+        kind = record['type']
+        if kind == "begin":
+            self.plans[record['plan']] = {"id": record['plan'], "kind": record['kind'], "params": record['params'],
+                                          "height": record.get('height'), "steps": []}
+            self.nextId = max(self.nextId, record['plan'] + 1)
+        elif kind == "sent":
+            if record['plan'] in self.plans:
+                self.plans[record['plan']]['steps'].append([record['step'], record['txId']])
+        elif kind == "end":
+            self.plans.pop(record['plan'], None)
+        elif kind == "state":
+            self.state.update(record['values'])
+
+    def _write(self, record):
+        self.file.write(json.dumps(record) + "\n")
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self._apply(record)
+        self.records += 1
+
+    def begin(self, kind, params, height=None):
+        """
+        :return: id of the new plan
+        """
+        with self.lock:
+            planId = self.nextId
+            self._write({"type": "begin", "plan": planId, "kind": kind, "params": params, "height": height})
+            return planId
+
+    def sent(self, planId, step, txId):
+        with self.lock:
+            self._write({"type": "sent", "plan": planId, "step": step, "txId": txId})
+
+    def end(self, planId, result="done"):
+        with self.lock:
+            self._write({"type": "end", "plan": planId, "result": result})
+            if self.records > COMPACT_RECORDS:
+                self._compact()
+
+    def set_state(self, **values):
+        with self.lock:
+            if any(self.state.get(key) != value for key, value in values.items()):
+                self._write({"type": "state", "values": values})
+
+    def open_plans(self):
+        with self.lock:
+            return [dict(plan, steps=list(plan['steps'])) for plan in sorted(self.plans.values(),
+                                                                               key=lambda p: p['id'])]
+
+    def compact(self):
+        with self.lock:
+            self._compact()
+
+    def _compact(self):
+        records = [{"type": "state", "values": self.state}] if len(self.state) > 0 else []
+        for plan in sorted(self.plans.values(), key=lambda p: p['id']):
+            records.append({"type": "begin", "plan": plan['id'], "kind": plan['kind'], "params": plan['params'],
+                            "height": plan['height']})
+            records += [{"type": "sent", "plan": plan['id'], "step": step, "txId": txId}
+                        for step, txId in plan['steps']]
+        tmpPath = self.path + ".tmp"
+        with open(tmpPath, "w") as f:
+            for record in records:
+                f.write(json.dumps(record) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        self.file.close()
+        os.replace(tmpPath, self.path)
+        if hasattr(os, "O_DIRECTORY"):
+            # the rename itself has to be durable too
+            directory = os.open(os.path.dirname(os.path.abspath(self.path)), os.O_DIRECTORY)
+            try:
+                os.fsync(directory)
+            finally:
+                os.close(directory)
+        self.file = open(self.path, "a")
+        self.records = len(records)
+
+    def close(self):
+        with self.lock:
+            self.file.close()
@@ -0,0 +1,340 @@
+import collections
+import json
+import threading
+import time
+from concurrent.futures import Future, wait, FIRST_COMPLETED
+
+import requests
+import requests.adapters
+
+'''
+several nodes behind utils.rpc. the first node (NODE_URL) is the wallet node: everything that needs the wallet
+(custom txs, listunspent, gettransaction, ...) goes there. reads of chain state go to the healthiest node:
+  - latency: recent round trips per node (and per method for the hedge delay)
+  - height lag: blocks behind the highest node seen (waitForNewBlock reports the new height, the others are
+    checked in the background right after)
+  - errors: connection errors, timeouts and "node is starting" responses. 3 in a row put the node on a cooldown
+reads only go to nodes that are at least at the height of the last snapshot (require_height), a node that lags
+behind the wallet node would answer with balances from before a tx that the wallet node already confirmed.
+the block hash and the accounts of a snapshot are always read from the wallet node.
+hedged reads: if the best node didn't answer within its p95 latency for that method, the same request goes to
+the second best node too and the first answer wins.
+writes are sent by the wallet node. the signed tx is then also sent to the other nodes (sendrawtransaction),
+so it reaches the network even if the peers of the wallet node are slow. the wallet node must not be replaced
+for writes: another node would sign with other inputs (or can't sign at all).
+
+in the settings: "NODE_URL" stays the wallet node, more nodes with
+  "BACKUP_NODES": ["http://127.0.0.1:8556/", {"url": "http://10.0.0.2:8555/", "user": "...", "password": "..."}]
+(plain urls use NODE_USER/NODE_PASSWORD)
+'''
+
+# chain state, the same on every synced node. getbestblockhash and getaccount are not in here: the snapshot
+# and the balances after a tx must come from the wallet node that confirmed it
+READ_METHODS = {"getblockcount", "getblockchaininfo", "getblockhash", "getblock",
+                "waitforblockheight", "getvault", "listvaults", "getloanscheme", "listloanschemes", "getloaninfo",
+                "listcollateraltokens", "listloantokens", "getpoolpair", "listpoolpairs",
+                "gettoken", "listtokens", "getfixedintervalprice", "listfixedintervalprices", "listprices",
+                "getprice", "listoracles", "getgov", "testpoolswap", "listauctions", "getnetworkinfo"}
+NO_HEDGE_METHODS = {"waitforblockheight", "listvaults"}  # long poll / heavy, a second request only adds load
+# create (and sign) a tx on the wallet node. the result is the txId
+WRITE_METHODS = {"sendrawtransaction", "compositeswap", "poolswap", "addpoolliquidity", "removepoolliquidity",
+                 "takeloan", "paybackloan", "deposittovault", "withdrawfromvault", "utxostoaccount",
+                 "accounttoaccount", "accounttoutxos", "sendtoaddress", "sendutxosfrom", "placeauctionbid"}
+HEIGHT_METHODS = {"getblockcount", "waitforblockheight"}
+STARTING_ERROR_CODES = {-28}  # loading block index, verifying blocks, ...
+
+SAMPLES = 200  # latencies kept per node and method
+MIN_SAMPLES = 20  # below that the default hedge delay is used
+DEFAULT_HEDGE_DELAY = 0.25  # seconds
+MIN_HEDGE_DELAY = 0.005
+ERROR_PENALTY = 1.0  # seconds of latency a 100% error rate is worth in the score
+LAG_PENALTY = 1.0  # seconds per block behind
+MAX_CONSECUTIVE_ERRORS = 3
+COOLDOWN = 5  # seconds, doubles with every failed retry up to MAX_COOLDOWN
+MAX_COOLDOWN = 120
+HEIGHT_CHECK_SECONDS = 30  # latest time to check the height of all nodes
+STUCK_SECONDS = 0.5  # a request open longer than that (and 4x the p95 of the node) counts as stuck
+STUCK_PENALTY = 10.0  # seconds per stuck request, a hanging node goes to the end of the list
+
+
+class NodeUnavailable(Exception):
+    pass
+
+
+class Node:
+    def __init__(self, url, user, password, connections=10):
+        """
+        :param connections: keep-alive connections kept open, should be at least the number of threads calling rpc
+        """
+        self.url = url
+        self.auth = (user, password)
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=connections)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.lock = threading.Lock()
+        self.latencies = collections.deque(maxlen=SAMPLES)
+        self.methodLatencies = {}  # method -> deque
+        self.errorRate = 0.0  # moving average of failed requests
+        self.consecutiveErrors = 0
+        self.cooldown = COOLDOWN
+        self.downUntil = 0
+        self.height = None
+        self.open = {}  # request key -> start of the requests that are still running
+
+    def post(self, method, data, timeout):
+        start = time.perf_counter()
+        key = object()
+        if method not in NO_HEDGE_METHODS:
+            with self.lock:
+                self.open[key] = start
+        try:
+            result = self.session.post(self.url, auth=self.auth, data=data, timeout=timeout)
+        except Exception as e:
+            self.record(method, time.perf_counter() - start, False)
+            raise NodeUnavailable(f"{self.url}: {e}")
+        finally:
+            with self.lock:
+                self.open.pop(key, None)
+        if result.status_code >= 500 and _starting(result):
+            self.record(method, time.perf_counter() - start, False)
+            raise NodeUnavailable(f"{self.url}: {result.json()['error']['message']}")
+        self.record(method, time.perf_counter() - start, True)
+        result.node = self
+        return result
+
+    def record(self, method, seconds, ok):
+        with self.lock:
+            self.errorRate = 0.9 * self.errorRate + (0 if ok else 0.1)
+            if ok:
+                self.consecutiveErrors = 0
+                self.cooldown = COOLDOWN
+                self.downUntil = 0
+                if method not in NO_HEDGE_METHODS:
+                    self.latencies.append(seconds)
+                    self.methodLatencies.setdefault(method, collections.deque(maxlen=SAMPLES)).append(seconds)
+            else:
+                self.consecutiveErrors += 1
+                if self.consecutiveErrors >= MAX_CONSECUTIVE_ERRORS:
+                    self.downUntil = time.time() + self.cooldown
+                    self.cooldown = min(MAX_COOLDOWN, self.cooldown * 2)
+
+    def available(self):
+        return self.downUntil <= time.time()
+
+    def quantile(self, q, method=None, minSamples=MIN_SAMPLES):
+        with self.lock:
+            samples = self.methodLatencies.get(method) if method is not None else None
+            if samples is None or len(samples) < minSamples:
+                samples = self.latencies
+            if len(samples) < minSamples:
+                return None
+            ordered = sorted(samples)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+    def score(self, bestHeight):
+        # expected seconds until a useful answer, lower is better
+        latency = self.quantile(0.5, minSamples=1)
+        lag = max(0, bestHeight - self.height) if bestHeight is not None and self.height is not None else 0
+        return (latency if latency is not None else DEFAULT_HEDGE_DELAY) + self.errorRate * ERROR_PENALTY \
+            + lag * LAG_PENALTY + self.stuck() * STUCK_PENALTY
+
+    def stuck(self):
+        p95 = self.quantile(0.95)
+        limit = time.perf_counter() - max(STUCK_SECONDS, 4 * p95 if p95 is not None else 0)
+        with self.lock:
+            return sum(1 for start in self.open.values() if start < limit)
+
+    def status(self, bestHeight):
+        lag = bestHeight - self.height if bestHeight is not None and self.height is not None else "?"
+        p50 = self.quantile(0.5, minSamples=1)
+        return (f"{self.url} {'up' if self.available() else 'down'} lag {lag} "
+                f"p50 {f'{p50 * 1000:.0f}ms' if p50 is not None else '?'} errors {self.errorRate:.0%}")
+
+
+def _starting(response):
+    try:
+        return response.json()['error']['code'] in STARTING_ERROR_CODES
+    except Exception:
+        return False
+
+
+class NodePool:
+    def __init__(self, nodes, logger=None, hedge=True):
+        """
+        :param nodes: list of Node, the first one is the wallet node
+        """
+        self.nodes = nodes
+        self.primary = nodes[0]
+        self.logger = logger
+        self.hedge = hedge
+        self.lock = threading.Lock()
+        self.bestHeight = None
+        self.minHeight = None  # reads only go to nodes at least at this height (the last snapshot of the wallet node)
+        self.lastHeightCheck = 0
+        self.checking = False
+
+    def ranked(self):
+        """
+        :return: available nodes for reads, best first (all nodes if none is available).
+                 with minHeight set only the wallet node and the nodes known to be at least that high
+        """
+        nodes = [node for node in self.nodes if node.available()] or list(self.nodes)
+        if self.minHeight is not None:
+            nodes = [node for node in nodes if node is self.primary
+                     or (node.height is not None and node.height >= self.minHeight)] or [self.primary]
+        return sorted(nodes, key=lambda node: node.score(self.bestHeight))
+
+    def require_height(self, height):
+        """
+        reads from now on only go to nodes at least at that height (the wallet node is always fine)
+        """
+        with self.lock:
+            if self.minHeight is None or height > self.minHeight:
+                self.minHeight = height
+
+    def post(self, method, data, timeout, methods=None):
+        """
+        :param methods: methods inside a batch, routing follows the "least movable" of them
+        """
+        methods = methods or [method]
+        if len(self.nodes) == 1 or not all(m in READ_METHODS for m in methods):
+            result = self.primary.post(method, data, timeout)
+            if len(self.nodes) > 1 and any(m in WRITE_METHODS for m in methods):
+                self._broadcast(method, data, result)
+            return result
+        if time.time() - self.lastHeightCheck > HEIGHT_CHECK_SECONDS:
+            self.check_heights()
+        result = self._read(method, data, timeout, methods)
+        if method in HEIGHT_METHODS and result.status_code < 300:
+            height = result.json()['result']
+            height = height['height'] if isinstance(height, dict) else height
+            if isinstance(height, int) and (self.bestHeight is None or height > self.bestHeight):
+                # new block: the others are behind until they tell otherwise
+                self.saw_height(height, result.node)
+                self.check_heights()
+        return result
+
+    def _read(self, method, data, timeout, methods):
+        candidates = self.ranked()
+        hedge = self.hedge and len(candidates) > 1 and not any(m in NO_HEDGE_METHODS for m in methods)
+        error = None
+        while len(candidates) > 0:
+            node = candidates.pop(0)
+            if not hedge or len(candidates) == 0:
+                try:
+                    return node.post(method, data, timeout)
+                except NodeUnavailable as e:
+                    error = e
+                    self._log(f"rpc {method} failed on {e}, trying next node")
+                    continue
+            delay = node.quantile(0.95, method)
+            delay = max(MIN_HEDGE_DELAY, delay if delay is not None else DEFAULT_HEDGE_DELAY)
+            futures = [_start(node.post, method, data, timeout)]
+            done, _ = wait(futures, timeout=delay)
+            if len(done) == 0:
+                futures.append(_start(candidates.pop(0).post, method, data, timeout))
+            while len(futures) > 0:
+                done, _ = wait(futures, return_when=FIRST_COMPLETED)
+                for future in done:
+                    futures.remove(future)
+                    if future.exception() is None:
+                        return future.result()  # a slower one still records its latency when it's done
+                    error = future.exception()
+        raise error
+
+    def _broadcast(self, method, data, result):
+        # the wallet node created (or got) the tx, relay the raw tx to the other nodes in the background
+        if result.status_code >= 300:
+            return
+        request = json.loads(data)
+        if method == "sendrawtransaction":
+            rawTx = request['params'][0]
+        else:
+            txId = result.json().get('result')
+            if not isinstance(txId, str):
+                return
+            rawTx = None
+
+        def relay():
+            raw = rawTx
+            if raw is None:
+                response = self.primary.post("getrawtransaction", _request("getrawtransaction", [txId]), 10)
+                raw = response.json().get('result')
+                if not isinstance(raw, str):
+                    return
+            for node in self.nodes[1:]:
+                if node.available():
+                    _start(node.post, "sendrawtransaction", _request("sendrawtransaction", [raw]), 10)
+
+        _start(relay)
+
+    def saw_height(self, height, node=None):
+        """
+        called with the height of a new block: nodes below it count as lagging until the next check.
+        """
+        with self.lock:
+            if self.bestHeight is None or height > self.bestHeight:
+                self.bestHeight = height
+            if node is not None:
+                node.height = max(node.height or 0, height)
+
+    def check_heights(self, block=False):
+        """
+        getblockcount on all nodes in parallel. in the background unless block is set
+        """
+        with self.lock:
+            if self.checking or len(self.nodes) == 1:
+                return
+            self.checking = True
+            self.lastHeightCheck = time.time()
+
+        def check(node):
+            try:
+                height = node.post("getblockcount", _request("getblockcount", []), 5).json()['result']
+            except Exception:
+                return
+            if isinstance(height, int):
+                node.height = height
+                self.saw_height(height)
+
+        def checkAll():
+            try:
+                for future in [_start(check, node) for node in self.nodes]:
+                    future.result()
+            finally:
+                self.checking = False
+                lagging = [node.status(self.bestHeight) for node in self.nodes
+                           if node.height is not None and node.height < self.bestHeight]
+                if len(lagging) > 0:
+                    self._log("lagging nodes: " + ", ".join(lagging))
+
+        if block:
+            checkAll()
+        else:
+            threading.Thread(target=checkAll, name="rpc-heights", daemon=True).start()
+
+    def status(self):
+        return " | ".join(node.status(self.bestHeight) for node in self.nodes)
+
+    def _log(self, message):
+        if self.logger is not None:
+            self.logger.warning(message)
+
+
+def _start(function, *args):
+    # own thread instead of a pool: a hanging node must not queue the requests to the others
+    future = Future()
+
+    def run():
+        try:
+            future.set_result(function(*args))
+        except Exception as e:
+            future.set_exception(e)
+
+    threading.Thread(target=run, name="rpc-nodes", daemon=True).start()
+    return future
+
+
+def _request(method, params):
+    return json.dumps({"jsonrpc": "2.0", "id": "meBe", "method": method, "params": params})
@@ -0,0 +1,184 @@
+import atexit
+import collections
+import threading
+import time
+
+import requests
+
+'''
+background delivery of telegram messages and heartbeats, so a slow telegram api or heartbeat endpoint
+never stalls the bot. the calling code only enqueues (utils.send_telegram, utils.send_heartbeat).
+
+- bounded queue: when full, the oldest entry is dropped
+- worker threads send with a timeout and retry failed sends with exponential backoff
+  (telegram's retry_after is respected)
+- rate limit per target (chat or url): at most one send per minInterval seconds
+- burst merging: messages for the same chat that queue up while waiting are sent as one message,
+  repeated heartbeats to the same url are sent once
+- texts over telegram's limit are split at line breaks and sent as several messages, one per send of the chat
+- pending entries are flushed on exit (up to flushTimeout seconds)
+'''
+
+TELEGRAM_MAX_LENGTH = 4096
+
+
+def split_message(text, maxLength=TELEGRAM_MAX_LENGTH):
+    """
+    splits text into parts of at most maxLength characters, at line breaks where possible.
+    lines that are longer themselves are cut, empty parts are left out
+    """
+    parts = []
+    current = None
+    for line in text.split("\n"):
+        while len(line) > maxLength:
+            if current is not None:
+                parts.append(current)
+                current = None
+            parts.append(line[:maxLength])
+            line = line[maxLength:]
+        if current is not None and len(current) + 1 + len(line) <= maxLength:
+            current += "\n" + line
+        else:
+            if current is not None:
+                parts.append(current)
+            current = line
+    if current is not None:
+        parts.append(current)
+    return [part for part in parts if part.strip() != ""]
+
+
+class _Entry:
+    def __init__(self, kind, target, payload):
+        self.kind = kind  # "telegram" or "heartbeat"
+        self.target = target  # (token, channel) or url
+        self.payload = payload  # list of message texts for telegram, the parts not sent yet
+        self.attempts = 0
+        self.notBefore = 0
+
+
+class Outbox:
+    def __init__(self, maxSize=500, workers=2, timeout=10, retries=5, backoff=1.0, maxBackoff=120,
+                 minInterval=1.0, flushTimeout=5, warn=print):
+        self.maxSize = maxSize
+        self.workers = workers
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.maxBackoff = maxBackoff
+        self.minInterval = minInterval
+        self.flushTimeout = flushTimeout
+        self.warn = warn
+        self.queue = collections.deque()
+        self.condition = threading.Condition()
+        self.busy = set()  # targets currently sent by a worker
+        self.nextSend = {}  # target -> earliest time for the next send
+        self.dropped = 0
+        self.sent = 0
+        self.threads = []
+
+    def _start(self):
+        if len(self.threads) == 0:
+            for idx in range(self.workers):
+                thread = threading.Thread(target=self._work, name="outbox-%d" % idx, daemon=True)
+                thread.start()
+                self.threads.append(thread)
+            atexit.register(self.flush)
+
+    def put(self, kind, target, payload=None):
+        with self.condition:
+            self._start()
+            for entry in self.queue:
+                # merge into a waiting entry of the same target
+                if entry.kind == kind and entry.target == target:
+                    if kind == "telegram":
+                        entry.payload.append(payload)
+                    self.condition.notify()
+                    return
+            if len(self.queue) >= self.maxSize:
+                self.queue.popleft()
+                self.dropped += 1
+            self.queue.append(_Entry(kind, target, [payload] if kind == "telegram" else None))
+            self.condition.notify()
+
+    def send_telegram(self, token, channel, message):
+        self.put("telegram", (token, channel), message)
+
+    def heartbeat(self, url):
+        self.put("heartbeat", url)
+
+    def _next(self):
+        # first entry that is ready and whose target is not in use, else the time to wait for one
+        now = time.time()
+        wait = None
+        for entry in self.queue:
+            if entry.target in self.busy:
+                continue
+            ready = max(entry.notBefore, self.nextSend.get(entry.target, 0))
+            if ready <= now:
+                self.queue.remove(entry)
+                return entry, None
+            wait = ready - now if wait is None else min(wait, ready - now)
+        return None, wait
+
+    def _work(self):
+        while True:
+            with self.condition:
+                entry, wait = self._next()
+                while entry is None:
+                    self.condition.wait(wait)
+                    entry, wait = self._next()
+                self.busy.add(entry.target)
+                self.nextSend[entry.target] = time.time() + self.minInterval
+            retryAfter = None
+            try:
+                if entry.kind == "telegram":
+                    ok, retryAfter = self._send_telegram(entry)
+                else:
+                    ok = requests.get(entry.target, timeout=self.timeout).status_code < 300
+            except Exception as e:
+                ok = False
+                self.warn(f"error sending {entry.kind}: {str(e)}")
+            with self.condition:
+                self.busy.discard(entry.target)
+                if ok:
+                    self.sent += 1
+                    if entry.kind == "telegram" and len(entry.payload) > 0:
+                        # rest of a split message, goes out at the next send slot of the chat
+                        entry.attempts = 0
+                        self.queue.appendleft(entry)
+                elif entry.attempts < self.retries:
+                    entry.attempts += 1
+                    delay = retryAfter or min(self.maxBackoff, self.backoff * 2 ** entry.attempts)
+                    entry.notBefore = time.time() + delay
+                    self.queue.appendleft(entry)
+                else:
+                    self.dropped += 1
+                    self.warn(f"giving up on {entry.kind} after {entry.attempts + 1} attempts")
+                self.condition.notify_all()
+
+    def _send_telegram(self, entry):
+        token, channel = entry.target
+        parts = split_message("\n".join(entry.payload))
+        if len(parts) == 0:
+            entry.payload = []
+            return True, None
+        result = requests.get('https://api.telegram.org/bot' + token + '/sendMessage',
+                              params={"chat_id": channel, "text": parts[0]}, timeout=self.timeout).json()
+        if not result["ok"]:
+            self.warn("error sending telegram messages " + str(result))
+            if result.get("error_code") in [400, 401, 403, 404]:
+                entry.attempts = self.retries  # wrong token or chat, retrying won't help
+            return False, result.get("parameters", {}).get("retry_after")
+        entry.payload = parts[1:]
+        return True, None
+
+    def flush(self, timeout=None):
+        """
+        waits until everything is sent (or timeout seconds)
+        :return: True if the queue is empty
+        """
+        end = time.time() + (self.flushTimeout if timeout is None else timeout)
+        with self.condition:
+            while (len(self.queue) > 0 or len(self.busy) > 0) and time.time() < end:
+                self.condition.wait(min(0.1, max(0.0, end - time.time())))
+            return len(self.queue) == 0 and len(self.busy) == 0
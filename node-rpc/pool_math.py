@@ -0,0 +1,193 @@
+import math
+import random
+import time
+
+import numpy as np
+
+import utils
+
+'''
+vectorized versions of the pool math in utils. works on a PoolTable (all pools of a snapshot in numpy columns)
+and evaluates many pools and trade sizes in one call.
+
+all functions take
+  idx: index (or array of indices) of the pools in the table
+  forward: True (or bool array) if the input token is tokenA of the pool
+and broadcast them against the amounts.
+
+run `python pool_math.py` to compare against the scalar versions in utils and see the speedup.
+'''
+
+
+class PoolTable:
+    def __init__(self, pools):
+        pools = list(pools)
+        self.symbols = [pool['symbol'] for pool in pools]
+        self.index = {symbol: i for i, symbol in enumerate(self.symbols)}
+        self.reserveA = np.array([pool['reserveA'] for pool in pools], dtype=np.float64)
+        self.reserveB = np.array([pool['reserveB'] for pool in pools], dtype=np.float64)
+        self.totalLiquidity = np.array([pool['totalLiquidity'] for pool in pools], dtype=np.float64)
+        self.commission = np.array([pool.get('commission', 0) for pool in pools], dtype=np.float64)
+        self.feeInA = np.array([pool.get('dexFeeInPctTokenA', pool.get('dexFeePctTokenA', 0)) for pool in pools],
+                               dtype=np.float64)
+        self.feeOutA = np.array([pool.get('dexFeeOutPctTokenA', 0) for pool in pools], dtype=np.float64)
+        self.feeInB = np.array([pool.get('dexFeeInPctTokenB', pool.get('dexFeePctTokenB', 0)) for pool in pools],
+                               dtype=np.float64)
+        self.feeOutB = np.array([pool.get('dexFeeOutPctTokenB', 0) for pool in pools], dtype=np.float64)
+
+    @staticmethod
+    def from_snapshot(snapshot):
+        return PoolTable(snapshot.poolByPair.values())
+
+    def lookup(self, poolPairs, tokensIn):
+        """
+        :return: idx and forward arrays for the given pair names and input tokens (same convention as utils)
+        """
+        idx = np.array([self.index[pair] for pair in poolPairs], dtype=np.int64)
+        forward = np.array([pair.startswith(token + "-") for pair, token in zip(poolPairs, tokensIn)])
+        return idx, forward
+
+    def reserves(self, idx, forward):
+        poolF = np.where(forward, self.reserveA[idx], self.reserveB[idx])
+        poolT = np.where(forward, self.reserveB[idx], self.reserveA[idx])
+        return poolF, poolT
+
+    def fees(self, idx, forward):
+        feeIn = np.where(forward, self.feeInA[idx], self.feeInB[idx])
+        feeOut = np.where(forward, self.feeOutB[idx], self.feeOutA[idx])
+        return self.commission[idx], feeIn, feeOut
+
+
+def estimated_new_price(table, idx, forward, amountIn):
+    poolF, poolT = table.reserves(idx, forward)
+    return ((poolF + amountIn) * (poolF + amountIn)) / (poolF * poolT)
+
+
+def estimated_pool_change(table, idx, forward, amountIn):
+    poolF, poolT = table.reserves(idx, forward)
+    return ((poolF + amountIn) * (poolF + amountIn)) / (poolF * poolF) - 1
+
+
+def estimated_execution(table, idx, forward, amountIn):
+    poolF, poolT = table.reserves(idx, forward)
+    return (poolF + amountIn) / poolT
+
+
+def max_swap_for_price_change(table, idx, forward, priceChange):
+    """
+    :param priceChange: relative increase 0.1 for 10% increase. 0 for entries <= 0
+    """
+    poolF, poolT = table.reserves(idx, forward)
+    priceChange = np.maximum(priceChange, 0)
+    return poolF * (np.sqrt(1 + priceChange) - 1)
+
+
+def swap_output(table, idx, forward, amountIn):
+    """
+    :return: amount of the output token after commission and dex fees
+    """
+    poolF, poolT = table.reserves(idx, forward)
+    commission, feeIn, feeOut = table.fees(idx, forward)
+    effectiveIn = amountIn * (1 - commission) * (1 - feeIn)
+    return poolT * effectiveIn / (poolF + effectiveIn) * (1 - feeOut)
+
+
+def price_impact(table, idx, forward, amountIn):
+    """
+    :return: relative loss of the execution price against the current pool price (incl. fees). 0.01 for 1%,
+             0 for amounts of 0
+    """
+    poolF, poolT = table.reserves(idx, forward)
+    amountIn = np.asarray(amountIn, dtype=np.float64)
+    safeAmount = np.where(amountIn > 0, amountIn, 1)
+    out = swap_output(table, idx, forward, safeAmount)
+    return np.where(amountIn > 0, 1 - (out / safeAmount) / (poolT / poolF), 0)
+
+
+def calc_maxPrice_Amounts(table, exchange_data, tokens, dfiAmount, target_premium=1.5, minTolerance=0.01):
+    """
+    vectorized utils.calc_maxPrice_Amount for many tokens at once
+    :return: arrays premium, maxPrice, bestPrice, amount
+    """
+    pairs = [token + "-DUSD" for token in tokens]
+    premium = np.array([exchange_data.premium_for_token(token) for token in tokens], dtype=np.float64)
+    oracle = np.array([exchange_data.dataByPair[pair].oracle_price for pair in pairs], dtype=np.float64)
+    dex = np.array([exchange_data.dataByPair[pair].dex_price for pair in pairs], dtype=np.float64)
+    valid = oracle > 0
+    safeOracle = np.where(valid, oracle, 1)
+    maxPrice = np.floor(exchange_data.dfioracle() / (target_premium * safeOracle) * 1e8) / 1e8
+    bestPrice = exchange_data.dfiData.dex_price / np.where(dex > 0, dex, 1)
+    idx, forward = table.lookup(pairs, tokens)
+    maxSwap = max_swap_for_price_change(table, idx, forward,
+                                        np.maximum(minTolerance, maxPrice / bestPrice - 1) * 0.75)
+    amount = np.floor(np.maximum(0, np.minimum(maxSwap, dfiAmount * maxPrice)) * 1e8) / 1e8
+    return (np.where(valid, premium, 0), np.where(valid, maxPrice, 1),
+            np.where(valid, bestPrice, 1), np.where(valid, amount, 0))
+
+
+def _sample_chain_data(pairs, tokens, rnd):
+    data = utils.ChainData()
+    data.dfiData.dex_price = rnd.uniform(0.5, 5)
+    data.dfiData.oracle_price = data.dfiData.dex_price * rnd.uniform(0.9, 1.1)
+    for pair, token in zip(pairs, tokens):
+        info = data.dataByPair[pair] = utils.PairInfo(pair)
+        info.dex_price = utils.poolByPair[pair]['reserveB/reserveA']
+        # some without oracle price, like a token with a stale feed
+        info.oracle_price = info.dex_price * rnd.uniform(0.8, 1.2) if rnd.random() > 0.1 else 0
+    return data
+
+
+def benchmark(numPools=100, numSizes=1000):
+    rnd = random.Random(42)
+    pools = {}
+    for i in range(numPools):
+        reserveA = rnd.uniform(1e3, 1e7)
+        reserveB = rnd.uniform(1e3, 1e7)
+        pools[str(i)] = {'symbol': "T%d-DUSD" % i, 'idTokenA': str(i + 100), 'idTokenB': "15",
+                         'reserveA': reserveA, 'reserveB': reserveB, 'totalLiquidity': math.sqrt(reserveA * reserveB),
+                         'reserveA/reserveB': reserveA / reserveB, 'reserveB/reserveA': reserveB / reserveA,
+                         'commission': 0.002}
+    snapshot = utils.ChainSnapshot("", 0, pools, [], [], {})
+    utils.poolByPair = snapshot.poolByPair
+    table = PoolTable.from_snapshot(snapshot)
+    pairs = [pool['symbol'] for pool in pools.values()]
+    tokens = [pair.split("-")[0] for pair in pairs]
+    sizes = np.array([rnd.uniform(1, 1e5) for _ in range(numSizes)])
+    changes = sizes / 1e6
+    chainData = _sample_chain_data(pairs, tokens, rnd)
+    dfiAmount = 1e4
+
+    start = time.perf_counter()
+    scalar = {
+        "estimatedNewPrice": [[utils.estimatedNewPrice(pair, token, size) for size in sizes]
+                              for pair, token in zip(pairs, tokens)],
+        "estimatedPoolChange": [[utils.estimatedPoolChange(pair, token, size) for size in sizes]
+                                for pair, token in zip(pairs, tokens)],
+        "estimatedExecution": [[utils.estimatedExecution(pair, token, size) for size in sizes]
+                               for pair, token in zip(pairs, tokens)],
+        "maxSwapForPriceChange": [[utils.maxSwapForPriceChange(pair, token, change) for change in changes]
+                                  for pair, token in zip(pairs, tokens)],
+        "calc_maxPrice_Amount": [utils.calc_maxPrice_Amount(chainData, token, dfiAmount) for token in tokens]}
+    scalarTime = time.perf_counter() - start
+
+    start = time.perf_counter()
+    idx, forward = table.lookup(pairs, tokens)
+    vector = {
+        "estimatedNewPrice": estimated_new_price(table, idx[:, None], forward[:, None], sizes[None, :]),
+        "estimatedPoolChange": estimated_pool_change(table, idx[:, None], forward[:, None], sizes[None, :]),
+        "estimatedExecution": estimated_execution(table, idx[:, None], forward[:, None], sizes[None, :]),
+        "maxSwapForPriceChange": max_swap_for_price_change(table, idx[:, None], forward[:, None], changes[None, :]),
+        "calc_maxPrice_Amount": np.array(calc_maxPrice_Amounts(table, chainData, tokens, dfiAmount)).T}
+    vectorTime = time.perf_counter() - start
+
+    print(f"{numPools} pools x {numSizes} sizes: scalar {scalarTime * 1000:.1f} ms, "
+          f"vectorized {vectorTime * 1000:.1f} ms ({scalarTime / vectorTime:.0f}x)")
+    for name, expected in scalar.items():
+        expected = np.array(expected, dtype=np.float64)
+        # relative for the prices, absolute for the amounts that are floored to 8 digits
+        diff = np.abs(vector[name] - expected) / np.maximum(np.abs(expected), 1)
+        print(f"  {name:22} max difference {np.max(diff):.2e}{'' if np.max(diff) < 1e-8 else '  MISMATCH'}")
+
+
+if __name__ == "__main__":
+    benchmark()
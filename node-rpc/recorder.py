@@ -0,0 +1,382 @@
+import json
+import logging
+import os
+import sys
+import threading
+
+import numpy as np
+
+import utils
+
+'''
+append-only columnar store of the per-block pool reserves and oracle prices.
+
+the store is a folder of segments, one subfolder per start height. a segment has fixed columns
+(the pools and tokens at the time it was created, in meta.json) and one raw file per field:
+  height.i64                               one int64 per row
+  reserveA/reserveB/totalLiquidity.f64     one float64 per pool and row
+  activePrice/nextPrice/livePrice.f64      one float64 per token and row (active/next from the fixed interval
+                                           price feed <token>/USD, live from listprices)
+values that are missing in a block are NaN. when new pools or tokens show up, a new segment is started.
+rows are only appended. a torn row from a crash is cut off on open and a height that gets recorded again
+(reorg) replaces the rows from that height on. readers that don't write (risk calibration, backfill sources)
+open the store with readOnly=True: they see the complete rows and leave the files alone, so a row that a
+writer in another process is appending right now isn't cut off under it.
+
+reads are numpy memmaps, so a range inside one segment comes back without copying.
+
+recording:
+  - python recorder.py record settings.json store   (own loop, one row per block)
+  - "recordTo": "store" in the settings of DFIVaultMaxi or trade_bot records every snapshot they load anyway
+
+backfill: defid only exposes the current reserves and prices, there is no rpc for the state at a past height.
+so gaps are filled from another store (f.e. one recorded on a second machine) or any external source with
+Recorder.backfill, which writes a whole range of rows with one write per column:
+  python recorder.py backfill store otherStore [fromHeight toHeight]
+'''
+
+POOL_FIELDS = ["reserveA", "reserveB", "totalLiquidity"]
+PRICE_FIELDS = ["activePrice", "nextPrice", "livePrice"]
+
+
+class Segment:
+    def __init__(self, path, pools=None, tokens=None, readOnly=False):
+        self.path = path
+        self.readOnly = readOnly
+        if pools is not None:
+            os.makedirs(path, exist_ok=True)
+            with open(os.path.join(path, "meta.json"), "w") as f:
+                json.dump({"pools": pools, "tokens": tokens}, f)
+        with open(os.path.join(path, "meta.json")) as f:
+            meta = json.load(f)
+        self.pools = meta['pools']
+        self.tokens = meta['tokens']
+        self.poolIndex = {pool: idx for idx, pool in enumerate(self.pools)}
+        self.tokenIndex = {token: idx for idx, token in enumerate(self.tokens)}
+        self.widths = {"height": 1}
+        self.widths.update({field: len(self.pools) for field in POOL_FIELDS})
+        self.widths.update({field: len(self.tokens) for field in PRICE_FIELDS})
+        self.files = {}
+        self.views = {}  # field -> memmap of the current rows, rebuilt on the first read after rows were added
+        self.lastHeight = None
+        if readOnly:
+            self.rows = self._complete_rows()
+            self._read_last_height()
+        else:
+            self.rows = self._repair()
+
+    def _file(self, field):
+        return os.path.join(self.path, field + (".i64" if field == "height" else ".f64"))
+
+    def _complete_rows(self):
+        # rows that are complete in all columns
+        rows = []
+        for field, width in self.widths.items():
+            if width > 0:
+                size = os.path.getsize(self._file(field)) if os.path.exists(self._file(field)) else 0
+                rows.append(size // (8 * width))
+        return min(rows)
+
+    def _repair(self):
+        # all columns must have the same number of complete rows, cut off what a crash left behind
+        self.truncate(self._complete_rows())
+        return self.rows
+
+    def _check_writable(self):
+        if self.readOnly:
+            raise ValueError(f"{self.path} is opened read-only")
+
+    def truncate(self, rows):
+        self._check_writable()
+        self.close()
+        for field, width in self.widths.items():
+            with open(self._file(field), "ab") as f:
+                f.truncate(rows * 8 * width)
+        self.rows = rows
+        self._read_last_height()
+
+    def _read_last_height(self):
+        self.lastHeight = None
+        if self.rows > 0:
+            with open(self._file("height"), "rb") as f:
+                f.seek((self.rows - 1) * 8)
+                self.lastHeight = int(np.frombuffer(f.read(8), dtype=np.int64)[0])
+
+    def append(self, heights, columns):
+        """
+        :param heights: int array of the rows
+        :param columns: field -> 2d array (rows x width) in the column order of this segment
+        """
+        self._check_writable()
+        for field in self.widths.keys():
+            if field not in self.files:
+                self.files[field] = open(self._file(field), "ab")
+            data = heights if field == "height" else columns[field]
+            self.files[field].write(np.ascontiguousarray(data, dtype=np.int64 if field == "height" else np.float64)
+                                    .tobytes())
+        for f in self.files.values():
+            f.flush()
+        self.rows += len(heights)
+        if len(heights) > 0:
+            self.lastHeight = int(heights[-1])
+        self.views = {}
+
+    def covers(self, pools, tokens):
+        """
+        True if the segment has columns for all the given pools and tokens
+        """
+        return set(pools) <= self.poolIndex.keys() and set(tokens) <= self.tokenIndex.keys()
+
+    def view(self, field):
+        if field not in self.views:
+            dtype = np.int64 if field == "height" else np.float64
+            width = self.widths[field]
+            if self.rows == 0 or width == 0:
+                data = np.zeros((self.rows, width), dtype=dtype)
+            else:
+                data = np.memmap(self._file(field), dtype=dtype, mode="r", shape=(self.rows, width))
+            self.views[field] = data[:, 0] if field == "height" else data
+        return self.views[field]
+
+    def range(self, fromHeight, toHeight):
+        heights = self.view("height")
+        return np.searchsorted(heights, fromHeight), np.searchsorted(heights, toHeight, side="right")
+
+    def close(self):
+        for f in self.files.values():
+            f.close()
+        self.files = {}
+        self.views = {}
+
+
+class Recorder:
+    def __init__(self, path, readOnly=False):
+        """
+        :param readOnly: don't repair or write, only the rows that are complete in all columns are visible
+        """
+        self.path = path
+        self.readOnly = readOnly
+        self.lock = threading.Lock()
+        if not readOnly:
+            os.makedirs(path, exist_ok=True)
+        names = sorted(os.listdir(path)) if os.path.isdir(path) else []
+        self.segments = [Segment(os.path.join(path, name), readOnly=readOnly) for name in names
+                         if os.path.exists(os.path.join(path, name, "meta.json"))]
+
+    def _new_segment(self, startHeight, pools, tokens):
+        if self.readOnly:
+            raise ValueError(f"{self.path} is opened read-only")
+        name = "%010d" % startHeight
+        while os.path.exists(os.path.join(self.path, name)):
+            name += "_"
+        segment = Segment(os.path.join(self.path, name), sorted(pools), sorted(tokens))
+        self.segments.append(segment)
+        self.segments.sort(key=lambda s: os.path.basename(s.path))
+        return segment
+
+    def last_height(self):
+        heights = [s.lastHeight for s in self.segments if s.lastHeight is not None]
+        return max(heights) if len(heights) > 0 else None
+
+    def record(self, snapshot):
+        pools = {}
+        for symbol, pool in snapshot.poolByPair.items():
+            pools[symbol] = [pool['reserveA'], pool['reserveB'], pool['totalLiquidity']]
+        prices = {}
+        for price in snapshot.fixedPrices:
+            token, currency = price['priceFeedId'].split("/")
+            if currency == "USD":
+                prices[token] = [price.get('activePrice', np.nan), price.get('nextPrice', np.nan), np.nan]
+        for price in snapshot.livePrices:
+            if price['currency'] == "USD" and price.get('ok') is True and "price" in price:
+                prices.setdefault(price['token'], [np.nan, np.nan, np.nan])[2] = price['price']
+        self.append(snapshot.height, pools, prices)
+
+    def append(self, height, pools, prices):
+        """
+        :param pools: symbol -> [reserveA, reserveB, totalLiquidity]
+        :param prices: token -> [activePrice, nextPrice, livePrice]
+        """
+        with self.lock:
+            segment = self.segments[-1] if len(self.segments) > 0 else None
+            for s in self.segments:
+                if s.lastHeight is not None and s.lastHeight >= height:
+                    # seen this height already (reorg or a second recorder), replace the rows from there on
+                    s.truncate(int(np.searchsorted(s.view("height"), height)))
+            if segment is None or not segment.covers(pools.keys(), prices.keys()):
+                segment = self._new_segment(height, pools.keys() | set(segment.pools if segment else []),
+                                            prices.keys() | set(segment.tokens if segment else []))
+            columns = {field: np.full((1, len(segment.pools)), np.nan) for field in POOL_FIELDS}
+            columns.update({field: np.full((1, len(segment.tokens)), np.nan) for field in PRICE_FIELDS})
+            for symbol, values in pools.items():
+                for field, value in zip(POOL_FIELDS, values):
+                    columns[field][0, segment.poolIndex[symbol]] = value
+            for token, values in prices.items():
+                for field, value in zip(PRICE_FIELDS, values):
+                    columns[field][0, segment.tokenIndex[token]] = value
+            segment.append(np.array([height], dtype=np.int64), columns)
+
+    def backfill(self, heights, pools, tokens, columns):
+        """
+        adds rows of heights that are not in the store yet, all with one write per column.
+        :param heights: sorted int array
+        :param pools, tokens: column names of the arrays in columns
+        :param columns: field -> 2d array (len(heights) x len(pools) or len(tokens))
+        :return: number of rows added
+        """
+        with self.lock:
+            heights = np.asarray(heights, dtype=np.int64)
+            new = np.ones(len(heights), dtype=bool)
+            for segment in self.segments:
+                if segment.rows > 0:
+                    new &= ~np.isin(heights, segment.view("height"))
+            if not new.any():
+                return 0
+            pools = list(pools)
+            tokens = list(tokens)
+            segment = self.segments[-1] if len(self.segments) > 0 else None
+            if segment is None or not segment.covers(pools, tokens) \
+                    or (segment.lastHeight is not None and segment.lastHeight >= heights[new][0]):
+                # rows of a segment stay sorted by height, older rows need their own segment
+                segment = self._new_segment(int(heights[new][0]), pools, tokens)
+            data = {}
+            for fields, names, index in [(POOL_FIELDS, pools, segment.poolIndex),
+                                         (PRICE_FIELDS, tokens, segment.tokenIndex)]:
+                # columns of the segment that the source doesn't have stay NaN
+                columnIdx = [index[name] for name in names]
+                for field in fields:
+                    data[field] = np.full((int(new.sum()), len(index)), np.nan)
+                    data[field][:, columnIdx] = np.asarray(columns[field])[new]
+            segment.append(heights[new], data)
+            return int(new.sum())
+
+    def backfill_from(self, other, fromHeight=0, toHeight=2 ** 62):
+        added = 0
+        for segment in other.segments:
+            start, end = segment.range(fromHeight, toHeight)
+            if end > start:
+                added += self.backfill(segment.view("height")[start:end], segment.pools, segment.tokens,
+                                       {field: segment.view(field)[start:end] for field in POOL_FIELDS + PRICE_FIELDS})
+        return added
+
+    def read(self, fromHeight, toHeight):
+        """
+        all rows with fromHeight <= height <= toHeight.
+        :return: dict with height, pools, tokens and the fields as 2d arrays (rows x pools/tokens).
+        memmap views if the range is in one segment, else a merged copy (NaN where a segment has no such column)
+        """
+        parts = []
+        for segment in self.segments:
+            start, end = segment.range(fromHeight, toHeight)
+            if end > start:
+                parts.append((segment, start, end))
+        if len(parts) == 1:
+            segment, start, end = parts[0]
+            result = {"pools": segment.pools, "tokens": segment.tokens, "height": segment.view("height")[start:end]}
+            result.update({field: segment.view(field)[start:end] for field in POOL_FIELDS + PRICE_FIELDS})
+            return result
+        pools = sorted(set(pool for segment, _, _ in parts for pool in segment.pools))
+        tokens = sorted(set(token for segment, _, _ in parts for token in segment.tokens))
+        heights = np.concatenate([segment.view("height")[start:end] for segment, start, end in parts]) \
+            if len(parts) > 0 else np.zeros(0, dtype=np.int64)
+        order = np.argsort(heights, kind="stable")
+        result = {"pools": pools, "tokens": tokens, "height": heights[order]}
+        for fields, names, attr in [(POOL_FIELDS, pools, "pools"), (PRICE_FIELDS, tokens, "tokens")]:
+            for field in fields:
+                merged = np.full((len(heights), len(names)), np.nan)
+                row = 0
+                for segment, start, end in parts:
+                    columns = [names.index(name) for name in getattr(segment, attr)]
+                    merged[row:row + end - start, columns] = segment.view(field)[start:end]
+                    row += end - start
+                result[field] = merged[order]
+        return result
+
+    def series(self, field, name, fromHeight, toHeight):
+        """
+        :return: [heights, values] of one pool (reserve fields) or token (price fields)
+        """
+        data = self.read(fromHeight, toHeight)
+        names = data['pools'] if field in POOL_FIELDS else data['tokens']
+        if name not in names:
+            return [data['height'], np.full(len(data['height']), np.nan)]
+        return [data['height'], data[field][:, names.index(name)]]
+
+    def missing(self, fromHeight, toHeight):
+        """
+        :return: list of [from, to] height ranges that are not recorded
+        """
+        recorded = np.unique(np.concatenate([s.view("height") for s in self.segments] + [np.zeros(0, np.int64)]))
+        recorded = recorded[(recorded >= fromHeight) & (recorded <= toHeight)]
+        bounds = np.concatenate([[fromHeight - 1], recorded, [toHeight + 1]])
+        gaps = np.flatnonzero(np.diff(bounds) > 1)
+        return [[int(bounds[i] + 1), int(bounds[i + 1] - 1)] for i in gaps]
+
+    def history(self, lmPair, fromHeight, toHeight, rewardPerBlock):
+        """
+        the recorded range as backtest.History for the pair. blocks without the pool are skipped
+        """
+        import backtest
+        data = self.read(fromHeight, toHeight)
+        pool = data['pools'].index(lmPair)
+        assetA = lmPair.split("-")[0]
+
+        def price(field, token):
+            if token == "DUSD":
+                return np.ones(len(data['height']))
+            return data[field][:, data['tokens'].index(token)]
+
+        valid = ~np.isnan(data['reserveA'][:, pool])
+        return backtest.History(height=data['height'][valid],
+                                reserveA=data['reserveA'][valid, pool], reserveB=data['reserveB'][valid, pool],
+                                totalLiquidity=data['totalLiquidity'][valid, pool],
+                                priceA=price("activePrice", assetA)[valid], nextPriceA=price("nextPrice", assetA)[valid],
+                                priceDFI=price("activePrice", "DFI")[valid],
+                                nextPriceDFI=price("nextPrice", "DFI")[valid],
+                                rewardPerBlock=np.full(int(valid.sum()), rewardPerBlock))
+
+    def close(self):
+        for segment in self.segments:
+            segment.close()
+
+
+_recorders = {}
+
+
+def attach(path):
+    """
+    records every new snapshot of utils (preload_snapshot) into the store at path. once per path and process
+    """
+    if path not in _recorders:
+        _recorders[path] = Recorder(path)
+        utils.snapshotListeners.append(_recorders[path].record)
+    return _recorders[path]
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 4 or sys.argv[1] not in ["record", "backfill"]:
+        print("usage: python recorder.py record settings.json store\n"
+              "       python recorder.py backfill store otherStore [fromHeight toHeight]")
+        sys.exit(1)
+    if sys.argv[1] == "backfill":
+        recorder = Recorder(sys.argv[2])
+        bounds = [int(x) for x in sys.argv[4:6]]
+        added = recorder.backfill_from(Recorder(sys.argv[3], readOnly=True), *bounds)
+        print(f"added {added} blocks")
+        sys.exit(0)
+
+    with open(sys.argv[2]) as f:
+        settings = json.load(f)
+        if "NODE_URL" in settings:
+            utils.NODE_URL = settings["NODE_URL"]
+        if "BACKUP_NODES" in settings:
+            utils.BACKUP_NODES = settings["BACKUP_NODES"]
+        utils.NODE_USER = settings['NODE_USER']
+        utils.NODE_PASSWORD = settings['NODE_PASSWORD']
+    utils.LOGGER = utils.setup_logger("recorder", logging.INFO)
+    attach(sys.argv[3])
+    height = utils.chain_snapshot().height
+    utils.LOGGER.info(f"recording into {sys.argv[3]} from block {height}")
+    while True:
+        height = utils.waitForNewBlock(height)
+        utils.chain_snapshot()
@@ -0,0 +1,251 @@
+import json
+import operator
+import random
+import sys
+import time
+import tracemalloc
+
+import tokenamount
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+'''
+records for the pools, vaults and accounts of a ChainSnapshot. records can be read like the json dicts
+(pool['reserveA'], pool.get('commission', 0)), so the code using the snapshot doesn't care.
+
+vaults and accounts parse their "amount@token" entries once per block instead of on every read.
+pools are only converted with utils.COMPACT_POOLS ("compactRecords": true in the settings): listpoolpairs returns
+~30 fields per pool, the bots read 14 of them and only those are kept, in a tuple instead of a dict per pool.
+a pool that didn't change since the last block (most of them, only pools with swaps move) keeps its record object,
+changed pools get a new one. records are never modified: threads that still work on the previous snapshot
+(vault_orchestrator) see consistent values. that is a third of the memory, but the conversion comes on top of the
+json decode, so per block it costs more cpu than it saves and the default keeps the decoded dicts.
+
+loads() uses orjson if it is installed (pip install orjson), else the json module. that is the part that makes
+the per block decode faster. `python records.py` compares memory and decode time per block.
+'''
+
+if orjson is not None:
+    loads = orjson.loads
+else:
+    loads = json.loads
+
+
+class Record:
+    __slots__ = []
+
+    def __getitem__(self, key):
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key)
+
+    def get(self, key, default=None):
+        return getattr(self, key, default)
+
+    def __contains__(self, key):
+        return hasattr(self, key)
+
+    def as_dict(self):
+        return {key: getattr(self, key) for key in self.__slots__ if not key.startswith("_") and hasattr(self, key)}
+
+    def __repr__(self):
+        return repr(self.as_dict())
+
+
+class PoolRecord(Record):
+    FIELDS = ["symbol", "idTokenA", "idTokenB", "reserveA", "reserveB", "totalLiquidity", "commission", "status",
+              "dexFeePctTokenA", "dexFeePctTokenB", "dexFeeInPctTokenA", "dexFeeOutPctTokenA", "dexFeeInPctTokenB",
+              "dexFeeOutPctTokenB"]
+    INDEX = {key: idx for idx, key in enumerate(FIELDS)}
+    _values = operator.itemgetter(*FIELDS)
+    __slots__ = ["id", "values"]
+
+    def __init__(self, poolId, values):
+        self.id = poolId
+        self.values = values  # in the order of FIELDS, None if the node didn't send it
+
+    @classmethod
+    def values_of(cls, pool):
+        try:
+            return cls._values(pool)
+        except KeyError:
+            # missing fields (older nodes have no dex fees) are None, so get() falls back to the default
+            return tuple(map(pool.get, cls.FIELDS))
+
+    def __getitem__(self, key):
+        idx = self.INDEX.get(key)
+        if idx is not None and self.values[idx] is not None:
+            return self.values[idx]
+        # the ratios of the node are the same division
+        if key == "reserveA/reserveB":
+            return self.values[3] / self.values[4]
+        if key == "reserveB/reserveA":
+            return self.values[4] / self.values[3]
+        if key == "id":
+            return self.id
+        raise KeyError(key)
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def as_dict(self):
+        result = {key: value for key, value in zip(self.FIELDS, self.values) if value is not None}
+        result["id"] = self.id
+        return result
+
+
+def decode_pools(pools, previous=None):
+    """
+    :param pools: result of listpoolpairs (id -> pool)
+    :param previous: id -> PoolRecord of the last block, unchanged pools are taken from there
+    :return: id -> PoolRecord
+    """
+    previous = previous or {}
+    result = {}
+    for poolId, pool in pools.items():
+        values = PoolRecord.values_of(pool)
+        record = previous.get(poolId)
+        if not isinstance(record, PoolRecord) or record.values != values:
+            record = PoolRecord(poolId, values)
+        result[poolId] = record
+    return result
+
+
+class VaultRecord(Record):
+    __slots__ = ["vaultId", "ownerAddress", "loanSchemeId", "state", "collateralAmounts", "loanAmounts",
+                 "collateralValue", "loanValue", "collateralRatio", "nextCollateralRatio", "_collaterals", "_loans"]
+
+    def __init__(self, vault):
+        for key in self.__slots__:
+            if not key.startswith("_") and key in vault:
+                setattr(self, key, vault[key])
+        self._collaterals = None
+        self._loans = None
+
+    def collaterals(self):
+        """
+        :return: token -> amount (float), parsed once
+        """
+        if self._collaterals is None:
+            self._collaterals = _parse_floats(self.get('collateralAmounts'))
+        return self._collaterals
+
+    def loans(self):
+        if self._loans is None:
+            self._loans = _parse_floats(self.get('loanAmounts'))
+        return self._loans
+
+
+def decode_vault(vault):
+    if vault is None:
+        return None
+    return VaultRecord(vault)
+
+
+class AccountRecord:
+    """
+    balances of an address: floats for the decisions, exact Amounts (tokenamount) for the txs.
+    both are parsed from the "amount@token" entries once per block
+    """
+    __slots__ = ["entries", "_balances", "_amounts"]
+
+    def __init__(self, entries):
+        self.entries = entries or []
+        self._balances = None
+        self._amounts = None
+
+    def balances(self):
+        if self._balances is None:
+            self._balances = _parse_floats(self.entries)
+        return self._balances
+
+    def amounts(self):
+        if self._amounts is None:
+            self._amounts = tokenamount.parse_amounts(self.entries)
+        return self._amounts
+
+
+def _parse_floats(entries):
+    balances = {}
+    for entry in entries or []:
+        value, _, token = entry.partition("@")
+        balances[token] = float(value)
+    return balances
+
+
+# ================================ benchmark ==================================
+
+
+def _sample_pools(count, rnd):
+    pools = {}
+    for i in range(count):
+        reserveA = rnd.uniform(1e3, 1e7)
+        reserveB = rnd.uniform(1e3, 1e7)
+        pools[str(i + 1)] = {
+            "symbol": f"T{i}-DUSD", "name": f"Token {i}-Decentralized USD", "status": True,
+            "idTokenA": str(i + 100), "idTokenB": "15", "dexFeePctTokenA": 0.001, "dexFeeInPctTokenA": 0.001,
+            "dexFeeOutPctTokenA": 0, "dexFeePctTokenB": 0, "dexFeeInPctTokenB": 0, "dexFeeOutPctTokenB": 0,
+            "reserveA": round(reserveA, 8), "reserveB": round(reserveB, 8), "commission": 0.002,
+            "totalLiquidity": round((reserveA * reserveB) ** 0.5, 8), "reserveA/reserveB": reserveA / reserveB,
+            "reserveB/reserveA": reserveB / reserveA, "tradeEnabled": True,
+            "ownerAddress": "8UAhRuUFCyFUHEPD7qvtj8Zy2HxF5HH5nb",
+            "blockCommissionA": 0, "blockCommissionB": 0, "rewardPct": 0.01, "rewardLoanPct": 0.02,
+            "customRewards": ["0.5@0"], "creationTx": "%064x" % rnd.getrandbits(256), "creationHeight": 1000000 + i}
+    return pools
+
+
+def _next_block(pools, rnd, changed):
+    # swaps in some of the pools
+    for poolId in rnd.sample(list(pools.keys()), changed):
+        pool = pools[poolId]
+        pool["reserveA"] = round(pool["reserveA"] * 1.001, 8)
+        pool["reserveB"] = round(pool["reserveB"] / 1.001, 8)
+
+
+def benchmark(numPools=500, blocks=200, changedPerBlock=20):
+    rnd = random.Random(42)
+    pools = _sample_pools(numPools, rnd)
+    texts = []
+    for _ in range(blocks):
+        _next_block(pools, rnd, changedPerBlock)
+        texts.append(json.dumps({"result": pools, "error": None, "id": "meBe"}).encode())
+
+    def run(decoder, toRecords):
+        seconds = float("inf")
+        for _ in range(3):  # best of 3, against noise from other processes
+            previous = None
+            start = time.perf_counter()
+            for text in texts:
+                result = decoder(text)['result']
+                previous = decode_pools(result, previous) if toRecords else result
+            seconds = min(seconds, (time.perf_counter() - start) / blocks)
+        tracemalloc.start()
+        kept = decode_pools(decoder(texts[-1])['result']) if toRecords else decoder(texts[-1])['result']
+        size = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        return seconds, size, kept
+
+    print(f"{numPools} pools, {changedPerBlock} change per block, {len(texts[-1]) // 1024} kB listpoolpairs")
+    decoders = [("json", json.loads)] + ([("orjson", orjson.loads)] if orjson is not None else [])
+    for name, decoder in decoders:
+        for toRecords in [False, True]:
+            seconds, size, _ = run(decoder, toRecords)
+            print(f"  {name:6} {'records (compactRecords)' if toRecords else 'dicts (default)         '}: "
+                  f"{seconds * 1000:6.2f} ms per block, "
+                  f"{size / 1024:7.0f} kB kept")
+    if orjson is None:
+        print("  (orjson not installed)")
+
+
+if __name__ == "__main__":
+    benchmark(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,131 @@
+import math
+import time
+
+import numpy as np
+
+import strategy
+
+'''
+monte carlo estimate of the liquidation risk of a vault over the next oracle intervals.
+
+the oracle price only changes every PRICE_INTERVAL blocks and the next one is known in advance, so a path is:
+the known next price, then `intervals` random steps (correlated log-normal, covariance per interval estimated from
+the recorded activePrice of recorder.py). the ratio multiplier of a path is its lowest collateral/loan ratio
+relative to the current one. it only depends on the composition of the vault, not on its size, so one set of
+paths answers both questions:
+  - probability that the current ratio would fall below the liquidation ratio without any reaction of the bot
+  - the lowest ratio where this probability stays below maxProbability -> suggested minCollateralRatio
+
+in the settings of DFIVaultMaxi:
+  "riskEngine": {"maxProbability": 0.001, "intervals": 2, "paths": 10000, "apply": false, "history": "store"}
+with apply the min/max collateral ratio follow the suggestion (same width as in the settings), else it's only logged.
+'''
+
+PRICE_INTERVAL = 120
+BLOCKS_PER_YEAR = 1051200
+DEFAULT_VOLATILITY = 1.0  # yearly, for tokens without recorded prices
+FIXED_TOKENS = {"DUSD"}  # always priced at 1 USD by the loan system
+
+
+class RiskEngine:
+    def __init__(self, paths=10000, intervals=1, seed=None, defaultVolatility=DEFAULT_VOLATILITY):
+        self.paths = paths
+        self.intervals = intervals
+        self.rng = np.random.default_rng(seed)
+        self.defaultVariance = defaultVolatility ** 2 * PRICE_INTERVAL / BLOCKS_PER_YEAR  # per interval
+        self.tokens = []  # tokens of the estimated covariance
+        self.covariance = np.zeros((0, 0))  # of the log returns per interval
+        self.normals = None  # same random numbers for every evaluation, so the result only moves with the vault
+
+    def calibrate(self, heights, prices, tokens):
+        """
+        estimates the covariance per oracle interval from recorded activePrices
+        :param heights: block heights of the rows
+        :param prices: rows x tokens, NaN where missing
+        """
+        if len(heights) < 2:
+            return
+        logPrices = np.log(np.where(prices > 0, prices, np.nan))
+        returns = np.nan_to_num(np.diff(logPrices, axis=0))  # only non-zero at the price blocks
+        intervalCount = max(1.0, (heights[-1] - heights[0]) / PRICE_INTERVAL)
+        self.tokens = list(tokens)
+        self.covariance = returns.T @ returns / intervalCount
+        self.normals = None
+
+    def calibrate_from(self, recorder, toHeight, lookbackBlocks=30 * 2880):
+        data = recorder.read(toHeight - lookbackBlocks, toHeight)
+        self.calibrate(data['height'], data['activePrice'], data['tokens'])
+
+    def _covariance(self, tokens):
+        # covariance for the given tokens, default variance (uncorrelated) for the unknown ones
+        result = np.diag([self.defaultVariance] * len(tokens))
+        known = [(idx, self.tokens.index(token)) for idx, token in enumerate(tokens) if token in self.tokens]
+        if len(known) > 0:
+            own, other = np.array(known).T
+            result[np.ix_(own, own)] = self.covariance[np.ix_(other, other)]
+            # a token that was recorded but never moved still gets no variance, that's the data
+        return result
+
+    def _normals(self, tokenCount):
+        if self.normals is None or self.normals.shape[2] < tokenCount:
+            self.normals = self.rng.standard_normal((self.paths, self.intervals, tokenCount))
+        return self.normals[:, :, :tokenCount]
+
+    def ratio_multipliers(self, collaterals, loans, prices, nextPrices, collateralFactors=None):
+        """
+        :param collaterals: token -> amount
+        :param loans: token -> amount
+        :param prices: token -> current (active) price
+        :param nextPrices: token -> next price (becomes active at nextPriceBlock)
+        :return: per path the lowest ratio over the horizon relative to the current ratio
+        """
+        collateralFactors = collateralFactors or {"DUSD": strategy.DUSD_COLLATERAL_FACTOR}
+        tokens = sorted(set(collaterals.keys()) | set(loans.keys()))
+        moving = [token for token in tokens if token not in FIXED_TOKENS]
+
+        def price(values, token):
+            return 1.0 if token in FIXED_TOKENS else values[token]
+
+        collateralWeights = np.array([collaterals.get(t, 0) * collateralFactors.get(t, 1) for t in tokens])
+        loanWeights = np.array([loans.get(t, 0) for t in tokens])
+        current = np.array([price(prices, t) for t in tokens])
+        currentRatio = (collateralWeights @ current) / (loanWeights @ current)
+
+        paths = np.empty((self.paths, self.intervals + 1, len(tokens)))
+        paths[:, :, :] = np.array([price(nextPrices, t) for t in tokens])
+        if len(moving) > 0 and self.intervals > 0:
+            cov = self._covariance(moving)
+            # eigen decomposition instead of cholesky: works for zero variance (never moved) tokens too
+            values, vectors = np.linalg.eigh(cov)
+            root = vectors * np.sqrt(np.clip(values, 0, None))
+            shocks = self._normals(len(moving)) @ root.T
+            drift = -0.5 * np.diag(cov)  # so the expected price stays the same
+            movingIdx = [tokens.index(t) for t in moving]
+            paths[:, 1:, movingIdx] *= np.exp(np.cumsum(shocks + drift, axis=1))
+        ratios = (paths @ collateralWeights) / (paths @ loanWeights)
+        return ratios.min(axis=1) / currentRatio
+
+    def evaluate(self, collaterals, loans, prices, nextPrices, ratio, liquidationRatio, maxProbability,
+                 collateralFactors=None):
+        """
+        :param ratio: current collateral ratio in %
+        :return: dict with probability (of getting liquidated from the current ratio), safeRatio
+                 (lowest ratio in % with probability <= maxProbability) and seconds
+        """
+        start = time.perf_counter()
+        if sum(loans.values()) <= 0:
+            return {"probability": 0.0, "safeRatio": liquidationRatio, "seconds": time.perf_counter() - start}
+        multipliers = self.ratio_multipliers(collaterals, loans, prices, nextPrices, collateralFactors)
+        probability = float(np.mean(ratio * multipliers < liquidationRatio))
+        # liquidated from ratio r iff r < liquidationRatio / multiplier
+        needed = liquidationRatio / multipliers
+        safeRatio = float(np.quantile(needed, 1 - maxProbability))
+        return {"probability": probability, "safeRatio": safeRatio, "seconds": time.perf_counter() - start}
+
+
+def suggested_range(safeRatio, minCollateralRatio, maxCollateralRatio, liquidationRatio):
+    """
+    :return: [min, max] collateral ratio with the width of the given range, min at the safe ratio
+    """
+    newMin = max(liquidationRatio + 1, math.ceil(safeRatio))
+    return [newMin, newMin + (maxCollateralRatio - minCollateralRatio)]
@@ -0,0 +1,203 @@
+import tokenamount
+from tokenamount import COIN, to_sats
+
+'''
+local composite swap routing over the pool graph of a ChainSnapshot.
+quotes are calculated in process with the reserves, commissions and dex fees of the pools,
+so no testpoolswap roundtrip to the node is needed.
+sizing and path search run on floats, the amount that is actually sent is checked in satoshis with the integer
+rounding of the chain (quote_path_sats, fit_max_price).
+'''
+
+
+class Router:
+    def __init__(self, snapshot=None, maxHops=3):
+        self.maxHops = maxHops
+        self.pools = {}  # symbol -> [tokenA, tokenB, reserveA, reserveB, commission, feeInA, feeOutA, feeInB, feeOutB]
+        self.edges = {}  # token -> list of (poolSymbol, otherToken)
+        self.pathCache = {}  # (tokenFrom, tokenTo) -> list of paths, a path is a list of (poolSymbol, tokenIn)
+        if snapshot is not None:
+            self.update(snapshot)
+
+    def update(self, snapshot):
+        """
+        refresh the reserves from the snapshot of the current block. path tables are only rebuilt if the set of pools changed
+        """
+        pools = {}
+        for symbol, pool in snapshot.poolByPair.items():
+            tokens = symbol.split("-")
+            if len(tokens) != 2 or not pool.get('status', True) or pool['reserveA'] <= 0 or pool['reserveB'] <= 0:
+                continue
+            pools[symbol] = [tokens[0], tokens[1], pool['reserveA'], pool['reserveB'], pool.get('commission', 0),
+                             pool.get('dexFeeInPctTokenA', pool.get('dexFeePctTokenA', 0)),
+                             pool.get('dexFeeOutPctTokenA', 0),
+                             pool.get('dexFeeInPctTokenB', pool.get('dexFeePctTokenB', 0)),
+                             pool.get('dexFeeOutPctTokenB', 0)]
+        if pools.keys() != self.pools.keys():
+            self.edges = {}
+            for symbol, pool in pools.items():
+                self.edges.setdefault(pool[0], []).append((symbol, pool[1]))
+                self.edges.setdefault(pool[1], []).append((symbol, pool[0]))
+            self.pathCache = {}
+        self.pools = pools
+
+    def paths(self, tokenFrom, tokenTo):
+        key = (tokenFrom, tokenTo)
+        if key not in self.pathCache:
+            result = []
+            self._collect_paths(tokenFrom, tokenTo, [], {tokenFrom}, result)
+            self.pathCache[key] = result
+        return self.pathCache[key]
+
+    def _collect_paths(self, token, tokenTo, path, visited, result):
+        if len(path) >= self.maxHops:
+            return
+        for symbol, other in self.edges.get(token, []):
+            if other in visited:
+                continue
+            step = path + [(symbol, token)]
+            if other == tokenTo:
+                result.append(step)
+            else:
+                visited.add(other)
+                self._collect_paths(other, tokenTo, step, visited, result)
+                visited.remove(other)
+
+    def _swap(self, symbol, tokenIn, amountIn, reserves):
+        pool = self.pools[symbol]
+        reserveA, reserveB = reserves.get(symbol, (pool[2], pool[3]))
+        if tokenIn == pool[0]:
+            poolF, poolT, feeIn, feeOut = reserveA, reserveB, pool[5], pool[8]
+        else:
+            poolF, poolT, feeIn, feeOut = reserveB, reserveA, pool[7], pool[6]
+        effectiveIn = amountIn * (1 - pool[4]) * (1 - feeIn)
+        out = poolT * effectiveIn / (poolF + effectiveIn)
+        return out * (1 - feeOut), poolF + effectiveIn, poolT - out, tokenIn == pool[0]
+
+    def quote_path(self, path, amountIn, reserves=None, apply=False):
+        """
+        :param reserves: virtual reserves by pool symbol (for splitting), the real ones if None
+        :param apply: update the virtual reserves with the swap
+        :return: amount of the target token
+        """
+        if reserves is None:
+            reserves = {}
+        amount = amountIn
+        for symbol, tokenIn in path:
+            amount, newF, newT, forward = self._swap(symbol, tokenIn, amount, reserves)
+            if apply:
+                reserves[symbol] = (newF, newT) if forward else (newT, newF)
+        return amount
+
+    def quote_path_sats(self, path, amountIn, reserves=None):
+        """
+        same as quote_path, in satoshis and integer math
+        """
+        reserves = reserves or {}
+        amount = amountIn
+        for symbol, tokenIn in path:
+            pool = self.pools[symbol]
+            reserveA, reserveB = reserves.get(symbol, (pool[2], pool[3]))
+            if tokenIn == pool[0]:
+                poolF, poolT, feeIn, feeOut = reserveA, reserveB, pool[5], pool[8]
+            else:
+                poolF, poolT, feeIn, feeOut = reserveB, reserveA, pool[7], pool[6]
+            amount = tokenamount.swap_out(amount, to_sats(poolF), to_sats(poolT), to_sats(pool[4]), to_sats(feeIn),
+                                          to_sats(feeOut))
+        return amount
+
+    def fit_max_price(self, path, amountIn, maxPrice, reserves=None):
+        """
+        max_amount lands right on maxPrice, where rounding decides if the chain accepts it.
+        :param amountIn: satoshis
+        :return: the largest amount (satoshis, <= amountIn) with amountIn * COIN / out <= maxPrice in integer math
+                 (the check of compositeswap)
+        """
+        limit = to_sats(maxPrice)
+        for _ in range(50):
+            if amountIn <= 0:
+                return 0
+            out = self.quote_path_sats(path, amountIn, reserves)
+            if out > 0 and amountIn * COIN // out <= limit:
+                return amountIn
+            amountIn -= max(1, amountIn // 100000)
+        return 0
+
+    def quote(self, tokenFrom, tokenTo, amountIn):
+        """
+        best single path
+        :return: [amountOut, path]. [0, None] if there is no path
+        """
+        best = [0, None]
+        for path in self.paths(tokenFrom, tokenTo):
+            out = self.quote_path(path, amountIn)
+            if out > best[0]:
+                best = [out, path]
+        return best
+
+    def max_amount(self, tokenFrom, tokenTo, maxPrice, reserves=None):
+        """
+        largest input that still gets an average price (amountIn / amountOut) <= maxPrice
+        :param reserves: virtual reserves (see quote_path) f.e. with the swaps already sent in this block
+        :return: [amountIn, path]. [0, None] if no path is below maxPrice
+        """
+        best = [0, None]
+        for path in self.paths(tokenFrom, tokenTo):
+            if len(path) == 1:
+                amount = self._max_direct(path[0][0], path[0][1], maxPrice, reserves or {})
+            else:
+                amount = self._max_bisect(path, maxPrice, reserves)
+            if amount > best[0]:
+                best = [amount, path]
+        return best
+
+    def _max_direct(self, symbol, tokenIn, maxPrice, reserves):
+        # same as utils.maxSwapForPriceChange, solved for the average price incl. fees:
+        # amountIn / out = (poolF + amountIn * c) / (poolT * c * (1 - feeOut)) with c = (1 - commission) * (1 - feeIn)
+        pool = self.pools[symbol]
+        reserveA, reserveB = reserves.get(symbol, (pool[2], pool[3]))
+        if tokenIn == pool[0]:
+            poolF, poolT, feeIn, feeOut = reserveA, reserveB, pool[5], pool[8]
+        else:
+            poolF, poolT, feeIn, feeOut = reserveB, reserveA, pool[7], pool[6]
+        c = (1 - pool[4]) * (1 - feeIn)
+        return max(0, (maxPrice * poolT * c * (1 - feeOut) - poolF) / c)
+
+    def _max_bisect(self, path, maxPrice, reserves, iterations=50):
+        def price(amount):
+            out = self.quote_path(path, amount, reserves)
+            return amount / out if out > 0 else float("inf")
+
+        # the average price only gets worse with size
+        low, high = 0.0, 1e-6
+        while price(high) <= maxPrice:
+            low, high = high, high * 4
+            if high > 1e15:
+                return low
+        for _ in range(iterations):
+            mid = (low + high) / 2
+            if price(mid) <= maxPrice:
+                low = mid
+            else:
+                high = mid
+        return low
+
+    def split_quote(self, tokenFrom, tokenTo, amountIn, maxRoutes=3, steps=20):
+        """
+        splits the order over parallel paths: every chunk goes to the path with the best marginal output
+        :return: [amountOut, list of [path, amountIn]]
+        """
+        paths = self.paths(tokenFrom, tokenTo)
+        if len(paths) == 0:
+            return [0, []]
+        # limit to the best paths for the full size
+        paths = sorted(paths, key=lambda p: -self.quote_path(p, amountIn))[:maxRoutes]
+        chunk = amountIn / steps
+        reserves = {}
+        used = {}
+        total = 0
+        for _ in range(steps):
+            bestIdx = max(range(len(paths)), key=lambda i: self.quote_path(paths[i], chunk, dict(reserves)))
+            total += self.quote_path(paths[bestIdx], chunk, reserves, apply=True)
+            used[bestIdx] = used.get(bestIdx, 0) + chunk
+        return [total, [[paths[idx], amount] for idx, amount in used.items()]]
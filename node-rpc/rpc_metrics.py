@@ -0,0 +1,223 @@
+import bisect
+import contextlib
+import os
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+'''
+counts, payload sizes, errors and latency histograms of all rpc calls, per method and caller.
+utils.rpc, utils.rpc_batch and async_utils record into `metrics`, nothing to do for the bots.
+
+the caller is the function that called rpc (f.e. "utils:get_tx_input" or "DFIVaultMaxi:reduceExposureDoubleMint").
+to group calls by loop phase instead, wrap them:
+    with rpc_metrics.phase("reinvest"):
+        ...
+calls inside a batch are counted per method and caller in defid_rpc_batched_calls_total, the round trip itself is
+method "batch". reads through the per-block snapshot (utils.chain_snapshot, get_account, ...) count for the function
+that asked for them, or the phase/caller given to chain_snapshot/preload_snapshot.
+
+exposed as prometheus text on http://host:port/metrics (start_http_server) and as a periodic log line (start_summary_log).
+in the settings of DFIVaultMaxi / trade_bot: "metrics": {"port": 9101, "logInterval": 600}
+'''
+
+LATENCY_BUCKETS = [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30]
+LONG_POLL_METHODS = {"waitforblockheight"}  # mostly idle waiting for the block, not load on the node
+
+_ownFiles = {"utils.py", "async_utils.py", "rpc_metrics.py"}
+_rpcFunctions = {"rpc", "rpc_response", "rpc_batch", "rpc_batch_responses", "_batch", "_post", "caller"}
+# reads through the snapshot: the calls belong to whoever asked for the vault, account or pool
+_snapshotFunctions = {"chain_snapshot", "preload_snapshot", "get_account", "get_account_amounts", "get_balance",
+                      "get_pool", "updateData", "updatePoolData"}
+_local = threading.local()
+
+
+class _Entry:
+    __slots__ = ["calls", "errors", "requestBytes", "responseBytes", "seconds", "buckets"]
+
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.requestBytes = 0
+        self.responseBytes = 0
+        self.seconds = 0.0
+        self.buckets = [0] * (len(LATENCY_BUCKETS) + 1)  # last one is +Inf
+
+    def quantile(self, q):
+        # upper bound of the bucket that contains the quantile
+        target = q * self.calls
+        count = 0
+        for idx, bucketCount in enumerate(self.buckets):
+            count += bucketCount
+            if count >= target and count > 0:
+                return LATENCY_BUCKETS[idx] if idx < len(LATENCY_BUCKETS) else float("inf")
+        return 0
+
+
+class RpcMetrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries = {}  # (method, caller) -> _Entry
+        self.batched = {}  # (method, caller) -> calls sent inside batches
+        self.started = time.time()
+
+    def record(self, method, caller, seconds, requestBytes, responseBytes, error):
+        with self.lock:
+            entry = self.entries.get((method, caller))
+            if entry is None:
+                entry = self.entries[(method, caller)] = _Entry()
+            entry.calls += 1
+            entry.errors += 1 if error else 0
+            entry.requestBytes += requestBytes
+            entry.responseBytes += responseBytes
+            entry.seconds += seconds
+            entry.buckets[bisect.bisect_left(LATENCY_BUCKETS, seconds)] += 1
+
+    def record_batched(self, methods, caller):
+        with self.lock:
+            for method in methods:
+                self.batched[(method, caller)] = self.batched.get((method, caller), 0) + 1
+
+    def by_method(self):
+        """
+        :return: method -> _Entry summed over all callers
+        """
+        result = {}
+        with self.lock:
+            for (method, caller), entry in self.entries.items():
+                total = result.setdefault(method, _Entry())
+                total.calls += entry.calls
+                total.errors += entry.errors
+                total.requestBytes += entry.requestBytes
+                total.responseBytes += entry.responseBytes
+                total.seconds += entry.seconds
+                total.buckets = [a + b for a, b in zip(total.buckets, entry.buckets)]
+        return result
+
+    def prometheus(self):
+        lines = []
+        with self.lock:
+            entries = sorted(self.entries.items())
+            batched = sorted(self.batched.items())
+        for name, attr, kind, help in [("defid_rpc_calls_total", "calls", "counter", "rpc round trips"),
+                                       ("defid_rpc_errors_total", "errors", "counter", "failed rpc calls"),
+                                       ("defid_rpc_request_bytes_total", "requestBytes", "counter", "sent bytes"),
+                                       ("defid_rpc_response_bytes_total", "responseBytes", "counter",
+                                        "received bytes")]:
+            lines.append(f"# HELP {name} {help}")
+            lines.append(f"# TYPE {name} {kind}")
+            for (method, caller), entry in entries:
+                lines.append(f'{name}{{method="{method}",caller="{caller}"}} {getattr(entry, attr)}')
+        lines.append("# HELP defid_rpc_latency_seconds rpc round trip time")
+        lines.append("# TYPE defid_rpc_latency_seconds histogram")
+        for (method, caller), entry in entries:
+            labels = f'method="{method}",caller="{caller}"'
+            count = 0
+            for bound, bucketCount in zip(LATENCY_BUCKETS + ["+Inf"], entry.buckets):
+                count += bucketCount
+                lines.append(f'defid_rpc_latency_seconds_bucket{{{labels},le="{bound}"}} {count}')
+            lines.append(f"defid_rpc_latency_seconds_sum{{{labels}}} {entry.seconds}")
+            lines.append(f"defid_rpc_latency_seconds_count{{{labels}}} {entry.calls}")
+        lines.append("# HELP defid_rpc_batched_calls_total calls sent inside a batch")
+        lines.append("# TYPE defid_rpc_batched_calls_total counter")
+        for (method, caller), count in batched:
+            lines.append(f'defid_rpc_batched_calls_total{{method="{method}",caller="{caller}"}} {count}')
+        return "\n".join(lines) + "\n"
+
+    def summary(self, top=8):
+        """
+        one line: the methods with the most node time, calls, errors, p50/p95 and kB received
+        """
+        methods = sorted(self.by_method().items(), key=lambda item: -item[1].seconds)
+        totalCalls = sum(entry.calls for _, entry in methods)
+        totalSeconds = sum(entry.seconds for method, entry in methods if method not in LONG_POLL_METHODS)
+        minutes = max(1e-9, (time.time() - self.started) / 60)
+        parts = [f"{method}: {entry.calls}x {entry.errors}err "
+                 f"p50<{entry.quantile(0.5) * 1000:g}ms p95<{entry.quantile(0.95) * 1000:g}ms "
+                 f"{entry.seconds:.1f}s {entry.responseBytes // 1024}kB"
+                 for method, entry in methods[:top]]
+        return (f"rpc: {totalCalls} calls ({totalCalls / minutes:.1f}/min), {totalSeconds:.1f}s on the node | "
+                + " | ".join(parts))
+
+
+metrics = RpcMetrics()
+
+
+@contextlib.contextmanager
+def phase(name):
+    previous = getattr(_local, "phase", None)
+    _local.phase = name
+    try:
+        yield
+    finally:
+        _local.phase = previous
+
+
+def caller():
+    """
+    the phase set in this thread or the first function outside the rpc layer
+    """
+    name = getattr(_local, "phase", None)
+    if name is not None:
+        return name
+    frame = sys._getframe(1)
+    while frame is not None and os.path.basename(frame.f_code.co_filename) in _ownFiles \
+            and (frame.f_code.co_name in _rpcFunctions or frame.f_code.co_name in _snapshotFunctions):
+        frame = frame.f_back
+    if frame is None:
+        return "unknown"
+    return os.path.splitext(os.path.basename(frame.f_code.co_filename))[0] + ":" + frame.f_code.co_name
+
+
+class _Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = metrics.prometheus().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+_server = None
+_summaryThread = None
+
+
+def start_http_server(port, host="127.0.0.1"):
+    global _server
+    if _server is None:
+        _server = ThreadingHTTPServer((host, port), _Handler)
+        threading.Thread(target=_server.serve_forever, name="rpc-metrics", daemon=True).start()
+    return _server
+
+
+def start(settings, logger):
+    """
+    starts the endpoint and summary log as configured in the "metrics" entry of the settings (if any)
+    """
+    if settings is None:
+        return
+    if "port" in settings:
+        start_http_server(settings['port'], settings.get('host', "127.0.0.1"))
+    if "logInterval" in settings:
+        start_summary_log(logger, settings['logInterval'])
+
+
+def start_summary_log(logger, intervalSeconds=600):
+    """
+    logs metrics.summary() every intervalSeconds
+    """
+    global _summaryThread
+
+    def loop():
+        while True:
+            time.sleep(intervalSeconds)
+            logger.info(metrics.summary())
+
+    if _summaryThread is None:
+        _summaryThread = threading.Thread(target=loop, name="rpc-metrics-log", daemon=True)
+        _summaryThread.start()
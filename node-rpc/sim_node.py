@@ -0,0 +1,693 @@
+import argparse
+import hashlib
+import json
+import math
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+'''
+local stand-in for defid to run DFIVaultMaxi.py and trade_bot.py without a full node and real funds.
+
+implements the json-rpc methods the scripts use on a deterministic model:
+- oracle prices follow a seeded random walk per block, fixed interval prices switch every priceInterval blocks
+- pools are constant product AMMs with commission
+- vaults hold collateral and loans, ratios are calculated from the fixed interval prices (no interest)
+- custom txs go into a mempool and are applied in order when the next block is mined.
+  a tx that fails at that point is dropped (gettransaction reports confirmations -1), its inputs are free again
+  and txs spending its outputs are dropped too
+- utxos are tracked like defid does: a tx with an unknown or already spent input is rejected when it's sent
+  (bad-txns-inputs-missingorspent), so reusing an input shows up as the error it would be on the real chain
+
+blocks are mined every --blocktime seconds, every call is delayed by --latency seconds.
+call counts per method and the reaction latency (block -> first tx of the bots) are available via `getsimstats`
+and printed on exit.
+
+usage: python sim_node.py --port 8555 --blocktime 2 --latency 0.005
+then point NODE_URL of the settings to http://127.0.0.1:8555/ and use vaultId "simvault", address "simaddress"
+'''
+
+COLLATERAL_FACTORS = {"DFI": 1.0, "DUSD": 0.99, "USDC": 1.0, "BTC": 1.0}
+LOAN_TOKENS = ["DUSD", "TSLA", "SPY", "GME"]
+TOKEN_IDS = {"DFI": "0", "BTC": "2", "USDC": "13", "DUSD": "15", "TSLA": "20", "SPY": "26", "GME": "30"}
+MIN_COLLATERAL_RATIO = 150
+TX_FEE = 0.0001
+
+
+class RpcError(Exception):
+    def __init__(self, message, code=-32600):
+        super().__init__(message)
+        self.code = code
+
+
+def parse_amount(amount):
+    t = amount.split("@")
+    return float(t[0]), t[1]
+
+
+class SimChain:
+    def __init__(self, seed=1, priceInterval=120, volatility=0.002):
+        self.rnd = random.Random(seed)
+        self.seed = seed
+        self.priceInterval = priceInterval
+        self.volatility = volatility
+        self.lock = threading.Condition()
+        self.height = 1000
+        self.blockHash = self._hash(self.height)
+        self.blockTimes = {self.height: time.time()}
+
+        self.prices = {"DFI": 2.0, "BTC": 40000.0, "USDC": 1.0, "DUSD": 1.0, "TSLA": 200.0, "SPY": 400.0, "GME": 150.0}
+        self.activePrices = dict(self.prices)
+        self.lastIntervalStart = self.height
+
+        self.pools = {}
+        self._add_pool("DUSD-DFI", 2000000.0, 1000000.0)
+        self._add_pool("BTC-DFI", 100.0, 2000000.0)
+        self._add_pool("USDC-DUSD", 1000000.0, 1010000.0)
+        self._add_pool("TSLA-DUSD", 5000.0, 1030000.0)
+        self._add_pool("SPY-DUSD", 2000.0, 820000.0)
+        self._add_pool("GME-DUSD", 3000.0, 460000.0)
+
+        self.accounts = {}
+        self.vaults = {}
+        self.utxos = {}  # (txid, vout) -> {address, amount, height (None while in mempool), spent}
+        self.txs = {}  # txid -> {"height": None/int, "dropped": bool, "vin": [(txid, vout)], "vout": [...]}
+        self.mempool = []  # list of (txid, fn)
+        self.txCounter = 0
+
+        self.callCounts = {}
+        self.callsInBlock = {}
+        self.reactionLatencies = []
+        self.firstTxInBlock = None
+
+    @staticmethod
+    def _hash(height):
+        return hashlib.sha256(("simblock%d" % height).encode()).hexdigest()
+
+    def _add_pool(self, symbol, reserveA, reserveB):
+        tokenA, tokenB = symbol.split("-")
+        self.pools[symbol] = {"symbol": symbol, "idTokenA": TOKEN_IDS[tokenA], "idTokenB": TOKEN_IDS[tokenB],
+                              "reserveA": reserveA, "reserveB": reserveB,
+                              "totalLiquidity": math.sqrt(reserveA * reserveB), "commission": 0.002}
+
+    # ================================ setup ===================================
+
+    def add_address(self, address, balances, utxoCount=5, utxoAmount=1.0):
+        self.accounts[address] = dict(balances)
+        for _ in range(utxoCount):
+            txid = self._new_txid()
+            self.txs[txid] = {"height": self.height, "dropped": False, "vin": [], "vout": [(address, utxoAmount)]}
+            self.utxos[(txid, 0)] = {"address": address, "amount": utxoAmount, "height": self.height, "spent": False}
+
+    def add_vault(self, vaultId, owner, collateral, loans):
+        self.vaults[vaultId] = {"owner": owner, "collateral": dict(collateral), "loans": dict(loans),
+                                "state": "active"}
+
+    # ================================ model ===================================
+
+    def _new_txid(self):
+        self.txCounter += 1
+        return hashlib.sha256(("simtx%d-%d" % (self.seed, self.txCounter)).encode()).hexdigest()
+
+    def _credit(self, address, token, amount):
+        account = self.accounts.setdefault(address, {})
+        account[token] = account.get(token, 0) + amount
+
+    def _debit(self, address, token, amount):
+        account = self.accounts.get(address, {})
+        if account.get(token, 0) < amount - 1e-9:
+            raise RpcError(f"amount {account.get(token, 0)} is less than {amount}@{token}")
+        account[token] = account.get(token, 0) - amount
+        if account[token] <= 1e-12:
+            del account[token]
+
+    def _vault_values(self, vault, prices):
+        collateral = sum(amount * prices[token] * COLLATERAL_FACTORS.get(token, 1)
+                         for token, amount in vault["collateral"].items())
+        loan = sum(amount * prices[token] for token, amount in vault["loans"].items())
+        return collateral, loan
+
+    def _ratio(self, vault, prices):
+        collateral, loan = self._vault_values(vault, prices)
+        return int(100 * collateral / loan) if loan > 0 else -1
+
+    def _check_vault(self, vault):
+        for prices in [self.activePrices, self.prices]:
+            ratio = self._ratio(vault, prices)
+            if 0 <= ratio < MIN_COLLATERAL_RATIO:
+                raise RpcError(f"Vault does not have enough collateralization ratio defined by loan scheme - {ratio} < 150")
+
+    def _vault(self, vaultId):
+        if vaultId not in self.vaults:
+            raise RpcError(f"Vault <{vaultId}> not found", -5)
+        return self.vaults[vaultId]
+
+    def _swap(self, symbol, tokenIn, amountIn):
+        pool = self.pools[symbol]
+        forward = symbol.startswith(tokenIn + "-")
+        poolF, poolT = (pool["reserveA"], pool["reserveB"]) if forward else (pool["reserveB"], pool["reserveA"])
+        effectiveIn = amountIn * (1 - pool["commission"])
+        out = poolT * effectiveIn / (poolF + effectiveIn)
+        if forward:
+            pool["reserveA"] += amountIn
+            pool["reserveB"] -= out
+        else:
+            pool["reserveB"] += amountIn
+            pool["reserveA"] -= out
+        return out
+
+    def _direct_route(self, tokenFrom, tokenTo):
+        for symbol in [tokenFrom + "-" + tokenTo, tokenTo + "-" + tokenFrom]:
+            if symbol in self.pools:
+                return [(symbol, tokenFrom)]
+        return None
+
+    def _route(self, tokenFrom, tokenTo):
+        # direct pool, else via DUSD or DFI (up to 3 hops), like the main pairs on chain
+        route = self._direct_route(tokenFrom, tokenTo)
+        if route is not None:
+            return route
+        for mid in ["DUSD", "DFI"]:
+            first = self._direct_route(tokenFrom, mid)
+            second = self._direct_route(mid, tokenTo)
+            if first and second:
+                return first + second
+        first = self._direct_route(tokenFrom, "DUSD") or self._direct_route(tokenFrom, "DFI")
+        last = self._direct_route("DFI", tokenTo) or self._direct_route("DUSD", tokenTo)
+        if first and last and first[0][0] != last[0][0]:
+            return first + [("DUSD-DFI", first[0][0].replace(tokenFrom, "").strip("-"))] + last
+        return None
+
+    def _composite_swap(self, data, execute):
+        amount = float(data["amountFrom"])
+        route = self._route(data["tokenFrom"], data["tokenTo"])
+        if route is None:
+            raise RpcError(f"no route from {data['tokenFrom']} to {data['tokenTo']}")
+        backup = {symbol: (self.pools[symbol]["reserveA"], self.pools[symbol]["reserveB"]) for symbol, _ in route}
+        out = amount
+        for symbol, tokenIn in route:
+            out = self._swap(symbol, tokenIn, out)
+        if not execute:
+            for symbol, (reserveA, reserveB) in backup.items():
+                self.pools[symbol]["reserveA"] = reserveA
+                self.pools[symbol]["reserveB"] = reserveB
+        if "maxPrice" in data and out > 0 and amount / out > float(data["maxPrice"]):
+            if execute:
+                for symbol, (reserveA, reserveB) in backup.items():
+                    self.pools[symbol]["reserveA"] = reserveA
+                    self.pools[symbol]["reserveB"] = reserveB
+            raise RpcError(f"Price is higher than indicated. {amount / out} > {data['maxPrice']}")
+        return out
+
+    def _next_prices(self):
+        for token in self.prices:
+            if token in ["DUSD", "USDC"]:
+                continue
+            self.prices[token] *= math.exp(self.rnd.gauss(0, self.volatility))
+
+    def mine_block(self):
+        with self.lock:
+            self.height += 1
+            self.blockHash = self._hash(self.height)
+            self.blockTimes[self.height] = time.time()
+            for txid, execute in self.mempool:
+                tx = self.txs[txid]
+                try:
+                    if any(key not in self.utxos for key in tx["vin"]):
+                        raise RpcError("bad-txns-inputs-missingorspent", -25)  # a parent was dropped
+                    execute()
+                    tx["height"] = self.height
+                    for n, (address, amount) in enumerate(tx["vout"]):
+                        if (txid, n) in self.utxos:
+                            self.utxos[(txid, n)]["height"] = self.height
+                except RpcError:
+                    self._drop(txid)
+            self.mempool = []
+            self._next_prices()
+            if self.height >= self.lastIntervalStart + self.priceInterval:
+                self.activePrices = dict(self.prices)
+                self.lastIntervalStart = self.height
+            for vault in self.vaults.values():
+                ratio = self._ratio(vault, self.activePrices)
+                if 0 <= ratio < 100:
+                    vault["state"] = "inLiquidation"
+            self.firstTxInBlock = None
+            self.callsInBlock = {}
+            self.lock.notify_all()
+
+    def _drop(self, txid):
+        # its inputs can be spent again, its outputs never existed
+        tx = self.txs[txid]
+        tx["dropped"] = True
+        for key in tx["vin"]:
+            if key in self.utxos:
+                self.utxos[key]["spent"] = False
+        for n, _ in enumerate(tx["vout"]):
+            self.utxos.pop((txid, n), None)
+
+    def _spend(self, inputs):
+        """
+        marks the inputs as spent. like defid, a tx with an unknown or already spent input is rejected
+        :return: list of keys of the inputs
+        """
+        keys = [(txIn["txid"], txIn["vout"]) for txIn in inputs]
+        for key in keys:
+            utxo = self.utxos.get(key)
+            if utxo is None or utxo["spent"]:
+                raise RpcError("bad-txns-inputs-missingorspent", -25)
+        if len(set(keys)) < len(keys):
+            raise RpcError("bad-txns-inputs-duplicate", -26)
+        for key in keys:
+            self.utxos[key]["spent"] = True
+        return keys
+
+    def _submit(self, address, inputs, execute):
+        """
+        puts a custom tx into the mempool: spends the given (or any) utxo of the address, creates the change output
+        """
+        if not inputs:
+            candidates = [key for key, utxo in self.utxos.items()
+                          if utxo["address"] == address and not utxo["spent"] and utxo["amount"] > TX_FEE]
+            if len(candidates) == 0:
+                raise RpcError("Insufficient funds")
+            inputs = [{"txid": candidates[0][0], "vout": candidates[0][1]}]
+        spent = self._spend(inputs)
+        txid = self._new_txid()
+        change = round(sum(self.utxos[key]["amount"] for key in spent) - TX_FEE, 8)
+        self.txs[txid] = {"height": None, "dropped": False, "vin": spent, "vout": [(None, 0), (address, change)]}
+        self.utxos[(txid, 1)] = {"address": address, "amount": change, "height": None, "spent": False}
+        self.mempool.append((txid, execute))
+        if self.firstTxInBlock is None:
+            self.firstTxInBlock = time.time()
+            self.reactionLatencies.append(self.firstTxInBlock - self.blockTimes[self.height])
+        return txid
+
+    # ================================ rpc methods ===================================
+
+    def pool_json(self, idx, pool):
+        result = dict(pool)
+        result["reserveA/reserveB"] = pool["reserveA"] / pool["reserveB"]
+        result["reserveB/reserveA"] = pool["reserveB"] / pool["reserveA"]
+        result["status"] = True
+        result["name"] = pool["symbol"]
+        return result
+
+    def rpc_getblockcount(self):
+        return self.height
+
+    def rpc_getbestblockhash(self):
+        return self.blockHash
+
+    def rpc_waitforblockheight(self, height, timeout=0):
+        with self.lock:
+            self.lock.wait_for(lambda: self.height >= height, timeout=timeout / 1000 if timeout > 0 else None)
+            return {"hash": self.blockHash, "height": self.height}
+
+    def rpc_listpoolpairs(self, pagination=None, verbose=True):
+        return {str(idx): self.pool_json(idx, pool) for idx, pool in enumerate(self.pools.values())}
+
+    def rpc_getpoolpair(self, symbol, verbose=True):
+        if symbol not in self.pools:
+            raise RpcError(f"Pool {symbol} not found", -5)
+        idx = list(self.pools.keys()).index(symbol)
+        return {str(idx): self.pool_json(idx, self.pools[symbol])}
+
+    def _fixed_price(self, token):
+        return {"priceFeedId": token + "/USD", "activePrice": self.activePrices[token],
+                "nextPrice": self.prices[token], "activePriceBlock": self.lastIntervalStart,
+                "nextPriceBlock": self.lastIntervalStart + self.priceInterval, "isLive": True,
+                "timestamp": int(time.time())}
+
+    def rpc_listfixedintervalprices(self, pagination=None):
+        return [self._fixed_price(token) for token in self.prices if token != "DUSD"]
+
+    def rpc_getfixedintervalprice(self, feedId):
+        token = feedId.split("/")[0]
+        if token not in self.prices:
+            raise RpcError(f"fixedIntervalPrice with id <{feedId}> not found", -5)
+        result = self._fixed_price(token)
+        result["fixedIntervalPriceId"] = result.pop("priceFeedId")
+        return result
+
+    def rpc_listprices(self, pagination=None):
+        return [{"token": token, "currency": "USD", "price": price, "ok": True}
+                for token, price in self.prices.items() if token != "DUSD"]
+
+    def rpc_getloaninfo(self):
+        return {"currentPriceBlock": self.lastIntervalStart,
+                "nextPriceBlock": self.lastIntervalStart + self.priceInterval,
+                "totals": {"vaults": len(self.vaults)}}
+
+    def rpc_getloanscheme(self, schemeId):
+        if schemeId != "MIN150":
+            raise RpcError(f"Cannot find existing loan scheme with id {schemeId}", -8)
+        return {"id": "MIN150", "mincolratio": MIN_COLLATERAL_RATIO, "interestrate": 0}
+
+    def rpc_listloanschemes(self):
+        return [{"id": "MIN150", "mincolratio": MIN_COLLATERAL_RATIO, "interestrate": 0, "default": True}]
+
+    def rpc_listcollateraltokens(self):
+        return [{"token": token, "tokenId": str(idx), "factor": factor, "fixedIntervalPriceId": token + "/USD"}
+                for idx, (token, factor) in enumerate(COLLATERAL_FACTORS.items())]
+
+    def rpc_getvault(self, vaultId, verbose=False):
+        vault = self._vault(vaultId)
+        collateral, loan = self._vault_values(vault, self.activePrices)
+        return {"vaultId": vaultId, "loanSchemeId": "MIN150", "ownerAddress": vault["owner"],
+                "state": vault["state"],
+                "collateralAmounts": ["%.8f@%s" % (amount, token) for token, amount in vault["collateral"].items()],
+                "loanAmounts": ["%.8f@%s" % (amount, token) for token, amount in vault["loans"].items()],
+                "interestAmounts": [],
+                "collateralValue": collateral, "loanValue": loan, "interestValue": 0,
+                "collateralRatio": self._ratio(vault, self.activePrices),
+                "nextCollateralRatio": self._ratio(vault, self.prices),
+                "informativeRatio": 100 * collateral / loan if loan > 0 else -1}
+
+    def rpc_listvaults(self, options=None, pagination=None):
+        pagination = pagination or {}
+        vaultIds = sorted(self.vaults.keys())
+        if "start" in pagination:
+            start = pagination["start"]
+            includingStart = pagination.get("including_start", False)
+            vaultIds = [v for v in vaultIds if v > start or (includingStart and v == start)]
+        vaultIds = vaultIds[:pagination.get("limit", 100)]
+        return [{"vaultId": vaultId, "ownerAddress": self.vaults[vaultId]["owner"], "loanSchemeId": "MIN150",
+                 "state": self.vaults[vaultId]["state"]} for vaultId in vaultIds]
+
+    def rpc_getaccount(self, address, pagination=None, indexed=False):
+        return ["%.8f@%s" % (amount, token) for token, amount in self.accounts.get(address, {}).items()]
+
+    def rpc_listunspent(self, minconf=1, maxconf=9999999, addresses=None, includeUnsafe=True, query=None):
+        minimumAmount = (query or {}).get("minimumAmount", 0)
+        result = []
+        for (txid, vout), utxo in self.utxos.items():
+            confirmations = self.height - utxo["height"] + 1 if utxo["height"] is not None else 0
+            if utxo["spent"] or confirmations < minconf or confirmations > maxconf or utxo["amount"] < minimumAmount:
+                continue
+            if addresses and utxo["address"] not in addresses:
+                continue
+            result.append({"txid": txid, "vout": vout, "address": utxo["address"], "amount": utxo["amount"],
+                           "confirmations": confirmations, "spendable": True})
+        return result
+
+    def rpc_gettransaction(self, txid, includeWatchonly=False):
+        if txid not in self.txs:
+            raise RpcError("Invalid or non-wallet transaction id", -5)
+        tx = self.txs[txid]
+        result = {"txid": txid, "amount": 0, "fee": -TX_FEE}
+        if tx["dropped"]:
+            result["confirmations"] = -1
+        elif tx["height"] is None:
+            result["confirmations"] = 0
+        else:
+            result["confirmations"] = self.height - tx["height"] + 1
+            result["blockhash"] = self._hash(tx["height"])
+            result["blockheight"] = tx["height"]
+        return result
+
+    def rpc_getrawtransaction(self, txid, verbose=False):
+        if txid not in self.txs:
+            raise RpcError("No such mempool or blockchain transaction", -5)
+        vout = []
+        for n, (address, amount) in enumerate(self.txs[txid]["vout"]):
+            vout.append({"n": n, "value": amount,
+                         "scriptPubKey": {"addresses": [address]} if address is not None else {"type": "nulldata"}})
+        return {"txid": txid, "vout": vout}
+
+    def rpc_removeprunedfunds(self, txid):
+        return None
+
+    # raw txs (utxo only, used to split utxos). the "hex" is just the json of the tx
+
+    @staticmethod
+    def _encode(tx):
+        return json.dumps(tx).encode().hex()
+
+    @staticmethod
+    def _decode(hexString):
+        return json.loads(bytes.fromhex(hexString).decode())
+
+    def rpc_createrawtransaction(self, inputs, outputs, locktime=0):
+        vout = []
+        for output in outputs if isinstance(outputs, list) else [{k: v} for k, v in outputs.items()]:
+            for address, amount in output.items():
+                vout.append([address, float(amount)])
+        return self._encode({"vin": [[txIn["txid"], txIn["vout"]] for txIn in inputs], "vout": vout})
+
+    def rpc_fundrawtransaction(self, hexString, options=None):
+        options = options or {}
+        tx = self._decode(hexString)
+        inputAmount = 0
+        for txid, n in tx["vin"]:
+            utxo = self.utxos.get((txid, n))
+            if utxo is None or utxo["spent"]:
+                raise RpcError("Insufficient funds", -4)
+            inputAmount += utxo["amount"]
+        change = round(inputAmount - sum(amount for _, amount in tx["vout"]) - TX_FEE, 8)
+        if change < 0:
+            raise RpcError("Insufficient funds", -4)
+        position = options.get("changePosition", len(tx["vout"]))
+        tx["vout"].insert(position, [options.get("changeAddress", "simchange"), change])
+        return {"hex": self._encode(tx), "fee": TX_FEE, "changepos": position}
+
+    def rpc_signrawtransactionwithwallet(self, hexString):
+        return {"hex": hexString, "complete": True}
+
+    def rpc_sendrawtransaction(self, hexString, maxfeerate=None):
+        tx = self._decode(hexString)
+        spent = self._spend([{"txid": txid, "vout": n} for txid, n in tx["vin"]])
+        txid = self._new_txid()
+        self.txs[txid] = {"height": None, "dropped": False, "vin": spent, "vout": [tuple(out) for out in tx["vout"]]}
+        for n, (address, amount) in enumerate(tx["vout"]):
+            self.utxos[(txid, n)] = {"address": address, "amount": amount, "height": None, "spent": False}
+        self.mempool.append((txid, lambda: None))
+        return txid
+
+    def rpc_takeloan(self, data, inputs=None):
+        vault = self._vault(data["vaultId"])
+        amounts = [parse_amount(a) for a in (data["amounts"] if isinstance(data["amounts"], list) else [data["amounts"]])]
+
+        def execute():
+            for amount, token in amounts:
+                vault["loans"][token] = vault["loans"].get(token, 0) + amount
+            try:
+                self._check_vault(vault)
+            except RpcError:
+                for amount, token in amounts:
+                    vault["loans"][token] -= amount
+                raise
+            for amount, token in amounts:
+                self._credit(data["to"], token, amount)
+
+        return self._submit(vault["owner"], inputs, execute)
+
+    def rpc_paybackloan(self, data, inputs=None):
+        vault = self._vault(data["vaultId"])
+        amounts = [parse_amount(a) for a in (data["amounts"] if isinstance(data["amounts"], list) else [data["amounts"]])]
+
+        def execute():
+            for amount, token in amounts:
+                if token not in vault["loans"]:
+                    raise RpcError(f"There is no loan on token ({token}) in this vault!")
+            for amount, token in amounts:
+                self._debit(data["from"], token, amount)
+                vault["loans"][token] = max(0, vault["loans"][token] - amount)
+                if vault["loans"][token] <= 1e-12:
+                    del vault["loans"][token]
+
+        return self._submit(data["from"], inputs, execute)
+
+    def rpc_deposittovault(self, vaultId, address, amount, inputs=None):
+        vault = self._vault(vaultId)
+        value, token = parse_amount(amount)
+
+        def execute():
+            self._debit(address, token, value)
+            vault["collateral"][token] = vault["collateral"].get(token, 0) + value
+
+        return self._submit(address, inputs, execute)
+
+    def rpc_withdrawfromvault(self, vaultId, address, amount, inputs=None):
+        vault = self._vault(vaultId)
+        value, token = parse_amount(amount)
+
+        def execute():
+            if vault["collateral"].get(token, 0) < value - 1e-9:
+                raise RpcError(f"Collateral for vault <{vaultId}> not found or not enough")
+            vault["collateral"][token] -= value
+            try:
+                self._check_vault(vault)
+            except RpcError:
+                vault["collateral"][token] += value
+                raise
+            self._credit(address, token, value)
+
+        return self._submit(vault["owner"], inputs, execute)
+
+    def rpc_addpoolliquidity(self, fromData, shareAddress, inputs=None):
+        [(address, amounts)] = list(fromData.items())
+        amounts = dict((token, value) for value, token in [parse_amount(a) for a in amounts])
+
+        def execute():
+            symbol = [s for s in self.pools if set(s.split("-")) == set(amounts.keys())]
+            if len(symbol) == 0:
+                raise RpcError("there is no such pool pair")
+            pool = self.pools[symbol[0]]
+            tokenA, tokenB = symbol[0].split("-")
+            for token, value in amounts.items():
+                self._debit(address, token, value)
+            liquidity = min(amounts[tokenA] * pool["totalLiquidity"] / pool["reserveA"],
+                            amounts[tokenB] * pool["totalLiquidity"] / pool["reserveB"])
+            pool["reserveA"] += amounts[tokenA]
+            pool["reserveB"] += amounts[tokenB]
+            pool["totalLiquidity"] += liquidity
+            self._credit(shareAddress, symbol[0], liquidity)
+
+        return self._submit(address, inputs, execute)
+
+    def rpc_removepoolliquidity(self, address, amount, inputs=None):
+        value, symbol = parse_amount(amount)
+        if symbol not in self.pools:
+            raise RpcError("there is no such pool pair")
+        pool = self.pools[symbol]
+
+        def execute():
+            self._debit(address, symbol, value)
+            share = value / pool["totalLiquidity"]
+            tokenA, tokenB = symbol.split("-")
+            amountA = pool["reserveA"] * share
+            amountB = pool["reserveB"] * share
+            pool["reserveA"] -= amountA
+            pool["reserveB"] -= amountB
+            pool["totalLiquidity"] -= value
+            self._credit(address, tokenA, amountA)
+            self._credit(address, tokenB, amountB)
+
+        return self._submit(address, inputs, execute)
+
+    def rpc_compositeswap(self, data, inputs=None):
+        def execute():
+            self._debit(data["from"], data["tokenFrom"], float(data["amountFrom"]))
+            try:
+                out = self._composite_swap(data, True)
+            except RpcError:
+                self._credit(data["from"], data["tokenFrom"], float(data["amountFrom"]))
+                raise
+            self._credit(data["to"], data["tokenTo"], out)
+
+        self._composite_swap(data, False)  # fail early like the node does
+        return self._submit(data["from"], inputs, execute)
+
+    def rpc_testpoolswap(self, data, path="direct", verbose=False):
+        out = self._composite_swap(data, False)
+        amount = "%.8f@%s" % (out, TOKEN_IDS[data["tokenTo"]])
+        if not verbose:
+            return amount
+        symbols = list(self.pools.keys())
+        return {"path": path, "pools": [str(symbols.index(symbol)) for symbol, _ in
+                                        self._route(data["tokenFrom"], data["tokenTo"])], "amount": amount}
+
+    def rpc_getsimstats(self):
+        latencies = self.reactionLatencies
+        return {"height": self.height,
+                "calls": dict(self.callCounts),
+                "callsThisBlock": dict(self.callsInBlock),
+                "totalCalls": sum(self.callCounts.values()),
+                "reactions": len(latencies),
+                "avgReactionLatency": sum(latencies) / len(latencies) if latencies else None}
+
+    def call(self, method, params):
+        self.callCounts[method] = self.callCounts.get(method, 0) + 1
+        self.callsInBlock[method] = self.callsInBlock.get(method, 0) + 1
+        fn = getattr(self, "rpc_" + method, None)
+        if fn is None:
+            raise RpcError("Method not found", -32601)
+        if method == "waitforblockheight":
+            return fn(*params)  # waits on the lock itself
+        with self.lock:
+            try:
+                return fn(*params)
+            except (TypeError, KeyError, ValueError) as e:
+                raise RpcError(f"invalid params for {method}: {str(e)}", -8)
+
+
+def make_handler(chain, latency):
+    class Handler(BaseHTTPRequestHandler):
+        def _answer(self, request):
+            try:
+                return {"result": chain.call(request["method"], request.get("params", [])), "error": None,
+                        "id": request.get("id")}, 200
+            except RpcError as e:
+                return {"result": None, "error": {"code": e.code, "message": str(e)}, "id": request.get("id")}, 500
+
+        def do_POST(self):
+            if latency > 0:
+                time.sleep(latency)
+            request = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+            if isinstance(request, list):
+                response = [self._answer(r)[0] for r in request]
+                status = 200
+            else:
+                response, status = self._answer(request)
+            body = json.dumps(response).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+
+def default_chain(seed):
+    chain = SimChain(seed)
+    chain.add_address("simaddress", {"DFI": 100.0, "TSLA-DUSD": 1000.0, "USDC": 10000.0})
+    chain.add_vault("simvault", "simaddress", {"DFI": 20000.0}, {"TSLA": 50.0, "DUSD": 10300.0})
+    return chain
+
+
+def add_random_vaults(chain, count, seed):
+    # vaults of other users with ratios between 150% and ~500%
+    rnd = random.Random(seed)
+    for idx in range(count):
+        collateral = {"DFI": rnd.uniform(100, 50000)}
+        if rnd.random() < 0.3:
+            collateral["DUSD"] = rnd.uniform(100, 20000)
+        collateralValue = sum(amount * chain.prices[token] * COLLATERAL_FACTORS[token]
+                              for token, amount in collateral.items())
+        loanValue = collateralValue / rnd.uniform(1.55, 5)
+        token = rnd.choice(["TSLA", "SPY", "GME", "DUSD"])
+        loans = {token: loanValue / chain.prices[token]} if rnd.random() < 0.9 else {}
+        chain.add_vault(hashlib.sha256(b"simvault%d-%d" % (seed, idx)).hexdigest(), "other%d" % (idx % 1000),
+                        collateral, loans)
+
+
+def mine(chain, blockTime, stop):
+    while not stop.wait(blockTime):
+        chain.mine_block()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="simulated defid json-rpc server")
+    parser.add_argument("--port", type=int, default=8555)
+    parser.add_argument("--blocktime", type=float, default=30.0, help="seconds per block")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds added to every request")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--vaults", type=int, default=0, help="additional random vaults of other users")
+    args = parser.parse_args()
+
+    chain = default_chain(args.seed)
+    add_random_vaults(chain, args.vaults, args.seed)
+    server = ThreadingHTTPServer(("127.0.0.1", args.port), make_handler(chain, args.latency))
+    stop = threading.Event()
+    threading.Thread(target=mine, args=(chain, args.blocktime, stop), daemon=True).start()
+    print(f"simulated node on http://127.0.0.1:{args.port}/ block every {args.blocktime}s")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        stop.set()
+        print(json.dumps(chain.rpc_getsimstats(), indent=2))
@@ -0,0 +1,116 @@
+'''
+the decisions of DFIVaultMaxi without any rpc calls: when to reduce or increase the exposure, by how much
+and which amounts to remove/add/borrow. only plain numbers go in and out, so the same code runs on the node
+(DFIVaultMaxi.processBlock) and offline in the backtest (backtest.py).
+
+ratios are in % like the node reports them (collateralRatio 180), targetCollateral is a factor (1.8).
+'''
+
+NOTHING = 0
+REDUCE = 1
+INCREASE = 2
+
+DUSD_COLLATERAL_FACTOR = 0.99  # DUSD only counts 0.99 as collateral
+
+
+def target_collateral(minCollateralRatio, maxCollateralRatio):
+    return (minCollateralRatio + maxCollateralRatio) / 200
+
+
+def is_single_mint(mainCollateralAsset, lmPair):
+    return mainCollateralAsset == "DUSD" or lmPair == "DUSD-DFI"
+
+
+def needed_repay(loanValue, collateralValue, nextCollateralRatio, targetCollateral):
+    # not calculating nextLoanValue and nextCollateralValue here, assuming that coll will move more -> approx nextColl via nextRatio and current loan
+    return max(loanValue - (collateralValue / targetCollateral),
+               loanValue - (loanValue * nextCollateralRatio / (100 * targetCollateral)))
+
+
+def additional_loan(loanValue, collateralValue, nextCollateralRatio, targetCollateral):
+    additionalLoan = (collateralValue / targetCollateral) - loanValue
+    if nextCollateralRatio > 0:
+        additionalLoan = min(additionalLoan,
+                             (loanValue * nextCollateralRatio / (100 * targetCollateral)) - loanValue)
+    return additionalLoan
+
+
+def decide(collateralRatio, nextCollateralRatio, collateralValue, loanValue,
+           minCollateralRatio, maxCollateralRatio, targetCollateral):
+    """
+    :return: [action, usdAmount] action is NOTHING, REDUCE (repay usdAmount) or INCREASE (loan usdAmount)
+    """
+    ratio = min(collateralRatio, nextCollateralRatio)
+    if 0 < ratio < minCollateralRatio:
+        neededrepay = needed_repay(loanValue, collateralValue, nextCollateralRatio, targetCollateral)
+        return [REDUCE, max(neededrepay, loanValue * 0.01)]
+    if maxCollateralRatio > 0 and (ratio < 0 or ratio > maxCollateralRatio) and collateralValue > 10:
+        return [INCREASE, additional_loan(loanValue, collateralValue, nextCollateralRatio, targetCollateral)]
+    return [NOTHING, 0]
+
+
+def projected_ratio(collaterals, loans, prices, collateralFactors=None):
+    """
+    collateral ratio with the given prices, f.e. the live prices that become the next oracle price at nextPriceBlock
+    :param collaterals: token -> amount in the vault
+    :param loans: token -> amount in the vault
+    :param prices: token -> USD price
+    :param collateralFactors: token -> factor, 1 if missing (DUSD_COLLATERAL_FACTOR for DUSD)
+    :return: ratio in %, -1 without loans, None if a price is missing
+    """
+    collateralFactors = collateralFactors or {"DUSD": DUSD_COLLATERAL_FACTOR}
+    collateralValue = 0
+    for token, amount in collaterals.items():
+        if token not in prices:
+            return None
+        collateralValue += amount * prices[token] * collateralFactors.get(token, 1)
+    loanValue = 0
+    for token, amount in loans.items():
+        if token not in prices:
+            return None
+        loanValue += amount * prices[token]
+    if loanValue <= 0:
+        return -1
+    return 100 * collateralValue / loanValue
+
+
+def reduce_double_mint(neededrepay, oracleA, reserveA, reserveB, totalLiquidity, lpTokens):
+    """
+    :return: [lp tokens to remove, amount of assetA to pay back, amount of assetB to pay back]
+    """
+    neededStock = neededrepay / (oracleA + reserveB / reserveA)
+    removeTokens = min(neededStock * totalLiquidity / reserveA, lpTokens)
+    return [removeTokens, neededStock, reserveB / reserveA * neededStock]
+
+
+def reduce_single_mint(neededrepay, wantedRatio, oracleA, oracleB, reserveA, reserveB, totalLiquidity, lpTokens):
+    """
+    pays back assetA and deposits assetB as collateral
+    :param oracleB: collateral value of assetB (DUSD_COLLATERAL_FACTOR for DUSD)
+    :return: [lp tokens to remove, expected assetA (payback), expected assetB (deposit)]
+    """
+    neededcollateral = neededrepay * wantedRatio  # I did the calc this way around, so convert it
+    ratioPart = (reserveA * oracleA * wantedRatio + reserveB * oracleB) / totalLiquidity
+    removeTokens = min(neededcollateral / ratioPart, lpTokens)
+    return [removeTokens, removeTokens * reserveA / totalLiquidity, removeTokens * reserveB / totalLiquidity]
+
+
+def increase_double_mint(additionalLoan, oracleA, reserveA, reserveB):
+    """
+    :return: [loan of assetA, loan of assetB], both go into the pool
+    """
+    neededStock = additionalLoan / (oracleA + reserveB / reserveA)
+    return [neededStock, reserveB / reserveA * neededStock]
+
+
+def increase_single_mint(additionalLoan, wantedRatio, oracleA, oracleB, reserveA, reserveB):
+    """
+    :return: [loan of assetA, assetB to withdraw from the vault], both go into the pool
+    """
+    freeCollateral = additionalLoan * wantedRatio  # I did the calc this way around, so convert it
+    usedAssetA = freeCollateral / (wantedRatio * oracleA + reserveB / reserveA * oracleB)
+    return [usedAssetA, reserveB / reserveA * usedAssetA]
+
+
+def should_reinvest(dfiBalance, minReinvest):
+    return minReinvest is not None and dfiBalance > minReinvest
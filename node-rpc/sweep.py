@@ -0,0 +1,149 @@
+import argparse
+import csv
+import itertools
+import json
+import os
+import random
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import backtest
+
+'''
+runs the backtest for many combinations of minCollateralRatio, maxCollateralRatio, lmPair, mainCollateralAsset
+and minReinvest in a process pool and ranks them by risk adjusted yield:
+
+  yield: rewards minus fees and interest per year, relative to the start value of the vault
+  score: yield, reduced linearly if the lowest ratio got closer than --safety (0.1 = 10%) to the liquidation ratio.
+         liquidated runs get -1
+
+the best combinations are written as ready to use settings files (node/vault/telegram settings from --base),
+all results go to results.csv in the output folder.
+
+usage:
+  python sweep.py --base settings.json --pairs TSLA-DUSD DUSD-DFI --history TSLA-DUSD=tsla.npz
+  python sweep.py --pairs TSLA-DUSD --min 160:300:5 --width 5:60:5 --random 2000
+pairs without --history use a synthetic year (backtest.synthetic_history).
+'''
+
+LIQUIDATION_RATIO = 150
+
+_histories = {}  # lmPair -> History, loaded once per worker process
+
+
+def _init_worker(historyPaths, pairs, seed):
+    for idx, pair in enumerate(pairs):
+        if pair in historyPaths:
+            _histories[pair] = backtest.History.load(historyPaths[pair])
+        else:
+            _histories[pair] = backtest.synthetic_history(seed=seed + idx, lmPair=pair)
+
+
+def _run_combination(combination):
+    settings, initialCollateral, safety = combination
+    result = backtest.run(_histories[settings['lmPair']], settings, initialCollateral=initialCollateral,
+                          liquidationRatio=LIQUIDATION_RATIO)
+    years = result['blocks'] / backtest.BLOCKS_PER_YEAR
+    profit = result['rewardsUSD'] - result['feesUSD'] - result['interestUSD']
+    result['yield'] = profit / result['startValueUSD'] / years if years > 0 else 0
+    if result['liquidatedAt'] is not None:
+        result['score'] = -1
+    elif result['minCollateralRatio'] is None:
+        result['score'] = 0  # never took a loan
+    else:
+        buffer = (result['minCollateralRatio'] - LIQUIDATION_RATIO) / LIQUIDATION_RATIO
+        result['score'] = result['yield'] * min(1, buffer / safety)
+    return settings, result
+
+
+def parse_range(text):
+    """
+    "160:250:5" -> [160, 165, ... 250], "160,170" -> [160, 170]
+    """
+    if ":" in text:
+        start, stop, step = [float(x) for x in text.split(":")]
+        values = []
+        while start <= stop + 1e-9:
+            values.append(int(start) if start == int(start) else start)
+            start += step
+        return values
+    return [float(x) if "." in x else int(x) for x in text.split(",")]
+
+
+def combinations(pairs, mins, widths, collaterals, reinvests, randomCount=0, seed=0):
+    grid = []
+    for pair, minRatio, width, collateral, reinvest in itertools.product(pairs, mins, widths, collaterals, reinvests):
+        if collateral != "DFI" and pair.split("-")[1] != collateral:
+            continue  # the bot would fall back to DFI, same as the DFI combination
+        grid.append({"lmPair": pair, "minCollateralRatio": minRatio, "maxCollateralRatio": minRatio + width,
+                     "mainCollateralAsset": collateral, "minReinvest": reinvest})
+    if 0 < randomCount < len(grid):
+        grid = random.Random(seed).sample(grid, randomCount)
+    return grid
+
+
+def sweep(grid, historyPaths, initialCollateral=1000.0, safety=0.1, workers=None, seed=42):
+    pairs = sorted(set(settings['lmPair'] for settings in grid))
+    jobs = [(settings, initialCollateral, safety) for settings in grid]
+    workers = workers or os.cpu_count()
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                             initargs=(historyPaths, pairs, seed)) as executor:
+        results = list(executor.map(_run_combination, jobs, chunksize=max(1, len(jobs) // (workers * 8))))
+    return sorted(results, key=lambda entry: -entry[1]['score'])
+
+
+def write_results(results, outDir, baseSettings, top):
+    os.makedirs(outDir, exist_ok=True)
+    keys = ["lmPair", "minCollateralRatio", "maxCollateralRatio", "mainCollateralAsset", "minReinvest"]
+    resultKeys = ["score", "yield", "rewardsUSD", "feesUSD", "interestUSD", "reduces", "increases", "reinvests",
+                  "minCollateralRatio", "liquidatedAt"]
+    with open(os.path.join(outDir, "results.csv"), "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["rank"] + keys + ["result_" + key for key in resultKeys])
+        for rank, (settings, result) in enumerate(results, 1):
+            writer.writerow([rank] + [settings[key] for key in keys] + [result[key] for key in resultKeys])
+    for rank, (settings, result) in enumerate(results[:top], 1):
+        data = dict(baseSettings)
+        data.update({key: settings[key] for key in keys if settings[key] is not None})
+        if settings['minReinvest'] is None:
+            data.pop("minReinvest", None)
+        with open(os.path.join(outDir, "settings_%d.json" % rank), "w") as f:
+            json.dump(data, f, indent=2)
+
+
+def reinvest_value(text):
+    return None if text.lower() == "none" else float(text)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="parameter sweep of the vault maxi settings over historic blocks")
+    parser.add_argument("--base", help="settings.json to take node, vault and telegram settings from")
+    parser.add_argument("--pairs", nargs="+", default=["TSLA-DUSD"])
+    parser.add_argument("--history", nargs="*", default=[], help="lmPair=path.npz|path.csv")
+    parser.add_argument("--min", default="160:300:10", help="minCollateralRatio values, start:stop:step or list")
+    parser.add_argument("--width", default="5:50:5", help="maxCollateralRatio - minCollateralRatio")
+    parser.add_argument("--collateral", nargs="+", default=["DFI", "DUSD"])
+    parser.add_argument("--reinvest", nargs="+", default=["none", "1", "5", "20"], type=str)
+    parser.add_argument("--random", type=int, default=0, help="sample this many combinations of the grid")
+    parser.add_argument("--capital", type=float, default=1000.0, help="initial amount of mainCollateralAsset")
+    parser.add_argument("--safety", type=float, default=0.1)
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--top", type=int, default=10)
+    parser.add_argument("--out", default="sweep")
+    args = parser.parse_args()
+
+    baseSettings = {}
+    if args.base is not None:
+        with open(args.base) as f:
+            baseSettings = json.load(f)
+    historyPaths = dict(entry.split("=", 1) for entry in args.history)
+    grid = combinations(args.pairs, parse_range(args.min), parse_range(args.width), args.collateral,
+                        [reinvest_value(value) for value in args.reinvest], args.random)
+    print(f"running {len(grid)} combinations")
+    start = time.perf_counter()
+    results = sweep(grid, historyPaths, args.capital, args.safety, args.workers)
+    print(f"done in {time.perf_counter() - start:.1f} s")
+    write_results(results, args.out, baseSettings, args.top)
+    for rank, (settings, result) in enumerate(results[:args.top], 1):
+        print(f"{rank}: score {result['score']:.4f} yield {result['yield']:.4f} "
+              f"lowest ratio {result['minCollateralRatio']} {settings}")
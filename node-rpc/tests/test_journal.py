@@ -0,0 +1,212 @@
+import json
+
+import pytest
+
+import journal
+import utils
+from DFIVaultMaxi import VaultMaxi, plan_result
+from tokenamount import Amount
+
+
+def test_torn_last_line_is_cut(tmp_path):
+    path = str(tmp_path / "vault.journal")
+    j = journal.Journal(path)
+    planId = j.begin("reduceDoubleMint", {"removeTokens": 1}, 100)
+    j.sent(planId, "removepoolliquidity", "tx1")
+    j.close()
+    size = (tmp_path / "vault.journal").stat().st_size
+    with open(path, "a") as f:
+        f.write('{"type": "sent", "plan": 1, "step": "paybackloan", "tx')
+
+    j = journal.Journal(path)
+    assert (tmp_path / "vault.journal").stat().st_size == size
+    assert j.open_plans()[0]['steps'] == [["removepoolliquidity", "tx1"]]
+    j.end(planId)
+    j.close()
+    assert journal.Journal(path).open_plans() == []
+
+
+def test_complete_record_without_newline_is_cut(tmp_path):
+    path = str(tmp_path / "vault.journal")
+    j = journal.Journal(path)
+    planId = j.begin("increaseDoubleMint", {}, 100)
+    j.close()
+    with open(path, "a") as f:
+        f.write(json.dumps({"type": "end", "plan": planId, "result": "done"}))
+
+    j = journal.Journal(path)
+    assert [plan['id'] for plan in j.open_plans()] == [planId]
+    j.sent(planId, "takeloan", "tx1")
+    j.close()
+    assert journal.Journal(path).open_plans()[0]['steps'] == [["takeloan", "tx1"]]
+
+
+def test_compaction_keeps_open_plans_and_state(tmp_path, monkeypatch):
+    monkeypatch.setattr(journal, "COMPACT_RECORDS", 10)
+    path = str(tmp_path / "vault.journal")
+    j = journal.Journal(path)
+    j.set_state(lastBlockSettingsLogged=5)
+    openId = j.begin("reduceSingleMint", {"assetA": 1}, 10)
+    j.sent(openId, "removepoolliquidity", "txOpen")
+    for idx in range(6):
+        planId = j.begin("increaseDoubleMint", {}, 11 + idx)
+        j.sent(planId, "takeloan", "tx%d" % idx)
+        j.end(planId)
+    j.set_state(lastBlockSettingsLogged=20)
+    j.close()
+
+    with open(path) as f:
+        records = [json.loads(line) for line in f]
+    assert len(records) < 10
+    assert {record['plan'] for record in records if 'plan' in record} == {openId}
+
+    j = journal.Journal(path)
+    assert j.state == {"lastBlockSettingsLogged": 20}
+    plans = j.open_plans()
+    assert [(plan['id'], plan['kind'], plan['height']) for plan in plans] == [(openId, "reduceSingleMint", 10)]
+    assert plans[0]['steps'] == [["removepoolliquidity", "txOpen"]]
+
+
+def test_plan_result():
+    assert plan_result("reduceDoubleMint", []) == "aborted"
+    assert plan_result("reduceDoubleMint", ["removepoolliquidity", "paybackloan"]) == "done"
+    assert plan_result("increaseSingleMint", ["takeloan", "paybackloan"]) == "rolledBack"
+    assert plan_result("increaseDoubleMint", ["takeloan", "addpoolliquidity"]) == "done"
+
+
+class FakeSnapshot:
+    def __init__(self, amounts, pool=None):
+        self.amounts = {token: Amount.of(value, token) for token, value in amounts.items()}
+        self.poolData = pool
+        self.height = 905
+
+    def account_amounts(self, address):
+        return dict(self.amounts)
+
+    def pool(self, pair):
+        return self.poolData
+
+
+@pytest.fixture
+def vault(tmp_path, monkeypatch):
+    settingsPath = tmp_path / "settings.json"
+    settingsPath.write_text(json.dumps({"NODE_USER": "user", "NODE_PASSWORD": "password", "vaultId": "vault",
+                                        "address": "address", "lmPair": "TSLA-DUSD", "logToConsole": False}))
+    vaultMaxi = VaultMaxi(str(settingsPath))
+    vaultMaxi.sent = []
+
+    def sendTx(method, params, txInput=None):
+        vaultMaxi.sent.append((method, params, txInput))
+        return "tx%d" % len(vaultMaxi.sent)
+
+    monkeypatch.setattr(vaultMaxi, "sendTx", sendTx)
+    monkeypatch.setattr(vaultMaxi, "send_telegram", lambda message: None)
+    monkeypatch.setattr(utils, "get_tx_input", lambda address: ["fresh"])
+    monkeypatch.setattr(utils, "get_chained_tx_input", lambda txId, address: ["change of " + txId])
+    yield vaultMaxi
+    vaultMaxi.journal.close()
+
+
+def plan(vaultMaxi, kind, assetA, assetB, balanceA=0, balanceB=0):
+    vaultMaxi.journal.begin(kind, {"assetA": assetA, "assetB": assetB,
+                                   "balances": {"TSLA": balanceA, "DUSD": balanceB}}, 900)
+    return vaultMaxi.journal.open_plans()[-1]
+
+
+def test_finish_nothing_loose(vault):
+    result = vault.finishPlan(plan(vault, "reduceDoubleMint", 1, 100, 2, 5), FakeSnapshot({"TSLA": 2, "DUSD": 5}))
+    assert result == "nothing"
+    assert vault.sent == []
+
+
+def test_finish_reduce_double_mint_pays_back_capped_at_plan(vault):
+    result = vault.finishPlan(plan(vault, "reduceDoubleMint", 1, 100, 2, 5), FakeSnapshot({"TSLA": 5, "DUSD": 50}))
+    assert result == "done"
+    assert vault.sent == [("paybackloan", [{"vaultId": "vault", "from": "address",
+                                            "amounts": ["1.00000000@TSLA", "45.00000000@DUSD"]}], ["fresh"])]
+
+
+def test_finish_reduce_single_mint_chains_deposit(vault):
+    result = vault.finishPlan(plan(vault, "reduceSingleMint", 1, 100), FakeSnapshot({"TSLA": 0.5, "DUSD": 100}))
+    assert result == "done"
+    assert [(method, txInput) for method, params, txInput in vault.sent] == \
+           [("paybackloan", ["fresh"]), ("deposittovault", ["change of tx1"])]
+    assert vault.sent[1][1] == ["vault", "address", "100.00000000@DUSD"]
+    assert [step for step, txId in vault.journal.open_plans()[-1]['steps']] == ["paybackloan", "deposittovault"]
+
+
+def test_finish_increase_single_mint_without_collateral_rolls_back(vault):
+    result = vault.finishPlan(plan(vault, "increaseSingleMint", 1, 100), FakeSnapshot({"TSLA": 1}))
+    assert result == "rolledBack"
+    assert vault.sent[0][0] == "paybackloan"
+    assert vault.sent[0][1][0]["amounts"] == ["1.00000000@TSLA"]
+
+
+def test_finish_increase_adds_in_pool_ratio(vault):
+    pool = {"reserveA": 100, "reserveB": 20000, "totalLiquidity": 1000}
+    result = vault.finishPlan(plan(vault, "increaseDoubleMint", 1, 300), FakeSnapshot({"TSLA": 1, "DUSD": 300}, pool))
+    assert result == "done"
+    method, params, txInput = vault.sent[0]
+    assert method == "addpoolliquidity"
+    assert params == [{"address": ["1.00000000@TSLA", "200.00000000@DUSD"]}, "address"]
+
+
+def test_finish_rejected_tx_fails(vault, monkeypatch):
+    monkeypatch.setattr(vault, "sendTx", lambda method, params, txInput=None: None)
+    result = vault.finishPlan(plan(vault, "reduceDoubleMint", 1, 100), FakeSnapshot({"TSLA": 1}))
+    assert result == "failed"
+    assert vault.journal.open_plans()[-1]['steps'] == [["paybackloan", None]]
+
+
+def test_resume_waits_for_pending_steps(vault, monkeypatch):
+    vault.journal.sent(plan(vault, "reduceDoubleMint", 1, 100)['id'], "removepoolliquidity", "txPending")
+    monkeypatch.setattr(utils, "tx_states", lambda txIds: {txId: utils.TX_PENDING for txId in txIds})
+    assert vault.resumePlans(FakeSnapshot({"TSLA": 1}))
+    assert vault.sent == []
+    assert len(vault.journal.open_plans()) == 1
+
+
+def test_resume_ends_plan_without_loose_tokens(vault, monkeypatch):
+    planId = plan(vault, "reduceDoubleMint", 1, 100)['id']
+    vault.journal.sent(planId, "removepoolliquidity", "txRemove")
+    vault.journal.sent(planId, "paybackloan", "txPayback")
+    monkeypatch.setattr(utils, "tx_states", lambda txIds: {txId: utils.TX_CONFIRMED for txId in txIds})
+    assert not vault.resumePlans(FakeSnapshot({}))
+    assert vault.sent == []
+    assert vault.journal.open_plans() == []
+
+
+def test_resume_finishes_dropped_payback_in_the_same_block(vault, monkeypatch):
+    planId = plan(vault, "reduceDoubleMint", 1, 100)['id']
+    vault.journal.sent(planId, "removepoolliquidity", "txRemove")
+    vault.journal.sent(planId, "paybackloan", "txPayback")
+    monkeypatch.setattr(utils, "tx_states", lambda txIds: {"txRemove": utils.TX_CONFIRMED,
+                                                             "txPayback": utils.TX_FAILED})
+    assert vault.resumePlans(FakeSnapshot({"TSLA": 1, "DUSD": 100}))
+    assert [method for method, params, txInput in vault.sent] == ["paybackloan"]
+    assert vault.journal.open_plans()[0]['steps'][-1] == ["paybackloan", "tx1"]
+
+
+def test_resume_gives_up_on_stuck_plans(vault, monkeypatch):
+    planId = plan(vault, "reduceDoubleMint", 1, 100)['id']
+    vault.journal.sent(planId, "removepoolliquidity", "txStuck")
+    monkeypatch.setattr(utils, "tx_states", lambda txIds: {txId: utils.TX_PENDING for txId in txIds})
+    snapshot = FakeSnapshot({"TSLA": 1})
+    snapshot.height = 900 + 30
+    assert vault.resumePlans(snapshot)
+    snapshot.height = 900 + 31
+    assert not vault.resumePlans(snapshot)
+    assert vault.sent == []
+    assert vault.journal.open_plans() == []
+
+
+def test_resume_compacts_only_after_a_plan_ended(vault, monkeypatch):
+    vault.journal.sent(plan(vault, "reduceDoubleMint", 1, 100)['id'], "removepoolliquidity", "txPending")
+    monkeypatch.setattr(utils, "tx_states", lambda txIds: {txId: utils.TX_PENDING for txId in txIds})
+    compactions = []
+    monkeypatch.setattr(vault.journal, "compact", lambda: compactions.append(True))
+    vault.resumePlans(FakeSnapshot({"TSLA": 1}))
+    assert compactions == []
+    monkeypatch.setattr(utils, "tx_states", lambda txIds: {txId: utils.TX_FAILED for txId in txIds})
+    vault.resumePlans(FakeSnapshot({}))
+    assert compactions == [True]
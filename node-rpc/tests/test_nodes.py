@@ -0,0 +1,26 @@
+import nodes
+
+
+def _pool(*heights):
+    pool = nodes.NodePool([nodes.Node(f"http://node{idx}/", "user", "password") for idx in range(len(heights))])
+    for node, height in zip(pool.nodes, heights):
+        node.height = height
+        node.latencies.append(0.01 if node is not pool.primary else 0.1)  # the backups answer faster
+    return pool
+
+
+def test_snapshot_reads_stay_on_the_wallet_node():
+    assert "getbestblockhash" not in nodes.READ_METHODS
+    assert "getaccount" not in nodes.READ_METHODS
+    assert "getpoolpair" in nodes.READ_METHODS
+
+
+def test_reads_skip_nodes_below_the_required_height():
+    pool = _pool(101, 100, None, 101)
+    assert pool.ranked()[0] is not pool.primary
+    pool.require_height(101)
+    assert pool.ranked() == [pool.nodes[3], pool.primary]
+    pool.require_height(100)  # never goes back
+    assert pool.minHeight == 101
+    pool.nodes[3].height = 100
+    assert pool.ranked() == [pool.primary]
@@ -0,0 +1,69 @@
+import numpy as np
+import pytest
+
+import recorder
+
+
+def _write_rows(store, heights):
+    for height in heights:
+        store.append(height, {"DUSD-DFI": [height, 2.0 * height, 3.0]}, {"DFI": [1.0, 1.1, 1.2]})
+
+
+def _sizes(path):
+    return {f.name: f.stat().st_size for f in path.rglob("*.*64")}
+
+
+def test_reader_leaves_a_partial_append_alone(tmp_path):
+    writer = recorder.Recorder(str(tmp_path))
+    _write_rows(writer, [100, 101])
+    segment = writer.segments[0]
+    # the writer is in the middle of the next row: height and reserveA are written, the other columns not yet
+    columns = {field: np.full((1, segment.widths[field]), 7.0)
+               for field in recorder.POOL_FIELDS + recorder.PRICE_FIELDS}
+    for field in ["height", "reserveA"]:
+        if field not in segment.files:
+            segment.files[field] = open(segment._file(field), "ab")
+        data = np.array([102], dtype=np.int64) if field == "height" else columns[field]
+        segment.files[field].write(data.tobytes())
+        segment.files[field].flush()
+    sizes = _sizes(tmp_path)
+
+    reader = recorder.Recorder(str(tmp_path), readOnly=True)
+    assert _sizes(tmp_path) == sizes
+    assert reader.last_height() == 101
+    data = reader.read(100, 200)
+    assert list(data['height']) == [100, 101]
+    assert data['reserveB'][:, 0].tolist() == [200.0, 202.0]
+    with pytest.raises(ValueError):
+        _write_rows(reader, [103])
+    reader.close()
+
+    # the writer finishes its row, all columns stay aligned
+    for field in recorder.POOL_FIELDS[1:] + recorder.PRICE_FIELDS:
+        if field not in segment.files:
+            segment.files[field] = open(segment._file(field), "ab")
+        segment.files[field].write(columns[field].tobytes())
+        segment.files[field].flush()
+    writer.close()
+    data = recorder.Recorder(str(tmp_path), readOnly=True).read(100, 200)
+    assert list(data['height']) == [100, 101, 102]
+    assert data['reserveB'][:, 0].tolist() == [200.0, 202.0, 7.0]
+
+
+def test_writer_cuts_a_torn_row(tmp_path):
+    writer = recorder.Recorder(str(tmp_path))
+    _write_rows(writer, [100, 101])
+    writer.close()
+    with open(tmp_path / "0000000100" / "height.i64", "ab") as f:
+        f.write(np.array([102], dtype=np.int64).tobytes())
+
+    writer = recorder.Recorder(str(tmp_path))
+    assert (tmp_path / "0000000100" / "height.i64").stat().st_size == 2 * 8
+    _write_rows(writer, [102])
+    assert list(writer.read(100, 200)['height']) == [100, 101, 102]
+
+
+def test_read_only_open_of_a_missing_store(tmp_path):
+    reader = recorder.Recorder(str(tmp_path / "missing"), readOnly=True)
+    assert reader.segments == []
+    assert not (tmp_path / "missing").exists()
@@ -0,0 +1,73 @@
+import pytest
+
+from router import Router
+from tokenamount import COIN, to_sats
+
+
+class FakeSnapshot:
+    def __init__(self, pools):
+        self.poolByPair = pools
+
+
+def pool(reserveA, reserveB, commission=0.002, **fees):
+    return dict({"reserveA": reserveA, "reserveB": reserveB, "commission": commission}, **fees)
+
+
+@pytest.fixture
+def router():
+    return Router(FakeSnapshot({
+        "DFI-DUSD": pool(1000000, 2500000),
+        "TSLA-DUSD": pool(12345.67891234, 2469135.78246, dexFeeInPctTokenB=0.01, dexFeeOutPctTokenA=0.005),
+        "DFI-BTC": pool(1201234.5, 100.12345678),
+        "BTC-DUSD": pool(40.5, 1215000),
+    }))
+
+
+def accepted(router, path, amountIn, maxPrice):
+    # the integer check of compositeswap
+    out = router.quote_path_sats(path, amountIn)
+    return out > 0 and amountIn * COIN // out <= to_sats(maxPrice)
+
+
+def test_paths(router):
+    paths = router.paths("DFI", "TSLA")
+    assert [("DFI-DUSD", "DFI"), ("TSLA-DUSD", "DUSD")] in paths
+    assert [("DFI-BTC", "DFI"), ("BTC-DUSD", "BTC"), ("TSLA-DUSD", "DUSD")] in paths
+    assert all(len(path) <= 3 for path in paths)
+
+
+def test_quote_sats_close_to_float(router):
+    for path in router.paths("DFI", "TSLA"):
+        out = router.quote_path(path, 1000.0)
+        outSats = router.quote_path_sats(path, 1000 * COIN)
+        assert abs(outSats / COIN - out) / out < 1e-6
+
+
+@pytest.mark.parametrize("tokenFrom, tokenTo, maxPrice", [
+    ("DUSD", "DFI", 2.6),
+    ("DUSD", "TSLA", 203.5),
+    ("DFI", "TSLA", 82.5),
+    ("TSLA", "DFI", 0.0128),
+])
+def test_fit_max_price_passes_the_integer_check(router, tokenFrom, tokenTo, maxPrice):
+    [maxAmount, path] = router.max_amount(tokenFrom, tokenTo, maxPrice)
+    assert path is not None and maxAmount > 0
+    # a bit above the float result, as if rounding went the wrong way
+    amountIn = to_sats(maxAmount) + to_sats(maxAmount) // 10000
+    assert not accepted(router, path, amountIn, maxPrice)
+    fitted = router.fit_max_price(path, amountIn, maxPrice)
+    assert 0 < fitted <= amountIn
+    assert accepted(router, path, fitted, maxPrice)
+    # doesn't give away more than the step size
+    assert fitted > to_sats(maxAmount) * 0.999
+
+
+def test_fit_max_price_keeps_accepted_amounts(router):
+    path = [("DFI-DUSD", "DUSD")]
+    assert router.fit_max_price(path, 100 * COIN, 2.6) == 100 * COIN
+
+
+def test_fit_max_price_below_any_price(router):
+    path = [("DFI-DUSD", "DUSD")]
+    assert router.max_amount("DUSD", "DFI", 2.0) == [0, None]
+    assert router.fit_max_price(path, 100 * COIN, 2.0) == 0
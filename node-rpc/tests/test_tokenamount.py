@@ -0,0 +1,89 @@
+import pytest
+
+import tokenamount
+from tokenamount import Amount, COIN, format_sats, parse_amounts, to_sats
+
+
+@pytest.mark.parametrize("value, sats", [
+    ("1.23456789", 123456789),
+    ("+1.5", 150000000),
+    (" 2.5 ", 250000000),
+    ("0.00000001", 1),
+    (".5", 50000000),
+    ("12", 1200000000),
+    ("-1.5", -150000000),
+    ("-0.00000001", -1),
+])
+def test_parse_exact(value, sats):
+    assert to_sats(value) == sats
+    assert tokenamount._parse_sats(value) == sats
+
+
+@pytest.mark.parametrize("value, sats", [
+    ("0.000000019", 1),
+    ("1.999999999999", 199999999),
+    # rounding down is towards minus infinity for negative amounts
+    ("-0.000000011", -2),
+    ("-1.000000010", -100000001),
+    # only zeros after the 8th digit is still exact
+    ("-1.0000000100", -100000001),
+    ("-1.00000001000", -100000001),
+])
+def test_parse_more_than_8_decimals_rounds_down(value, sats):
+    assert to_sats(value) == sats
+
+
+@pytest.mark.parametrize("value, sats", [
+    ("1e-8", 1),
+    ("1E3", 100000000000),
+    ("2.5e-7", 25),
+    ("-1e-9", -1),
+])
+def test_exponent_notation(value, sats):
+    assert to_sats(value) == sats
+
+
+@pytest.mark.parametrize("value, sats", [
+    (0.29, 29000000),
+    (1.1, 110000000),
+    (0.1 + 0.2, 30000000),  # 0.30000000000000004
+    (1e-8, 1),
+    (-0.29, -29000000),
+    (3, 300000000),
+    (-2, -200000000),
+])
+def test_numbers(value, sats):
+    assert to_sats(value) == sats
+
+
+def test_format():
+    assert format_sats(123456789) == "1.23456789"
+    assert format_sats(1) == "0.00000001"
+    assert format_sats(-150000000) == "-1.50000000"
+    assert format_sats(0) == "0.00000000"
+    for text in ["0.00000001", "1234.56789012", "-0.5"]:
+        assert Amount.parse(text + "@DFI").sats == to_sats(text)
+        assert str(Amount.parse(str(Amount.parse(text + "@DFI")))) == str(Amount.parse(text + "@DFI"))
+
+
+def test_amount():
+    balance = Amount.parse("12.5@DUSD")
+    assert str(balance) == "12.50000000@DUSD"
+    assert balance.number() == "12.50000000"
+    assert min(balance, Amount.of(12.500000019, "DUSD")) == Amount.of(12.5, "DUSD")
+    assert balance - Amount.of(2.5, "DUSD") == Amount(10 * COIN, "DUSD")
+    assert str(balance * 0.995) == "12.43750000@DUSD"
+    assert balance > 0 and not Amount(0, "DUSD") > 0
+    with pytest.raises(ValueError):
+        balance + Amount.of(1, "DFI")
+    assert parse_amounts(["1.5@DFI", "10@DUSD"]) == {"DFI": Amount(150000000, "DFI"),
+                                                     "DUSD": Amount(1000000000, "DUSD")}
+
+
+def test_swap_out_rounds_down():
+    # 0.2% commission on 1 coin, then the constant product rounded down
+    assert tokenamount.swap_out(COIN, 100 * COIN, 200 * COIN, commission=200000) == \
+           200 * COIN * (COIN - 200000) // (100 * COIN + COIN - 200000)
+    assert tokenamount.swap_out(0, 100 * COIN, 200 * COIN) == 0
+    assert tokenamount.at_pool_ratio(COIN, 100 * COIN, 200 * COIN) == 2 * COIN
+    assert tokenamount.removed_amount(COIN, 100 * COIN, 10 * COIN) == 10 * COIN
@@ -0,0 +1,84 @@
+import pytest
+
+import utils
+
+
+class FakeNode:
+    def __init__(self, unspent):
+        self.unspent = unspent  # list of (txid, vout, amount, confirmations)
+        self.txs = {}  # txid -> list of (address, value)
+        self.calls = []
+
+    def rpc(self, method, params=None, silentErrors=False, timeout=None):
+        self.calls.append(method)
+        if method == "listunspent":
+            return [{"txid": txid, "vout": vout, "amount": amount, "confirmations": confirmations}
+                    for txid, vout, amount, confirmations in self.unspent]
+        if method == "getrawtransaction":
+            outputs = self.txs.get(params[0])
+            if outputs is None:
+                return None
+            return {"txid": params[0], "vout": [{"n": n, "value": value, "scriptPubKey": {"address": address}}
+                                                for n, (address, value) in enumerate(outputs)]}
+        raise AssertionError("unexpected rpc " + method)
+
+
+@pytest.fixture
+def node(monkeypatch):
+    node = FakeNode([("a", 0, 1.0, 5), ("b", 1, 2.0, 3)])
+    monkeypatch.setattr(utils, "rpc", node.rpc)
+    monkeypatch.setattr(utils, "chainHeight", 100)
+    return node
+
+
+def test_reserved_inputs_are_not_handed_out_twice(node):
+    manager = utils.UtxoManager("address")
+    first = manager.acquire()
+    second = manager.acquire()
+    assert len(first) == 1 and len(second) == 1
+    assert first[0]['txid'] != second[0]['txid']
+    assert node.calls.count("listunspent") == 1  # cached for the block
+    assert manager.acquire() == []  # both reserved, a forced refresh finds no other
+    assert node.calls.count("listunspent") == 2
+
+
+def test_spent_inputs_stay_gone_until_the_next_block(node):
+    manager = utils.UtxoManager("address")
+    txInput = manager.acquire()
+    manager.mark_spent(txInput)
+    manager.reserved.clear()  # reservations timed out
+    for _ in range(3):
+        assert manager.acquire() != txInput
+        manager.reserved.clear()
+
+
+def test_tx_sent_adds_change_and_frees_rejected_inputs(node, monkeypatch):
+    manager = utils.UtxoManager("address")
+    monkeypatch.setitem(utils._utxoManagers, "address", manager)
+    node.txs["sent"] = [("other", 0.5), ("address", 0.49)]
+
+    txInput = manager.acquire()
+    assert utils.tx_sent("address", txInput, "sent") == "sent"
+    assert (txInput[0]['txid'], txInput[0]['vout']) not in manager.unspent
+    assert manager.unspent[("sent", 1)] == [0.49, 0]
+    assert ("sent", 0) not in manager.unspent
+
+    rejected = manager.acquire()
+    assert utils.tx_sent("address", rejected, None) is None
+    assert (rejected[0]['txid'], rejected[0]['vout']) not in manager.reserved
+
+
+def test_chained_input_uses_the_cached_change_once(node, monkeypatch):
+    manager = utils.UtxoManager("address")
+    monkeypatch.setitem(utils._utxoManagers, "address", manager)
+    node.txs["sent"] = [("address", 0.49)]
+    utils.tx_sent("address", manager.acquire(), "sent")
+    calls = len(node.calls)
+
+    change = utils.get_chained_tx_input("sent", "address")
+    assert change == [{"txid": "sent", "vout": 0, "amount": 0.49}]
+    assert len(node.calls) == calls  # no second getrawtransaction
+    utils.tx_sent("address", change, "next")
+    # the change is spent now, an unconfirmed change is only handed out to chained txs
+    assert all(txIn['txid'] != "sent" for txIn in utils.get_chained_tx_input("sent", "address"))
+    assert all(key[0] != "sent" for key in manager.unspent)
@@ -0,0 +1,174 @@
+from decimal import Decimal, ROUND_FLOOR
+
+'''
+token amounts as integer satoshis (1e-8), the way the chain stores them.
+floats can't hold most 8 decimal amounts exactly and "%.8f" rounds to the nearest satoshi, so an amount calculated
+from the balance could end up 1 satoshi above it and the tx fails (costing a block to retry). here:
+  - "1.23456789@DFI" from the node is parsed into ints without going through a float
+  - calculated (float) amounts are floored to full satoshis, so they never exceed what they were calculated from
+  - formatting is exact, str(amount) is the "amount@token" string the rpc calls take
+  - the pool math works on satoshis with the integer rounding of the chain
+
+    balance = Amount.parse("12.5@DUSD")
+    payback = min(balance, Amount.of(neededDUSD, "DUSD"))
+    rpc("paybackloan", [{..., "amounts": [str(payback)]}])
+'''
+
+COIN = 100000000
+
+
+def to_sats(value):
+    """
+    satoshis of a float/int/str amount, rounded down
+    """
+    if isinstance(value, int):
+        return value * COIN
+    if isinstance(value, str) and "e" not in value and "E" not in value:
+        return _parse_sats(value)
+    # repr is the shortest string that gives this float, for 0.29 that is "0.29" and not 0.28999999999999998
+    return int((Decimal(repr(float(value))) * COIN).to_integral_value(ROUND_FLOOR))
+
+
+def _parse_sats(text):
+    text = text.strip()
+    negative = text.startswith("-")
+    whole, _, fraction = text.lstrip("+-").partition(".")
+    sats = int(whole or "0") * COIN + int((fraction + "00000000")[:8])
+    if negative:
+        # digits after the 8th are cut, for negative amounts that is rounding up
+        return -sats - (1 if fraction[8:].strip("0") else 0)
+    return sats
+
+
+def format_sats(sats):
+    sign = "-" if sats < 0 else ""
+    whole, fraction = divmod(abs(sats), COIN)
+    return f"{sign}{whole}.{fraction:08d}"
+
+
+class Amount:
+    __slots__ = ["sats", "token"]
+
+    def __init__(self, sats, token):
+        self.sats = sats
+        self.token = token
+
+    @classmethod
+    def parse(cls, text):
+        """
+        "1.23456789@DFI" -> Amount(123456789, "DFI")
+        """
+        value, _, token = text.partition("@")
+        return cls(_parse_sats(value), token)
+
+    @classmethod
+    def of(cls, value, token):
+        """
+        from a calculated amount (float), rounded down to full satoshis
+        """
+        return cls(to_sats(value), token)
+
+    def number(self):
+        # without the token, f.e. for amountFrom of compositeswap
+        return format_sats(self.sats)
+
+    def __str__(self):
+        return format_sats(self.sats) + "@" + self.token
+
+    def __repr__(self):
+        return f"Amount({str(self)})"
+
+    def __float__(self):
+        return self.sats / COIN
+
+    def __bool__(self):
+        return self.sats != 0
+
+    def __hash__(self):
+        return hash((self.sats, self.token))
+
+    def _other(self, other):
+        if isinstance(other, Amount):
+            if other.token != self.token:
+                raise ValueError(f"can't combine {self.token} and {other.token}")
+            return other.sats
+        if other == 0:
+            return 0
+        raise TypeError(f"can't combine Amount and {type(other).__name__}")
+
+    def __add__(self, other):
+        return Amount(self.sats + self._other(other), self.token)
+
+    __radd__ = __add__  # sum() starts with 0
+
+    def __sub__(self, other):
+        return Amount(self.sats - self._other(other), self.token)
+
+    def __neg__(self):
+        return Amount(-self.sats, self.token)
+
+    def __mul__(self, factor):
+        # scaling by a float (f.e. a safety factor) rounds down
+        if isinstance(factor, int):
+            return Amount(self.sats * factor, self.token)
+        return Amount(int((self.sats * Decimal(repr(float(factor)))).to_integral_value(ROUND_FLOOR)), self.token)
+
+    __rmul__ = __mul__
+
+    def __eq__(self, other):
+        if isinstance(other, Amount):
+            return self.sats == other.sats and self.token == other.token
+        return other == 0 and self.sats == 0
+
+    def __lt__(self, other):
+        return self.sats < self._other(other)
+
+    def __le__(self, other):
+        return self.sats <= self._other(other)
+
+    def __gt__(self, other):
+        return self.sats > self._other(other)
+
+    def __ge__(self, other):
+        return self.sats >= self._other(other)
+
+
+def parse_amounts(entries):
+    """
+    ["1.5@DFI", "10@DUSD"] -> {"DFI": Amount(1.5 DFI), "DUSD": Amount(10 DUSD)}
+    """
+    result = {}
+    for entry in entries or []:
+        amount = Amount.parse(entry)
+        result[amount.token] = amount
+    return result
+
+
+# ================================ pool math in satoshis ==================================
+# all amounts and reserves in satoshis, fee rates as satoshis per coin (0.2% = 200000)
+
+
+def swap_out(amountIn, reserveIn, reserveOut, commission=0, feeIn=0, feeOut=0):
+    """
+    output of a swap through one pool, fees are taken from the amount (rounded down, like the chain does)
+    """
+    effective = amountIn - amountIn * commission // COIN
+    effective -= effective * feeIn // COIN
+    if effective <= 0:
+        return 0
+    out = reserveOut * effective // (reserveIn + effective)
+    return out - out * feeOut // COIN
+
+
+def removed_amount(liquidity, reserve, totalLiquidity):
+    """
+    tokens of one side that removing the given liquidity tokens returns
+    """
+    return liquidity * reserve // totalLiquidity
+
+
+def at_pool_ratio(amount, reserveOf, reserveOther):
+    """
+    the other side of an addpoolliquidity: amount of the other token in the ratio of the reserves (rounded down)
+    """
+    return amount * reserveOther // reserveOf
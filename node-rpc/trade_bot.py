@@ -2,20 +2,26 @@ import json
 import logging
 import sys
 import traceback
-from time import sleep
 
+import execution
+import recorder
+import rpc_metrics
 import utils
+from router import Router
 
 sourceToken = "USDC"
 targetToken = "DUSD"
 totalAmount = 0
-batchSize = 2000
+batchSize = None  # max amount per swap, None: only limited by maxPrice
+minSwap = 0.001
 address = ""
 maxPrice = 1.016
+orderSettings = []
 
 logToConsole = True
 logToFile = False
 logId = ""
+metricsSettings = None
 
 '''
 sample settings:
@@ -27,7 +33,7 @@ sample settings:
   "sourceToken": "USDC",
   "targetToken": "DUSD",
   "totalAmount": 10,
-  "batchSize": 1,
+  "batchSize": 1,  (optional, max amount per swap)
   "maxPrice": 1.02,
   
   "telegram": {
@@ -37,6 +43,17 @@ sample settings:
   "logToConsole": true,
   "logToFile": true
 }
+
+instead of sourceToken...maxPrice several orders can run at once, each with its own schedule (see execution.py):
+  "orders": [
+    {"sourceToken": "USDC", "targetToken": "DUSD", "totalAmount": 1000, "maxPrice": 1.02,
+     "schedule": "twap", "blocks": 120},
+    {"sourceToken": "USDT", "targetToken": "DUSD", "totalAmount": 500, "maxPrice": 1.02,
+     "schedule": "participation", "rate": 0.1},
+    {"sourceToken": "DUSD", "targetToken": "TSLA", "totalAmount": 100, "maxPrice": 0.01,
+     "schedule": "opportunistic", "premiumPair": "TSLA-DUSD", "premiumBelow": 0.99}
+  ]
+an order can also have its own "address", "batchSize" and "minSwap".
 '''
 
 settingsPath = sys.argv[1] if len(sys.argv) > 1 else None
@@ -47,6 +64,8 @@ if settingsPath is not None:
         settings = json.load(f)
         if "NODE_URL" in settings:
             utils.NODE_URL = settings["NODE_URL"]
+        if "BACKUP_NODES" in settings:
+            utils.BACKUP_NODES = settings["BACKUP_NODES"]
         utils.NODE_USER = settings['NODE_USER']
         utils.NODE_PASSWORD = settings['NODE_PASSWORD']
         address = settings['address']
@@ -60,55 +79,79 @@ if settingsPath is not None:
         if "telegram" in settings:
             utils.TELEGRAM_TOKEN = settings['telegram']['token']
             utils.TELEGRAM_CHANNEL = settings['telegram']['channel']
-        sourceToken = settings["sourceToken"]
-        targetToken = settings["targetToken"]
-        totalAmount = settings["totalAmount"]
-        batchSize = settings["batchSize"]
-        maxPrice = settings["maxPrice"]
+        if "minSwap" in settings:
+            minSwap = settings["minSwap"]
+        if "compactRecords" in settings:
+            utils.COMPACT_POOLS = settings["compactRecords"]
+        if "orders" in settings:
+            orderSettings = settings["orders"]
+        else:
+            sourceToken = settings["sourceToken"]
+            targetToken = settings["targetToken"]
+            totalAmount = settings["totalAmount"]
+            batchSize = settings.get("batchSize")
+            maxPrice = settings["maxPrice"]
+            orderSettings = [{"sourceToken": sourceToken, "targetToken": targetToken, "totalAmount": totalAmount,
+                              "batchSize": batchSize, "maxPrice": maxPrice}]
+        if "recordTo" in settings:
+            recorder.attach(settings['recordTo'])
+        if "metrics" in settings:
+            metricsSettings = settings['metrics']
+        if "utxoSplit" in settings:
+            utils.utxo_manager(address).configure(settings['utxoSplit']['count'], settings['utxoSplit']['amount'])
 
 logger = utils.setup_logger("tradebot_" + logId, logging.INFO, logToConsole=logToConsole, logToFile=logToFile)
 utils.LOGGER = logger
+rpc_metrics.start(metricsSettings, logger)
+
+# all orders are stepped on the same snapshot every block. swaps of one order move the virtual reserves
+# the next order is sized on, results come from the tx tracker of utils
+router = Router()
+orders = [execution.Order(entry, address, router, logger, minSwap) for entry in orderSettings]
+addresses = sorted(set(order.address for order in orders))
+chainData = utils.ChainData()
+for order in orders:
+    if isinstance(order.schedule, execution.OpportunisticSchedule):
+        chainData.dataByPair[order.schedule.premiumPair] = utils.PairInfo(order.schedule.premiumPair)
 
-logger.info(
-    f"starting to trade. trying to swap {totalAmount} {sourceToken} into {targetToken} with maxPrice {maxPrice}. {batchSize} at a time")
+for order in orders:
+    logger.info(f"starting to trade {order.name}. trying to swap {order.totalAmount} {order.sourceToken} into "
+                f"{order.targetToken} with maxPrice {order.maxPrice}, schedule "
+                f"{type(order.schedule).__name__}. {order.batchSize or 'unlimited'} max per swap")
 
-openAmount = totalAmount
 try:
-    while openAmount > 0:
-        amount = min(batchSize, openAmount)
-        balance = utils.get_balance(address, sourceToken)
-        if logToConsole:
-            print(f"\r{utils.blockcount()} still {openAmount} {sourceToken} to go", end="")
-        if balance < amount:
-            logger.error(f"not enough tokens in adress! {balance} < {amount}! quitting")
+    while True:
+        active = [order for order in orders if not order.done()]
+        if len(active) == 0:
             break
-        data = {
-            "from": address,
-            "tokenFrom": sourceToken,
-            "amountFrom": amount,
-            "to": address,
-            "tokenTo": targetToken,
-            "maxPrice": maxPrice
-        }
-        test_result = utils.rpc("testpoolswap", [data, "auto"], silentErrors=True)
-        if test_result is not None:
-            logger.info(f"{utils.blockcount()} trying swap on testresult {test_result}")
-            tx = utils.rpc("compositeswap", [data], silentErrors=True)
-            if tx is not None:
-                success = utils.waitForTx(tx)
-                if success:
-                    openAmount -= amount
-                    logger.info(f"{utils.blockcount()} successfully swapped batch, got {openAmount} to do")
-                    utils.send_telegram("tradebot successfully swapped a batch")
-                else:
-                    utils.rpc("removeprunedfunds", [tx])
-                    logger.info(f"{utils.blockcount()} failed to swap batch")
-            else:
-                utils.waitBlocks(1)  # probably slipage: wait for next block
+        snapshot = utils.preload_snapshot(addresses=addresses)
+        router.update(snapshot)
+        if len(chainData.dataByPair) > 0:
+            utils.updateData(chainData)
+        balances = {}  # (address, token) -> free balance in this block
+        for order in orders:
+            key = (order.address, order.sourceToken)
+            if key not in balances:
+                balances[key] = (snapshot.account(order.address) or {}).get(order.sourceToken, 0)
+            balances[key] -= order.pendingAmount()
+        for order in active:
+            key = (order.address, order.sourceToken)
+            if len(order.pending) == 0 and balances[key] < min(order.openAmount, order.minSwap):
+                logger.error(f"not enough tokens in adress for {order.name}! {balances[key]} < {order.openAmount}! "
+                             f"dropping the order")
+                order.openAmount = 0
+        if logToConsole:
+            print(f"\r{snapshot.height} " + ", ".join(f"{order.name}: {order.openAmount} to go, "
+                                                      f"{len(order.pending)} pending" for order in active), end="")
+        reserves = {}  # pools after the swaps sent in this block, shared by all orders
+        for order in active:
+            order.step(snapshot, chainData, reserves, balances)
+        execution.end_block()
 
-        sleep(10)
+        height = utils.waitForNewBlock(snapshot.height)
+        utils.txTracker.onNewBlock(height)
 
-    logger.info(f"tradebot finished")
+    logger.info("tradebot finished")
     utils.send_telegram("tradebot finished")
 except Exception as e:
     logger.error("uncaught exception: " + str(e) + "\n" + traceback.format_exc())
@@ -6,14 +6,25 @@ import sys
 import math
 import os
 import random
+import threading
+import time
+from decimal import Decimal, ROUND_FLOOR
 
-import requests
+import nodes
+import outbox
+import records
+import rpc_metrics
+from tokenamount import Amount
 
 from time import sleep
 
 NODE_URL = "http://127.0.0.1:8555/"
 NODE_USER = "satoshi"
 NODE_PASSWORD = "hunter12"
+BACKUP_NODES = []  # more nodes for reads and relaying txs, see nodes.py
+RPC_TIMEOUT = 30  # seconds
+RPC_CONNECTIONS = 10  # keep-alive connections per node, at least one per thread that calls rpc
+COMPACT_POOLS = False  # pools of the snapshot as records (records.py): a third of the memory, more cpu per block
 
 TELEGRAM_TOKEN = None
 TELEGRAM_CHANNEL = None
@@ -24,7 +35,8 @@ logId = None
 
 
 def floor(number, digits):
-    return math.floor(number * math.pow(10, digits)) / math.pow(10, digits)
+    # on the decimal digits: math.floor(0.29 * 1e8) would give 0.28999999
+    return float(Decimal(repr(float(number))).quantize(Decimal(1).scaleb(-digits), rounding=ROUND_FLOOR))
 
 
 def smart_format(number, target_digit=5):
@@ -79,26 +91,36 @@ def setup_logger(name="kuegi_defi", log_level=logging.INFO,
     return logger
 
 
-def send_telegram(message):
-    if TELEGRAM_TOKEN is not None and TELEGRAM_CHANNEL is not None:
-        if logId is not None:
-            message = logId + ": " + message
-        url = 'https://api.telegram.org/bot' + TELEGRAM_TOKEN + '/sendMessage?chat_id=' + TELEGRAM_CHANNEL + '&text=' + message
+def send_telegram(message, token=None, channel=None, messageId=None):
+    # token, channel and id default to the global settings, override them if one process serves multiple configs
+    _send_telegram_message(message, token or TELEGRAM_TOKEN, channel or TELEGRAM_CHANNEL, messageId or logId)
 
-        result = requests.get(url).json()
-        if not result["ok"] and LOGGER is not None:
-            LOGGER.warning("error sending telegram messages " + str(result))
 
+def send_telegram_log(message, token=None, channel=None, messageId=None):
+    _send_telegram_message(message, token or TELEGRAM_TOKEN, channel or TELEGRAM_LOG_CHANNEL, messageId or logId)
 
-def send_telegram_log(message):
-    if TELEGRAM_TOKEN is not None and TELEGRAM_LOG_CHANNEL is not None:
-        if logId is not None:
-            message = logId + ": " + message
-        url = 'https://api.telegram.org/bot' + TELEGRAM_TOKEN + '/sendMessage?chat_id=' + TELEGRAM_LOG_CHANNEL + '&text=' + message
 
-        result = requests.get(url).json()
-        if not result["ok"] and LOGGER is not None:
-            LOGGER.warning("error sending telegram messages " + str(result))
+def _send_telegram_message(message, token, channel, messageId):
+    # only enqueued, the outbox sends it in the background
+    if token is not None and channel is not None:
+        if messageId is not None:
+            message = messageId + ": " + message
+        notifications.send_telegram(token, channel, message)
+
+
+def send_heartbeat(url):
+    if url is not None and len(url) > 0:
+        notifications.heartbeat(url)
+
+
+def _log_warning(message):
+    if LOGGER is not None:
+        LOGGER.warning(message)
+    else:
+        print("\r" + message)
+
+
+notifications = outbox.Outbox(warn=_log_warning)
 
 
 # ================================= ChainData =============================================
@@ -167,22 +189,162 @@ def calc_maxPrice_Amount(exchange_data, token, dfiAmount, target_premium=1.5, mi
     bestPrice = exchange_data.dfiData.dex_price / v.dex_price
     maxSwap = maxSwapForPriceChange(poolpair, token, max(minTolerance,
                                                          maxPrice / bestPrice - 1) * 0.75)  # buffer 75% of max change, against price problem
-    amount = floor(max(0, min(maxSwap, dfiAmount * maxPrice)), 7)  # to prevent floating problems on max positionsize
+    amount = floor(max(0, min(maxSwap, dfiAmount * maxPrice)), 8)
     return [premium, maxPrice, bestPrice, amount]
 
 
+def parse_amounts(entries):
+    """
+    ["1.5@DFI", "10@DUSD"] -> {"DFI": 1.5, "DUSD": 10.0}
+    """
+    balances = {}
+    for entry in entries or []:
+        t = entry.split("@")
+        balances[t[1]] = float(t[0])
+    return balances
+
+
+class ChainSnapshot:
+    """
+    read-only view of the chain at one block: pools, oracle prices, loan info and the vaults and accounts in use.
+    loaded with one batch call and shared by all lookups until the block changes. don't modify the content.
+    vaults and accounts are records (records.py) that parse their amounts once. pools are the decoded dicts,
+    with COMPACT_POOLS compact records where unchanged pools are shared with the previous snapshot
+    """
+
+    def __init__(self, blockHash, height, pools, fixedPrices, livePrices, loanInfo, previousPools=None):
+        """
+        :param previousPools: poolById of the snapshot before, to reuse the records of unchanged pools
+        """
+        self.blockHash = blockHash
+        self.height = height
+        self.poolById = records.decode_pools(pools, previousPools) if COMPACT_POOLS else pools
+        self.poolByPair = {}
+        self.poolByIdPair = {}
+        for pool in self.poolById.values():
+            self.poolByPair[pool['symbol']] = pool
+            self.poolByIdPair[pool['idTokenA'] + "-" + pool["idTokenB"]] = pool
+        self.fixedPrices = fixedPrices
+        self.fixedPriceByFeed = {price['priceFeedId']: price for price in fixedPrices}
+        self.livePrices = livePrices
+        self.loanInfo = loanInfo
+        self.vaults = {}
+        self.accounts = {}
+        self.accountRecords = {}
+
+    def add_vault(self, vaultId, vault):
+        self.vaults[vaultId] = records.decode_vault(vault)
+
+    def add_account(self, address, accountEntries):
+        record = records.AccountRecord(accountEntries)
+        self.accountRecords[address] = record
+        self.accounts[address] = record.balances()
+
+    def pool(self, pair):
+        return self.poolByPair.get(pair)
+
+    def fixed_price(self, token):
+        # same content as getfixedintervalprice for <token>/USD
+        return self.fixedPriceByFeed.get(token + "/USD")
+
+    def vault(self, vaultId):
+        return self.vaults.get(vaultId)
+
+    def account(self, address):
+        return self.accounts.get(address)
+
+    def account_amounts(self, address):
+        """
+        :return: token -> exact Amount (tokenamount), for amounts that are sent back in a tx
+        """
+        if address not in self.accountRecords:
+            return None
+        return dict(self.accountRecords[address].amounts())
+
+
+_snapshot = None
+_snapshotLock = threading.RLock()
+snapshotListeners = []  # called with every new snapshot, f.e. recorder.Recorder.record
+
+
+def chain_snapshot(vaultId=None, address=None, caller=None):
+    """
+    snapshot of the current block. only refetched if the best block changed, missing vault/account is added to it
+    :param caller: name the rpc calls are counted for in rpc_metrics, default is the function that asked
+    """
+    return preload_snapshot([vaultId] if vaultId is not None else [], [address] if address is not None else [],
+                            caller)
+
+
+def preload_snapshot(vaultIds=(), addresses=(), caller=None):
+    """
+    snapshot of the current block with all given vaults and accounts loaded.
+    vaults and accounts of the previous snapshot are reloaded in the same batch when the block changes
+    :param caller: name the rpc calls are counted for in rpc_metrics, default is the function that asked
+    """
+    with rpc_metrics.phase(caller or rpc_metrics.caller()):
+        return _load_snapshot(vaultIds, addresses)
+
+
+def _load_snapshot(vaultIds, addresses):
+    global _snapshot, poolByPair, poolByIdPair, chainHeight
+    with _snapshotLock:
+        if _snapshot is not None and rpc("getbestblockhash") == _snapshot.blockHash:
+            vaultIds = [vaultId for vaultId in vaultIds if vaultId not in _snapshot.vaults]
+            addresses = [address for address in addresses if address not in _snapshot.accounts]
+            results = rpc_batch([("getvault", [vaultId, True]) for vaultId in vaultIds] +
+                                [("getaccount", [address]) for address in addresses])
+            _add_vaults_and_accounts(_snapshot, vaultIds, addresses, results)
+            return _snapshot
+
+        if _snapshot is not None:
+            # keep what was already part of the previous snapshot
+            vaultIds = list(set(vaultIds) | _snapshot.vaults.keys())
+            addresses = list(set(addresses) | _snapshot.accounts.keys())
+        results = rpc_batch([("getbestblockhash",),
+                             ("getblockcount",),
+                             ("listpoolpairs", [{"limit": 1000}]),
+                             ("listfixedintervalprices", [{"limit": 1000}]),
+                             ("listprices", [{"limit": 1000}]),
+                             ("getloaninfo",)] +
+                            [("getvault", [vaultId, True]) for vaultId in vaultIds] +
+                            [("getaccount", [address]) for address in addresses])
+        blockHash, height, pools, fixedPrices, livePrices, loanInfo = results[:6]
+        snapshot = ChainSnapshot(blockHash, height, pools, fixedPrices, livePrices, loanInfo,
+                                 _snapshot.poolById if _snapshot is not None else None)
+        _add_vaults_and_accounts(snapshot, vaultIds, addresses, results[6:])
+        _snapshot = snapshot
+        poolByPair = snapshot.poolByPair
+        poolByIdPair = snapshot.poolByIdPair
+        chainHeight = height
+        if isinstance(height, int):
+            # the snapshot came from the wallet node, later reads must not go back to a block before it
+            node_pool().require_height(height)
+        for listener in snapshotListeners:
+            try:
+                listener(snapshot)
+            except Exception as e:
+                if LOGGER:
+                    LOGGER.error(f"snapshot listener failed: {str(e)}")
+        return snapshot
+
+
+def _add_vaults_and_accounts(snapshot, vaultIds, addresses, results):
+    for vaultId, vault in zip(vaultIds, results):
+        snapshot.add_vault(vaultId, vault)
+    for address, accountEntries in zip(addresses, results[len(vaultIds):]):
+        snapshot.add_account(address, accountEntries)
+
+
 def updateData(data):
-    pools = rpc('listpoolpairs')
-    for pool in pools.values():
-        poolByPair[pool['symbol']] = pool
-        poolByIdPair[pool['idTokenA'] + "-" + pool["idTokenB"]] = pool
+    snapshot = chain_snapshot()
+    for pool in snapshot.poolByPair.values():
         if pool['symbol'] == 'DUSD-DFI':
             data.dfiData.dex_price = pool['reserveA/reserveB']  # DFI-DUSD price is flipped to the others!
         elif pool['symbol'] in data.dataByPair.keys():
             data.dataByPair[pool['symbol']].dex_price = pool['reserveB/reserveA']
 
-    prices = rpc('listfixedintervalprices')
-    for price in prices:
+    for price in snapshot.fixedPrices:
         pair = price['priceFeedId'].replace("/", "-D")
         if price['isLive']:
             activePrice = price['activePrice']
@@ -197,8 +359,7 @@ def updateData(data):
             data.dataByPair[pair].oracle_price = activePrice
             data.dataByPair[pair].next_oracle_price = predicted
 
-    prices = rpc('listprices')
-    for price in prices:
+    for price in snapshot.livePrices:
         if price['currency'] == 'USD':
             pair = price['token'] + "-DUSD"
             if price['ok'] and "price" in price:
@@ -211,17 +372,18 @@ def updateData(data):
                 data.dataByPair[pair].live_oracle_price = usedPrice
 
 
+# pools of the current snapshot
 poolByPair = {}
 poolByIdPair = {}
 
 
 def updatePoolData():
-    pools = rpc('listpoolpairs')
-    for pool in pools.values():
-        poolByPair[pool['symbol']] = pool
-        poolByIdPair[pool['idTokenA'] + "-" + pool["idTokenB"]] = pool
+    chain_snapshot()
 
 
+# estimates on the float reserves of the snapshot: prices, relative price changes and swap sizes. they stay
+# floats, nothing here goes into a tx as it is. amounts that are sent are cut to satoshis with tokenamount and
+# the integer price check of the chain is done by router.fit_max_price
 def getReservesFromPool(poolPair, tokenIn):
     if poolPair in poolByPair:
         pool = poolByPair[poolPair]
@@ -277,20 +439,221 @@ def estimatedExecution(poolPair, tokenIn, amount):
 
 # ===================================== RPC Stuff ===================================
 
+# last height we know of, shared by everything that waits on blocks
+chainHeight = 0
+
+
 def blockcount():
-    return rpc("getblockcount")
+    global chainHeight
+    chainHeight = rpc("getblockcount")
+    return chainHeight
 
 
-def get_tx_input(address, minamount=0.001, count=1):
-    # get a random utxo (helps preventing problems when multiple scripts use the same address)
-    unspent = rpc("listunspent", [1, 9999999, [address], False, {"minimumAmount": round(minamount, 8)}])
-    if len(unspent) == 0:
-        return []
-    unspent_sample = random.sample(unspent, min(len(unspent), count))
-    result = []
-    for tx in unspent_sample:
-        result.append({'txid': tx["txid"], "vout": tx["vout"], "amount": tx["amount"]})
-    return result
+RESERVE_INPUT_SECONDS = 60
+MAX_SPLIT_CHAIN = 20  # unconfirmed split txs in a row, stays below the mempool chain limit
+
+
+class UtxoManager:
+    """
+    the unspent outputs of one address: cached per block (one listunspent instead of one per tx),
+    handed out with a reservation so concurrent senders never pick the same utxo.
+    after a send (tx_sent) the inputs are removed from the cache and the change of the tx is added, unconfirmed.
+    release() frees the inputs of a tx that was not sent, reservations also end after RESERVE_INPUT_SECONDS
+    as a safety net.
+    with a targetCount > 0 the largest utxo is split in the background until there are targetCount free utxos
+    of splitAmount, so many txs can be sent from the address in one block.
+    """
+
+    def __init__(self, address, targetCount=0, splitAmount=0.1):
+        self.address = address
+        self.targetCount = targetCount
+        self.splitAmount = splitAmount
+        self.unspent = {}  # (txid, vout) -> [amount, confirmations]
+        self.reserved = {}  # (txid, vout) -> time until reserved
+        self.spent = set()  # (txid, vout) spent by own txs since the last listunspent
+        self.refreshedHeight = None
+        self.splitting = False
+        self.lock = threading.RLock()
+
+    def configure(self, targetCount, splitAmount):
+        self.targetCount = targetCount
+        self.splitAmount = splitAmount
+
+    def refresh(self, force=False):
+        with self.lock:
+            if force or self.refreshedHeight is None or self.refreshedHeight < chainHeight:
+                unspent = rpc("listunspent", [0, 9999999, [self.address]]) or []
+                self.unspent = {(tx["txid"], tx["vout"]): [tx["amount"], tx["confirmations"]] for tx in unspent}
+                self.spent = set()
+                self.refreshedHeight = chainHeight
+            now = time.time()
+            for key in [key for key, until in self.reserved.items() if until < now]:
+                del self.reserved[key]
+        self._maintain()
+
+    def _free(self, minamount, minconf):
+        return [key for key, (amount, confirmations) in self.unspent.items()
+                if key not in self.reserved and amount >= minamount and confirmations >= minconf]
+
+    def acquire(self, count=1, minamount=0.001, minconf=1):
+        with self.lock:
+            self.refresh()
+            free = self._free(minamount, minconf)
+            if len(free) < count:
+                self.refresh(force=True)
+                free = self._free(minamount, minconf)
+            # random pick still helps against other processes using the same address
+            picked = random.sample(free, min(len(free), count))
+            until = time.time() + RESERVE_INPUT_SECONDS
+            result = []
+            for key in picked:
+                self.reserved[key] = until
+                result.append({'txid': key[0], "vout": key[1], "amount": self.unspent[key][0]})
+            return result
+
+    def reserve(self, txid, vout, amount):
+        # output of an own (unconfirmed) tx that is used right away
+        with self.lock:
+            self.unspent[(txid, vout)] = [amount, 0]
+            self.reserved[(txid, vout)] = time.time() + RESERVE_INPUT_SECONDS
+
+    def release(self, inputs):
+        with self.lock:
+            for txIn in inputs or []:
+                self.reserved.pop((txIn["txid"], txIn["vout"]), None)
+
+    def mark_spent(self, inputs):
+        # inputs of a sent tx, gone right away instead of at the next listunspent
+        with self.lock:
+            for txIn in inputs or []:
+                key = (txIn["txid"], txIn["vout"])
+                self.unspent.pop(key, None)
+                self.reserved.pop(key, None)
+                self.spent.add(key)
+
+    def add_outputs(self, txId):
+        """
+        adds the outputs of the own tx txId that went back to the address (its change) as unconfirmed utxos
+        """
+        tx = rpc("getrawtransaction", [txId, True], silentErrors=True)
+        if tx is None:
+            return
+        with self.lock:
+            for out in tx['vout']:
+                script = out['scriptPubKey']
+                key = (txId, out['n'])
+                if out['value'] > 0 and key not in self.spent \
+                        and (script.get('address') == self.address or self.address in script.get('addresses', [])):
+                    self.unspent.setdefault(key, [out['value'], 0])
+
+    def acquire_output(self, txId):
+        """
+        reserves an unspent output of the own tx txId that went back to the address
+        :return: list with the input, empty if there is none
+        """
+        with self.lock:
+            known = any(key[0] == txId for key in list(self.unspent) + list(self.spent))
+        if not known:
+            self.add_outputs(txId)
+        with self.lock:
+            free = [key for key in self.unspent if key[0] == txId and key not in self.reserved]
+            if len(free) == 0:
+                return []
+            key = free[0]
+            self.reserved[key] = time.time() + RESERVE_INPUT_SECONDS
+            return [{'txid': key[0], "vout": key[1], "amount": self.unspent[key][0]}]
+
+    def _maintain(self):
+        with self.lock:
+            if self.targetCount <= 0 or self.splitting:
+                return
+            missing = self.targetCount - len(self._free(self.splitAmount, 0))
+            if missing <= 0:
+                return
+            self.splitting = True
+        threading.Thread(target=self._split, args=(min(missing, MAX_SPLIT_CHAIN),), daemon=True).start()
+
+    def _split(self, pieces):
+        # chain of txs, each sends splitAmount to the address and the change back to it as input of the next
+        key = None
+        try:
+            with self.lock:
+                candidates = self._free(2 * self.splitAmount, 0)
+                if len(candidates) == 0:
+                    return
+                key = max(candidates, key=lambda k: self.unspent[k][0])
+                amount = self.unspent[key][0]
+                self.reserved[key] = time.time() + RESERVE_INPUT_SECONDS
+            for _ in range(pieces):
+                if amount < 2 * self.splitAmount:
+                    break
+                raw = rpc("createrawtransaction",
+                          [[{"txid": key[0], "vout": key[1]}],
+                           [{self.address: Amount.of(self.splitAmount, "DFI").number()}]])
+                funded = rpc("fundrawtransaction", [raw, {"changeAddress": self.address, "changePosition": 1}])
+                signed = rpc("signrawtransactionwithwallet", [funded["hex"]])
+                txId = rpc("sendrawtransaction", [signed["hex"]], silentErrors=True)
+                if txId is None:
+                    break
+                with self.lock:
+                    self.unspent.pop(key, None)
+                    self.reserved.pop(key, None)
+                    self.spent.add(key)
+                    amount = amount - self.splitAmount - funded["fee"]
+                    self.unspent[(txId, 0)] = [self.splitAmount, 0]
+                    key = (txId, 1)
+                    self.reserve(txId, 1, amount)
+            if LOGGER:
+                LOGGER.info(f"split utxos of {self.address}, now {len(self._free(self.splitAmount, 0))} free")
+        except Exception as e:
+            if LOGGER:
+                LOGGER.warning(f"splitting utxos of {self.address} failed: {str(e)}")
+        finally:
+            with self.lock:
+                self.reserved.pop(key, None)
+                self.splitting = False
+
+
+_utxoManagers = {}
+_utxoManagersLock = threading.Lock()
+
+
+def utxo_manager(address):
+    with _utxoManagersLock:
+        if address not in _utxoManagers:
+            _utxoManagers[address] = UtxoManager(address)
+        return _utxoManagers[address]
+
+
+def get_tx_input(address, minamount=0.001, count=1, minconf=1):
+    return utxo_manager(address).acquire(count, minamount, minconf)
+
+
+def get_chained_tx_input(prevTxId, address):
+    """
+    input for a tx that should land in the same block as prevTxId: spends the (unconfirmed) change of prevTxId
+    that went back to address. falls back to any unconfirmed utxo of the address if there is none
+    """
+    if prevTxId is not None:
+        txInput = utxo_manager(address).acquire_output(prevTxId)
+        if len(txInput) > 0:
+            return txInput
+    return get_tx_input(address, minconf=0)
+
+
+def tx_sent(address, inputs, txId):
+    """
+    updates the utxo cache of address after a tx with the given inputs was sent: the inputs are spent, the change
+    can be used by the next tx. if the node rejected the tx (txId None) the inputs are free again
+    :return: txId
+    """
+    manager = utxo_manager(address)
+    if txId is None:
+        manager.release(inputs)
+    else:
+        manager.mark_spent(inputs)
+        manager.add_outputs(txId)
+    return txId
 
 
 def is_tx_confirmed(txId):
@@ -302,56 +665,305 @@ def is_tx_confirmed(txId):
     return False
 
 
-def rpc(method, params=None, silentErrors=False):
+_nodePool = None
+_nodeConfig = None
+
+
+def node_pool():
+    # rebuilt when the node settings changed
+    global _nodePool, _nodeConfig
+    config = json.dumps([NODE_URL, NODE_USER, NODE_PASSWORD, BACKUP_NODES, RPC_CONNECTIONS])
+    if _nodePool is None or config != _nodeConfig:
+        entries = [{"url": NODE_URL}] + [entry if isinstance(entry, dict) else {"url": entry}
+                                         for entry in BACKUP_NODES]
+        _nodePool = nodes.NodePool([nodes.Node(entry['url'], entry.get('user', NODE_USER),
+                                               entry.get('password', NODE_PASSWORD), RPC_CONNECTIONS)
+                                    for entry in entries],
+                                   LOGGER)
+        _nodeConfig = config
+    _nodePool.logger = LOGGER
+    return _nodePool
+
+
+def rpc_session():
+    # one pooled keep-alive session per node, so we don't pay a new connection on every rpc
+    return node_pool().primary.session
+
+
+def _log_rpc_error(method, params, error):
+    message = f"--Error in RPC Call {method} with {str(params)}:\n{error['message']}"
+    if LOGGER:
+        LOGGER.error(message)
+    else:
+        print("\r" + message)
+    send_telegram(f"Error in RPC Call {method}: {error['message']}")
+
+
+def rpc(method, params=None, silentErrors=False, timeout=None):
+    if params is None:
+        params = []
+    response = rpc_response(method, params, timeout)
+    if response.get('error') is not None and not silentErrors:
+        _log_rpc_error(method, params, response['error'])
+    return response['result']
+
+
+def rpc_response(method, params=None, timeout=None):
+    """
+    the full json-rpc response ("result" and "error"), for callers that need the error code
+    """
     if params is None:
         params = []
+    if timeout is None:
+        timeout = RPC_TIMEOUT
     data = json.dumps({
         "jsonrpc": "2.0",
         "id": "meBe",
         "method": method,
         "params": params
     })
-    result = requests.post(NODE_URL, auth=(NODE_USER, NODE_PASSWORD), data=data)
-    if result.status_code >= 300 and not silentErrors:
-        message = f"--Error in RPC Call {method} with {str(params)}:\n{result.json()['error']['message']}"
-        if LOGGER:
-            LOGGER.error(message)
+    return records.loads(_post(method, data, timeout).content)
+
+
+def _post(method, data, timeout, methods=None, caller=None):
+    caller = caller or rpc_metrics.caller()
+    start = time.perf_counter()
+    try:
+        result = node_pool().post(method, data, timeout, methods)
+    except Exception:
+        rpc_metrics.metrics.record(method, caller, time.perf_counter() - start, len(data), 0, True)
+        raise
+    rpc_metrics.metrics.record(method, caller, time.perf_counter() - start, len(data), len(result.content),
+                               result.status_code >= 300)
+    return result
+
+
+def rpc_batch(calls, silentErrors=False):
+    """
+    sends multiple calls in one json-rpc batch (one round trip)
+    :param calls: list of (method, params) tuples, params can be omitted
+    :return: list of results in the same order as the calls. None for calls that failed
+    """
+    if len(calls) == 0:
+        return []
+    requestData, responses = _batch(calls)
+    if not isinstance(responses, list):
+        # whole batch was rejected
+        if not silentErrors:
+            _log_rpc_error("batch", [call[0] for call in calls], responses['error'])
+        return [None] * len(calls)
+    results = [None] * len(calls)
+    for response in responses:
+        idx = response['id']
+        if response.get('error') is not None:
+            if not silentErrors:
+                _log_rpc_error(requestData[idx]['method'], requestData[idx]['params'], response['error'])
         else:
-            print("\r" + message)
-        send_telegram(f"Error in RPC Call {method}: {result.json()['error']['message']}")
-    return result.json()['result']
+            results[idx] = response['result']
+    return results
+
+
+def rpc_batch_responses(calls):
+    """
+    same as rpc_batch, but the full response ("result" and "error") per call, nothing is logged.
+    if the whole batch was rejected every call gets the error of the batch
+    """
+    if len(calls) == 0:
+        return []
+    requestData, responses = _batch(calls)
+    if not isinstance(responses, list):
+        return [{"result": None, "error": responses.get('error')} for _ in calls]
+    results = [{"result": None, "error": {"code": None, "message": "no response"}} for _ in calls]
+    for response in responses:
+        results[response['id']] = response
+    return results
+
+
+def _batch(calls):
+    requestData = []
+    for idx, call in enumerate(calls):
+        requestData.append({
+            "jsonrpc": "2.0",
+            "id": idx,
+            "method": call[0],
+            "params": call[1] if len(call) > 1 and call[1] is not None else []
+        })
+    caller = rpc_metrics.caller()
+    rpc_metrics.metrics.record_batched([call[0] for call in calls], caller)
+    responses = records.loads(_post("batch", json.dumps(requestData), RPC_TIMEOUT,
+                                    [call[0] for call in calls], caller).content)
+    return requestData, responses
+
+
+METHOD_NOT_FOUND = -32601
+_longPollSupported = True
+
+
+def long_poll_failed(error):
+    """
+    called when waitforblockheight returned no result. only "method not found" turns the long-poll off for good,
+    a timeout, the warm-up of the node (-28) or any other error just polls for this round
+    """
+    global _longPollSupported
+    if error is not None and error.get('code') == METHOD_NOT_FOUND:
+        _longPollSupported = False
+        if LOGGER is not None:
+            LOGGER.info("node does not support waitforblockheight, falling back to polling")
+
+
+def waitForNewBlock(lastHeight, longPollSeconds=20, maxPollSleep=5.0):
+    """
+    blocks until the chain is above lastHeight.
+    uses the waitforblockheight long-poll of the node (returns as soon as the block arrives).
+    if the node doesn't support it (or the call failed), falls back to polling getblockcount with increasing sleep
+    :return: the new height
+    """
+    global chainHeight
+    pollSleep = 0.5
+    while True:
+        height = None
+        if _longPollSupported:
+            response = rpc_response("waitforblockheight", [lastHeight + 1, longPollSeconds * 1000],
+                                    timeout=longPollSeconds + RPC_TIMEOUT)
+            if response.get('result') is not None:
+                height = response['result']['height']
+            else:
+                long_poll_failed(response.get('error'))
+        if height is None:
+            sleep(pollSleep)
+            pollSleep = min(pollSleep * 2, maxPollSleep)
+            height = rpc("getblockcount", silentErrors=True)
+        if height is not None and height > lastHeight:
+            chainHeight = height
+            return height
+
+
+NOT_FOUND = -5  # gettransaction: invalid or non-wallet transaction id
 
 
-def waitForTx(txId, loopSleep=1.0, timeoutBlocks=30):
+TX_CONFIRMED = "confirmed"
+TX_PENDING = "pending"
+TX_FAILED = "failed"
+
+
+def tx_state(response):
+    """
+    :param response: json-rpc response of gettransaction
+    :return: TX_CONFIRMED, TX_PENDING (in the mempool), TX_FAILED (conflicted or not in the wallet)
+             or None if the call itself failed
+    """
+    tx = response.get('result')
+    if tx is None:
+        return TX_FAILED if (response.get('error') or {}).get('code') == NOT_FOUND else None
+    if tx.get("confirmations", 0) < 0:
+        return TX_FAILED
+    return TX_CONFIRMED if "blockhash" in tx else TX_PENDING
+
+
+def tx_states(txIds):
+    """
+    states of many txs with one batch call, raises if the batch itself failed
+    :return: dict of txId -> state (see tx_state)
+    """
+    txIds = list(txIds)
+    responses = rpc_batch_responses([("gettransaction", [txId]) for txId in txIds])
+    return {txId: tx_state(response) for txId, response in zip(txIds, responses)}
+
+
+class TxTracker:
+    """
+    tracks the confirmation of many txs at once.
+    on every new block all pending txs are checked with one batch call, resolved txs trigger their callback.
+    a tx only fails on an explicit answer of the node (conflicted, not found or not mined in time), if the check
+    itself failed it stays pending for the next block
+    """
+
+    def __init__(self):
+        self.pending = {}  # txId -> (lastBlock, callback)
+        self.results = {}  # txId -> confirmed, only for watches without callback (read by wait)
+        self.checkedHeight = 0
+        self.lock = threading.RLock()
+
+    def watch(self, txId, callback=None, timeoutBlocks=30):
+        """
+        :param callback: called with (txId, confirmed) once the tx got mined (True) or dropped/timed out (False)
+        :param timeoutBlocks: tx counts as failed if not mined within that many blocks. <= 0 for no timeout
+        """
+        if txId is None:
+            return
+        if chainHeight == 0:
+            blockcount()
+        lastBlock = chainHeight + timeoutBlocks if timeoutBlocks > 0 else None
+        with self.lock:
+            self.pending[txId] = (lastBlock, callback)
+
+    def _resolve(self, txId, confirmed):
+        lastBlock, callback = self.pending.pop(txId)
+        if callback is not None:
+            callback(txId, confirmed)
+        else:
+            self.results[txId] = confirmed
+
+    def onNewBlock(self, height):
+        with self.lock:
+            if height <= self.checkedHeight:
+                return  # another waiting thread already checked this block
+            txIds = list(self.pending.keys())
+            try:
+                states = tx_states(txIds)
+            except Exception as e:
+                _log_warning(f"checking {len(txIds)} txs failed, trying again next block: {str(e)}")
+                return
+            self.checkedHeight = height
+            for txId, state in states.items():
+                lastBlock = self.pending[txId][0]
+                if state == TX_FAILED:
+                    self._resolve(txId, False)
+                elif state == TX_CONFIRMED:
+                    self._resolve(txId, lastBlock is None or height <= lastBlock)
+                elif state == TX_PENDING and lastBlock is not None and height > lastBlock:
+                    self._resolve(txId, False)
+                # None: the check failed, not the tx. ask again next block
+
+    def wait(self, txIds=None):
+        """
+        blocks until the given (default: all) watched txs are resolved
+        :return: dict of txId -> confirmed
+        """
+        if txIds is None:
+            txIds = list(self.pending.keys())
+        while any(txId in self.pending for txId in txIds):
+            height = waitForNewBlock(max(chainHeight, self.checkedHeight))
+            print(f"\r{height} waiting for {len(self.pending)} txs", end="")
+            self.onNewBlock(height)
+        with self.lock:
+            return {txId: self.results.pop(txId, False) for txId in txIds}
+
+
+txTracker = TxTracker()
+
+
+def waitForTx(txId, timeoutBlocks=30):
     if txId is None:
         return False
-    height = rpc('getblockcount')
-    lastBlock = height + timeoutBlocks
-    tx = rpc('gettransaction', [txId])
-    while tx is not None and ("blockhash" not in tx) and (timeoutBlocks <= 0 or height <= lastBlock):
-        print(f"\r{height} waiting for tx {txId}", end="")
-        sleep(loopSleep)
-        tx = rpc('gettransaction', [txId])
-        height = rpc('getblockcount')
-    return tx is not None and (timeoutBlocks <= 0 or height <= lastBlock)
+    txTracker.watch(txId, timeoutBlocks=timeoutBlocks)
+    return txTracker.wait([txId])[txId]
 
 
-def waitBlocks(numberOfBlocks, loopSleep=1.0):
-    height = rpc('getblockcount')
+def waitBlocks(numberOfBlocks):
+    height = blockcount()
     lastBlock = height + numberOfBlocks
     while height < lastBlock:
         print(f"\r{height} waiting ", end="")
-        sleep(loopSleep)
-        height = rpc('getblockcount')
+        height = waitForNewBlock(height)
 
 
 def get_account(address):
-    balances = {}
-    tokenbalances = rpc("getaccount", [address])
-    for entry in tokenbalances:
-        t = entry.split("@")
-        balances[t[1]] = float(t[0])
-    return balances
+    return dict(chain_snapshot(address=address).account(address))
+
+
+def get_account_amounts(address):
+    return chain_snapshot(address=address).account_amounts(address)
 
 
 def get_balance(address, token):
@@ -361,8 +973,28 @@ def get_balance(address, token):
     return 0
 
 
+def test_compositeswap(data):
+    """
+    what a compositeswap with data would get right now. compositeswap takes no path, defid picks the route
+    itself (the same as testpoolswap with "auto"), so this is the route the swap will actually take.
+    :param data: the metadata of the compositeswap
+    :param data: the metadata of the compositeswap, without maxPrice (checked by the caller against the result)
+    :return: (out as Amount, symbols of the pools of the route) or (None, None) if the node couldn't tell
+    """
+    result = rpc("testpoolswap", [data, "auto", True], silentErrors=True)
+    if not isinstance(result, dict) or not isinstance(result.get('amount'), str):
+        return None, None
+    out = Amount.parse(result['amount'])
+    out.token = data['tokenTo']  # the node answers with the token id, not the symbol
+    poolById = _snapshot.poolById if _snapshot is not None else {}
+    return out, [(poolById.get(str(poolId)) or {}).get('symbol', str(poolId)) for poolId in result.get('pools', [])]
+
+
 def get_pool(pool):
+    snapshot = chain_snapshot()
+    if pool in snapshot.poolByPair:
+        return snapshot.poolByPair[pool]
     pools = rpc("getpoolpair", [pool])
-    for pool in pools.values():
-        return pool
+    for poolId, pool in pools.items():
+        return records.decode_pools({poolId: pool})[poolId] if COMPACT_POOLS else pool
     return None
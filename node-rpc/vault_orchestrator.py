@@ -0,0 +1,91 @@
+import glob
+import logging
+import sys
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+import rpc_metrics
+import utils
+from DFIVaultMaxi import VaultMaxi
+
+'''
+runs many vaults in one process instead of one DFIVaultMaxi.py per vault.
+per block the pools, oracle prices and all vaults and accounts are loaded in one batch,
+then every vault is processed in its own thread. a vault that is still busy with its transactions
+from a previous block skips the new block.
+
+all settings files must use the same node, NODE_URL/NODE_USER/NODE_PASSWORD/BACKUP_NODES of the last one is used.
+every vault needs its own address: the token balances of an address are not split between vaults, two vaults on
+one address would reinvest the same DFI and pay back with the tokens the other one removed. a second vault on an
+address that is already used is skipped.
+
+usage: python vault_orchestrator.py settings1.json settings2.json ...
+       python vault_orchestrator.py "settings/*.json"
+'''
+
+
+def load_vaults(patterns, logger):
+    vaults = []
+    addresses = {}  # address -> settingsPath of the vault using it
+    for pattern in patterns:
+        for settingsPath in sorted(glob.glob(pattern)):
+            try:
+                vaultMaxi = VaultMaxi(settingsPath)
+            except Exception as e:
+                logger.error(f"could not load {settingsPath}: {str(e)}")
+                continue
+            if not vaultMaxi.isSupported():
+                logger.warning(f"{settingsPath}: pair {vaultMaxi.lmPair} not supported, skipping")
+                continue
+            if vaultMaxi.address in addresses:
+                logger.error(f"{settingsPath}: address {vaultMaxi.address} is already used by "
+                             f"{addresses[vaultMaxi.address]}, skipping")
+                continue
+            addresses[vaultMaxi.address] = settingsPath
+            vaults.append(vaultMaxi)
+    return vaults
+
+
+def process_vault(vaultMaxi, snapshot):
+    try:
+        return vaultMaxi.processBlock(snapshot)
+    except Exception as e:
+        vaultMaxi.logger.error("uncaught exception: " + str(e) + "\n" + traceback.format_exc())
+        vaultMaxi.send_telegram("LMVault: Exception in script!")
+        return True  # keep it running, next block might work again
+
+
+def run(vaults, logger):
+    running = {}  # vaultMaxi -> future of the block it is processing
+    with ThreadPoolExecutor(max_workers=max(1, len(vaults)), thread_name_prefix="vault") as executor:
+        for vaultMaxi in vaults:
+            vaultMaxi.logSettings()
+        while len(vaults) > 0:
+            snapshot = utils.preload_snapshot([v.vaultId for v in vaults], [v.address for v in vaults])
+            for vaultMaxi, future in list(running.items()):
+                if future.done():
+                    del running[vaultMaxi]
+                    if not future.result():
+                        logger.info(f"stopping vault {vaultMaxi.vaultId}")
+                        vaults.remove(vaultMaxi)
+            for vaultMaxi in vaults:
+                if vaultMaxi not in running:
+                    running[vaultMaxi] = executor.submit(process_vault, vaultMaxi, snapshot)
+            utils.waitForNewBlock(snapshot.height)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print("You need to provide settings paths!")
+        sys.exit(1)
+    logger = utils.setup_logger("VaultOrchestrator", logging.INFO)
+    utils.LOGGER = logger
+    vaults = load_vaults(sys.argv[1:], logger)
+    logger.info(f"orchestrating {len(vaults)} vaults")
+    # one thread per vault plus the main loop and the background checks of the node pool
+    utils.RPC_CONNECTIONS = max(utils.RPC_CONNECTIONS, len(vaults) + 2)
+    for vaultMaxi in vaults:
+        if vaultMaxi.metricsSettings is not None:
+            rpc_metrics.start(vaultMaxi.metricsSettings, logger)
+            break
+    run(vaults, logger)
@@ -0,0 +1,191 @@
+import argparse
+import json
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+import utils
+
+'''
+scans all vaults of the chain: listvaults is paged (the next page needs the last id of the previous one),
+while the next page loads, the getvault calls of the previous one already run as batches in a thread pool
+on the pooled connection of utils. the result is a VaultTable with one row per vault and numpy columns,
+so distributions and scenarios over all vaults are single array operations.
+
+usage:
+  python vault_scanner.py settings.json                       (only NODE_URL/NODE_USER/NODE_PASSWORD are used)
+  python vault_scanner.py settings.json --move DFI=-0.2 TSLA=0.1 --within 0.1
+    -> vaults that would be within 10% of their liquidation ratio if DFI drops 20% and TSLA rises 10%
+'''
+
+PAGE_SIZE = 1000  # vaults per listvaults call
+BATCH_SIZE = 250  # getvault calls per batch
+WORKERS = 8  # parallel batches, stays below the connection pool of utils.rpc_session
+
+
+class VaultTable:
+    """
+    one row per vault. amounts are matrices (vaults x tokens) with the tokens in collateralTokens/loanTokens
+    """
+
+    def __init__(self, vaults, schemeRatios, collateralFactors):
+        self.vaultIds = [vault['vaultId'] for vault in vaults]
+        self.owners = [vault.get('ownerAddress') for vault in vaults]
+        self.states = np.array([vault.get('state', "unknown") for vault in vaults])
+        self.minRatio = np.array([schemeRatios.get(vault.get('loanSchemeId'), 150) for vault in vaults], dtype=float)
+        self.collateralFactors = collateralFactors
+        collaterals = [utils.parse_amounts(vault.get('collateralAmounts')) for vault in vaults]
+        loans = [utils.parse_amounts(vault.get('loanAmounts')) for vault in vaults]
+        self.collateralTokens, self.collateralAmounts = self._matrix(collaterals)
+        self.loanTokens, self.loanAmounts = self._matrix(loans)
+        self.collateralValue = np.array([vault.get('collateralValue', 0) for vault in vaults], dtype=float)
+        self.loanValue = np.array([vault.get('loanValue', 0) for vault in vaults], dtype=float)
+        self.collateralRatio = np.array([vault.get('collateralRatio', -1) for vault in vaults], dtype=float)
+        self.nextCollateralRatio = np.array([vault.get('nextCollateralRatio', -1) for vault in vaults], dtype=float)
+
+    @staticmethod
+    def _matrix(rows):
+        tokens = sorted(set(token for row in rows for token in row))
+        index = {token: idx for idx, token in enumerate(tokens)}
+        result = np.zeros((len(rows), len(tokens)))
+        for idx, row in enumerate(rows):
+            for token, amount in row.items():
+                result[idx, index[token]] = amount
+        return tokens, result
+
+    def __len__(self):
+        return len(self.vaultIds)
+
+    def with_loans(self):
+        return self.loanAmounts.sum(axis=1) > 0
+
+    def ratios(self, prices, moves=None):
+        """
+        collateral ratio (%) of every vault with the given prices, -1 for vaults without loans
+        :param prices: token -> USD price (DUSD is 1 if missing)
+        :param moves: token -> relative price change, f.e. {"DFI": -0.2}
+        """
+        moves = moves or {}
+
+        def price(token):
+            return prices.get(token, 1.0 if token == "DUSD" else np.nan) * (1 + moves.get(token, 0))
+
+        collateral = self.collateralAmounts @ np.array([price(token) * self.collateralFactors.get(token, 1)
+                                                        for token in self.collateralTokens])
+        loan = self.loanAmounts @ np.array([price(token) for token in self.loanTokens])
+        with np.errstate(divide="ignore", invalid="ignore"):
+            return np.where(loan > 0, 100 * collateral / loan, -1)
+
+    def ratio_histogram(self, bins=(150, 160, 175, 200, 250, 300, 400, 500, 1000)):
+        ratios = self.collateralRatio[self.with_loans()]
+        counts, edges = np.histogram(ratios, bins=[0] + list(bins) + [np.inf])
+        return list(zip(edges[:-1], edges[1:], counts))
+
+    def near_liquidation(self, prices, within=0.1, moves=None):
+        """
+        :return: mask of the vaults that are below minRatio * (1 + within) with the moved prices
+        """
+        ratios = self.ratios(prices, moves)
+        return (ratios >= 0) & (ratios < self.minRatio * (1 + within))
+
+    def loan_exposure(self, prices):
+        """
+        :return: token -> [total loan amount, USD value]
+        """
+        totals = self.loanAmounts.sum(axis=0)
+        return {token: [float(amount), float(amount * prices.get(token, 1.0 if token == "DUSD" else np.nan))]
+                for token, amount in zip(self.loanTokens, totals)}
+
+
+def _collateral_factors():
+    tokens = utils.rpc("listcollateraltokens", silentErrors=True)
+    if tokens is None:
+        return {"DUSD": 0.99}
+    return {token['token']: token['factor'] for token in tokens}
+
+
+def _scheme_ratios():
+    schemes = utils.rpc("listloanschemes", silentErrors=True) or []
+    return {scheme['id']: scheme['mincolratio'] for scheme in schemes}
+
+
+def scan(workers=WORKERS, pageSize=PAGE_SIZE, batchSize=BATCH_SIZE):
+    """
+    :return: VaultTable of all vaults on chain
+    """
+    futures = []
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        factors = executor.submit(_collateral_factors)
+        schemes = executor.submit(_scheme_ratios)
+        start = None
+        while True:
+            pagination = {"limit": pageSize}
+            if start is not None:
+                pagination.update({"start": start, "including_start": False})
+            page = utils.rpc("listvaults", [{}, pagination])
+            for idx in range(0, len(page), batchSize):
+                calls = [("getvault", [entry['vaultId']]) for entry in page[idx:idx + batchSize]]
+                futures.append(executor.submit(utils.rpc_batch, calls, True))
+            if len(page) < pageSize:
+                break
+            start = page[-1]['vaultId']
+        vaults = [vault for future in futures for vault in future.result() if vault is not None]
+        return VaultTable(vaults, schemes.result(), factors.result())
+
+
+def oracle_prices(snapshot):
+    prices = {"DUSD": 1.0}
+    for price in snapshot.fixedPrices:
+        if price.get('isLive', True) and price['priceFeedId'].endswith("/USD"):
+            prices[price['priceFeedId'].split("/")[0]] = price['activePrice']
+    return prices
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="health statistics of all vaults on chain")
+    parser.add_argument("settings", help="settings.json with the node connection")
+    parser.add_argument("--move", nargs="*", default=["DFI=-0.1"], help="token=relative price change")
+    parser.add_argument("--within", type=float, default=0.1, help="distance to the liquidation ratio, 0.1 = 10%%")
+    parser.add_argument("--workers", type=int, default=WORKERS)
+    args = parser.parse_args()
+
+    with open(args.settings) as f:
+        settings = json.load(f)
+        if "NODE_URL" in settings:
+            utils.NODE_URL = settings["NODE_URL"]
+        if "BACKUP_NODES" in settings:
+            utils.BACKUP_NODES = settings["BACKUP_NODES"]
+        utils.NODE_USER = settings['NODE_USER']
+        utils.NODE_PASSWORD = settings['NODE_PASSWORD']
+
+    started = time.perf_counter()
+    table = scan(args.workers)
+    seconds = time.perf_counter() - started
+    prices = oracle_prices(utils.chain_snapshot())
+    if len(table) == 0:
+        print("no vaults found")
+        sys.exit(0)
+
+    withLoans = table.with_loans()
+    ratios = table.collateralRatio[withLoans]
+    print(f"{len(table)} vaults in {seconds:.1f} s, {int(withLoans.sum())} with loans")
+    states, counts = np.unique(table.states, return_counts=True)
+    print("states: " + ", ".join(f"{state} {count}" for state, count in zip(states, counts)))
+    if len(ratios) > 0:
+        print("collateral ratio percentiles: " + ", ".join(
+            f"p{q}: {value:.0f}%" for q, value in zip([1, 5, 25, 50, 75], np.percentile(ratios, [1, 5, 25, 50, 75]))))
+    for low, high, count in table.ratio_histogram():
+        print(f"  {low:>5.0f} - {high:<5.0f}%: {count}")
+
+    moves = {entry.split("=")[0]: float(entry.split("=")[1]) for entry in args.move}
+    for scenario in [{}, moves]:
+        mask = table.near_liquidation(prices, args.within, scenario)
+        name = ", ".join(f"{token} {100 * move:+.0f}%" for token, move in scenario.items()) or "current prices"
+        print(f"within {100 * args.within:.0f}% of liquidation with {name}: {int(mask.sum())} vaults, "
+              f"{table.loanValue[mask].sum():.0f} USD loans")
+
+    print("loans per token:")
+    for token, (amount, value) in sorted(table.loan_exposure(prices).items(), key=lambda item: -item[1][1]):
+        print(f"  {token}: {amount:.2f} ({value:.0f} USD)")